@@ -1,9 +1,44 @@
-from flask import Flask, request, jsonify, render_template_string
-import requests
-from datetime import datetime
+from flask import Flask, Response, abort, g, request, jsonify, render_template_string, stream_with_context
+from datetime import datetime, timedelta
+import json
 import os
+import secrets
+import time
+
+from blocking import run_blocking
+from catalog import BATCH_LIMIT, MODE_NAMES, PLAN_LIMIT, ScheduleCatalog, format_duration, route_label
+from delays import DelayFeed
+from estimates import COUNTIES, catalog_version, load_estimates
+from jobs import PREFETCH_LIMIT, PREFETCH_QUEUE_DEPTH, PREFETCH_WORKERS, JobQueue, QueueFull
+from metrics import cache_requests, http_in_progress, http_latency, llm_tokens, registry
+from ratelimit import BACKGROUND, INTERACTIVE, Overloaded, RateLimiter
+from precompiled import PrecompiledResponse, fingerprint, split_assets
+from routing import INF, MIN_TRANSFER, Router, format_time, parse_time
+from suggestion_cache import SuggestionCache, make_key
+from timetable_bin import load_timetable
+from tour import DEFAULT_STAY, MAX_STOPS, OBJECTIVES, TourPlanner, validate_trips
+from trip_store import MAX_PAGE_SIZE, PAGE_SIZE, TripError, TripStore
+from singleflight import SingleFlight
+from static_plans import STATIC_PLANS_URL
+from upstream import UpstreamError, openai_client
+from warmup import SuggestionWarmer, WARMUP_INTERVAL, load_catalog
 
 app = Flask(__name__)
+# 編譯後的時刻表以 mmap 開啟，各 worker 共用同一份頁面快取
+router = Router(load_timetable())
+catalog = ScheduleCatalog(router)
+# 編譯檔的標頭已有時刻表雜湊，只部署編譯檔時也能檢查預估矩陣是否過期
+estimates = load_estimates(catalog, digest=router.timetable.digest)
+# 即時誤點資料（DELAY_FEED 未設定時不啟動）
+delay_feed = DelayFeed(catalog)
+delay_feed.start()
+# 各 worker 共用上游配額，超出時排隊或直接拒絕
+rate_limiter = RateLimiter()
+suggestion_cache = SuggestionCache()
+suggestion_flights = SingleFlight(suggestion_cache)
+trip_store = TripStore()
+tour_planner = TourPlanner(catalog)
+registry.start()
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -291,7 +326,93 @@ HTML_TEMPLATE = """
         let bookedTrips = [];
         let currentSelection = null;
         
-        document.getElementById('planBtn').addEventListener('click', function() {
+        // 已確認行程存在伺服器端，載入頁面時逐頁取回
+        async function loadBookedTrips() {
+            let cursor = '';
+            bookedTrips = [];
+            do {
+                const response = await fetch('/api/trips?limit=200' + (cursor ? '&cursor=' + cursor : ''));
+                const data = await response.json();
+                bookedTrips = bookedTrips.concat(data.trips);
+                cursor = data.next_cursor;
+            } while (cursor);
+            if (bookedTrips.length) {
+                updateBookedTrips();
+            }
+        }
+        loadBookedTrips();
+        
+        // 同一查詢條件的規劃結果在頁面內重複使用；伺服器端另以 ETag 讓瀏覽器重新驗證
+        const planCache = new Map();
+        let currentPlan = null;
+        
+        // 常見查詢先讀 CDN 上預先匯出的靜態結果，查不到（或當天有即時誤點資料）時才呼叫 API
+        const STATIC_PLANS_URL = {{ static_plans_url|tojson }};
+        const PLANS_VERSION = {{ plans_version|tojson }};
+        const LIVE_DELAYS = {{ live_delays|tojson }};
+        let staticManifest = null;
+        
+        function loadStaticManifest() {
+            if (!staticManifest) {
+                staticManifest = fetch(STATIC_PLANS_URL + '/manifest.json').then(function(response) {
+                    return response.ok ? response.json() : null;
+                }).then(function(manifest) {
+                    // 時刻表或排序方式與目前不同的匯出結果不使用
+                    return manifest && manifest.version === PLANS_VERSION ? manifest : null;
+                }).catch(function() {
+                    return null;
+                });
+            }
+            return staticManifest;
+        }
+        
+        async function fetchStaticPlan(params) {
+            const value = params.get('departure_time') || '';
+            const match = /^(\d{4}-\d{2}-\d{2})T(\d{2}):(\d{2})$/.exec(value);
+            if (!STATIC_PLANS_URL || !match) return null;
+            const today = new Date();
+            const todayValue = today.getFullYear() + '-' + String(today.getMonth() + 1).padStart(2, '0') + '-' +
+                String(today.getDate()).padStart(2, '0');
+            if (LIVE_DELAYS && match[1] === todayValue) return null;
+            
+            const manifest = await loadStaticManifest();
+            const byOrigin = manifest && manifest.shards[params.get('origin')];
+            const shards = byOrigin && byOrigin[params.get('destination')];
+            const hour = parseInt(match[2], 10);
+            if (!shards || !shards[hour]) return null;
+            const response = await fetch(STATIC_PLANS_URL + '/' + shards[hour]);
+            if (!response.ok) return null;
+            const shard = await response.json();
+            // 取 from 不大於出發分鐘的最後一筆
+            const minute = hour * 60 + parseInt(match[3], 10);
+            let found = null;
+            shard.plans.forEach(function(plan) {
+                if (plan.from <= minute) found = plan;
+            });
+            return found && {routes: found.routes};
+        }
+        
+        function fetchPlan(params) {
+            const key = params.toString();
+            if (!planCache.has(key)) {
+                planCache.set(key, fetchStaticPlan(params).catch(function() {
+                    return null;
+                }).then(function(plan) {
+                    return plan || fetch('/api/plan?' + key).then(function(response) {
+                        if (!response.ok) {
+                            throw new Error('plan request failed: ' + response.status);
+                        }
+                        return response.json();
+                    });
+                }).catch(function(error) {
+                    planCache.delete(key);
+                    throw error;
+                }));
+            }
+            return planCache.get(key);
+        }
+        
+        document.getElementById('planBtn').addEventListener('click', async function() {
             const origin = document.getElementById('origin').value;
             const destination = document.getElementById('destination').value;
             
@@ -305,46 +426,48 @@ HTML_TEMPLATE = """
             
             loading.style.display = 'block';
             result.innerHTML = '';
+            cancelPrefetch();
             
-            setTimeout(function() {
-                displayRoutes();
+            const params = new URLSearchParams({
+                origin: origin,
+                destination: destination,
+                departure_time: document.getElementById('departure_time').value
+            });
+            try {
+                currentPlan = await fetchPlan(params);
+                renderRoutes(currentPlan.routes);
+            } catch (error) {
+                result.innerHTML = '<div class="route-summary">規劃失敗，請稍後再試</div>';
+            } finally {
                 loading.style.display = 'none';
-            }, 500);
+            }
         });
         
-        function displayRoutes() {
+        const ROUTE_CARDS = [
+            {type: 'fastest', title: '⚡ 時間最短方案', note: '高鐵可購買早鳥票或大學生票更優惠'},
+            {type: 'cheapest', title: '💰 費用最低方案', note: '台鐵無優惠票價，一律以全票計算'},
+            {type: 'recommended', title: '⭐ 推薦方案（折衷）', note: '綜合時間、費用與轉乘時間，不易錯過班次'}
+        ];
+        
+        function renderRoutes(routes) {
             const result = document.getElementById('result');
-            result.innerHTML = `
-                <div class="route-card" data-type="fastest">
-                    <h3>⚡ 時間最短方案</h3>
-                    <div class="route-summary"><strong>類型：</strong>高鐵+台鐵</div>
-                    <div class="route-summary"><strong>預估時長：</strong>約 3.5-4 小時</div>
-                    <div class="route-summary"><strong>預估費用：</strong>NT$ 1,283</div>
-                    <div class="route-summary" style="color: #666; font-size: 14px;">高鐵可購買早鳥票或大學生票更優惠</div>
-                    <div class="schedule-list"></div>
-                    <div class="gpt-section"></div>
-                </div>
-                
-                <div class="route-card" data-type="cheapest">
-                    <h3>💰 費用最低方案</h3>
-                    <div class="route-summary"><strong>類型：</strong>台鐵直達</div>
-                    <div class="route-summary"><strong>預估時長：</strong>4-5 小時</div>
-                    <div class="route-summary"><strong>預估費用：</strong>NT$ 966</div>
-                    <div class="route-summary" style="color: #666; font-size: 14px;">台鐵無優惠票價，一律以全票計算</div>
-                    <div class="schedule-list"></div>
-                    <div class="gpt-section"></div>
-                </div>
-                
-                <div class="route-card" data-type="recommended">
-                    <h3>⭐ 推薦方案（折衷）</h3>
-                    <div class="route-summary"><strong>類型：</strong>高鐵+台鐵（轉乘時間充裕）</div>
-                    <div class="route-summary"><strong>預估時長：</strong>約 4 小時</div>
-                    <div class="route-summary"><strong>預估費用：</strong>NT$ 1,283</div>
-                    <div class="route-summary" style="color: #666; font-size: 14px;">轉乘時間較充裕，不易錯過班次</div>
-                    <div class="schedule-list"></div>
-                    <div class="gpt-section"></div>
-                </div>
-            `;
+            let html = '';
+            ROUTE_CARDS.forEach(function(c) {
+                const r = routes[c.type];
+                html += '<div class="route-card" data-type="' + c.type + '">' +
+                    '<h3>' + c.title + '</h3>';
+                if (r.schedules.length) {
+                    const best = r.schedules[0];
+                    html += '<div class="route-summary"><strong>類型：</strong>' + r.label + '</div>' +
+                        '<div class="route-summary"><strong>預估時長：</strong>約 ' + best.duration + '</div>' +
+                        '<div class="route-summary"><strong>預估費用：</strong>NT$ ' + best.cost + '</div>' +
+                        '<div class="route-summary" style="color: #666; font-size: 14px;">' + c.note + '</div>';
+                } else {
+                    html += '<div class="route-summary">查無適合的班次</div>';
+                }
+                html += '<div class="schedule-list"></div><div class="gpt-section"></div></div>';
+            });
+            result.innerHTML = html;
             
             document.querySelectorAll('.route-card').forEach(function(card) {
                 card.addEventListener('click', function() {
@@ -353,12 +476,13 @@ HTML_TEMPLATE = """
             });
         }
         
-        async function toggleSchedule(type) {
+        function toggleSchedule(type) {
             const card = document.querySelector('[data-type="' + type + '"]');
             const scheduleDiv = card.querySelector('.schedule-list');
             
             if (scheduleDiv.style.display === 'block') {
                 scheduleDiv.style.display = 'none';
+                cancelPrefetch();
                 return;
             }
             
@@ -370,30 +494,114 @@ HTML_TEMPLATE = """
                 el.style.display = 'none';
             });
             
-            const response = await fetch('/api/get_schedules?type=' + type);
-            const data = await response.json();
+            const schedules = currentPlan.routes[type].schedules;
             
             let html = '';
-            data.schedules.forEach(function(s) {
+            if (schedules.length === 0) {
+                html = '<div class="schedule-detail">查無適合的班次，請調整出發時間或地點</div>';
+            }
+            schedules.forEach(function(s) {
                 html += '<div class="schedule-item" data-schedule="' + s.id + '">' +
                     '<div class="schedule-detail"><strong>' + s.title + '</strong></div>' +
                     '<div class="schedule-detail">' + s.detail + '</div>' +
+                    (s.live ? '<div class="schedule-detail" style="color: #d32f2f;">' + s.live.detail + '</div>' : '') +
                     '<div class="schedule-detail">時長：' + s.duration + ' | 費用：NT$ ' + s.cost + '</div>' +
+                    '<div class="schedule-detail" style="color: #666; font-size: 14px;">' +
+                    s.fares.filter(function(f) { return f.category !== 'adult' && f.cost !== s.cost; })
+                        .map(function(f) { return f.name + ' NT$ ' + f.cost; }).join('｜') +
+                    '</div>' +
                     '</div>';
             });
             
             scheduleDiv.innerHTML = html;
             scheduleDiv.style.display = 'block';
+            prefetchSuggestions(schedules.map(function(s) { return s.id; }));
             
             scheduleDiv.querySelectorAll('.schedule-item').forEach(function(item) {
                 item.addEventListener('click', function(e) {
                     e.stopPropagation();
-                    const scheduleId = parseInt(this.getAttribute('data-schedule'));
+                    const scheduleId = this.getAttribute('data-schedule');
                     selectSchedule(type, scheduleId);
                 });
             });
         }
         
+        let suggestionRequest = 0;
+        
+        // 展開方案時預先請伺服器產生各班次的建議，點選班次時直接沿用；切換方案時取消尚未開始的工作
+        let prefetchJobs = {};
+        let prefetchRequest = 0;
+        
+        function cancelPrefetchJobs(jobIds) {
+            if (!jobIds.length) return;
+            fetch('/api/get_suggestion/prefetch', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({cancel: jobIds}),
+                keepalive: true
+            }).catch(function() {});
+        }
+        
+        function cancelPrefetch() {
+            prefetchRequest++;
+            cancelPrefetchJobs(Object.values(prefetchJobs));
+            prefetchJobs = {};
+        }
+        
+        async function prefetchSuggestions(scheduleIds) {
+            cancelPrefetch();
+            if (!scheduleIds.length) return;
+            const requestId = prefetchRequest;
+            let data;
+            try {
+                const response = await fetch('/api/get_suggestion/prefetch', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({
+                        schedule_ids: scheduleIds,
+                        departure_time: document.getElementById('departure_time').value
+                    })
+                });
+                if (!response.ok) return;
+                data = await response.json();
+            } catch (e) {
+                return;
+            }
+            if (requestId !== prefetchRequest) {
+                // 回應前已切換到其他方案
+                cancelPrefetchJobs(Object.values(data.jobs));
+                return;
+            }
+            prefetchJobs = data.jobs;
+        }
+        
+        function showSuggestion(textEl, text) {
+            textEl.innerHTML = text.split('\\n').join('<br>');
+        }
+        
+        let suggestionStream = null;
+        
+        function streamJob(jobId, textEl) {
+            // 以 SSE 逐段顯示工作中模型已產生的文字；回傳工作最後的狀態，連線中斷時視為仍在執行
+            return new Promise(function(resolve) {
+                const source = new EventSource('/api/get_suggestion/jobs/' + encodeURIComponent(jobId) + '/stream');
+                suggestionStream = source;
+                let text = '';
+                source.onmessage = function(e) {
+                    text += JSON.parse(e.data).delta;
+                    showSuggestion(textEl, text);
+                };
+                source.addEventListener('done', function(e) {
+                    source.close();
+                    resolve(JSON.parse(e.data));
+                });
+                source.onerror = function() {
+                    source.close();
+                    resolve({job_id: jobId, status: 'running'});
+                };
+            });
+        }
+        
         async function selectSchedule(type, scheduleId) {
             const card = document.querySelector('[data-type="' + type + '"]');
             const gptSection = card.querySelector('.gpt-section');
@@ -402,14 +610,42 @@ HTML_TEMPLATE = """
                 el.style.display = 'none';
             });
             
-            const response = await fetch('/api/get_suggestion', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ type: type, schedule_id: scheduleId })
-            });
+            // 切換班次後，先前的查詢結果不再顯示
+            const requestId = ++suggestionRequest;
+            if (suggestionStream) {
+                suggestionStream.close();
+                suggestionStream = null;
+            }
+            const prefetchJob = prefetchJobs[scheduleId];
+            delete prefetchJobs[scheduleId];
             
-            const data = await response.json();
-            const suggestionText = data.suggestion.split('\\n').join('<br>');
+            gptSection.innerHTML = '<h3>🤖 助手建議</h3>' +
+                '<p class="suggestion-text">AI建議載入中...</p>' +
+                '<div class="suggestion-actions"></div>';
+            gptSection.style.display = 'block';
+            
+            const textEl = gptSection.querySelector('.suggestion-text');
+            const actionsEl = gptSection.querySelector('.suggestion-actions');
+            
+            // 先顯示本地建議，模型的文字開始串流後取代；串流中斷或逾時時改以 long-poll 等待完成
+            let data;
+            try {
+                const response = await fetch('/api/get_suggestion', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({
+                        schedule_id: scheduleId,
+                        departure_time: document.getElementById('departure_time').value,
+                        prefetch_job: prefetchJob
+                    })
+                });
+                if (!response.ok) throw new Error(response.status);
+                data = await response.json();
+            } catch (e) {
+                textEl.innerHTML = 'GPT建議暫時無法使用';
+                return;
+            }
+            if (requestId !== suggestionRequest) return;
             
             currentSelection = {
                 type: type,
@@ -424,35 +660,60 @@ HTML_TEMPLATE = """
                 bookingHTML = '<a href="' + data.booking_links.hsr + '" target="_blank" class="book-link">訂購高鐵</a> ' +
                               '<a href="' + data.booking_links.tra + '" target="_blank" class="book-link">訂購台鐵</a>';
             } else {
-                bookingHTML = '<a href="' + data.booking_links.tra + '" target="_blank" class="book-link">前往訂票</a>';
+                bookingHTML = '<a href="' + (data.booking_links.hsr || data.booking_links.tra) + '" target="_blank" class="book-link">前往訂票</a>';
             }
             
-            gptSection.innerHTML = '<h3>🤖 助手建議</h3>' +
-                '<p>' + suggestionText + '</p>' +
-                bookingHTML +
+            actionsEl.innerHTML = bookingHTML +
                 '<button class="confirm-trip" onclick="confirmTrip()">✓ 確認行程</button>';
+            showSuggestion(textEl, data.suggestion);
+            if (!data.job_id) return;
             
-            gptSection.style.display = 'block';
+            let job = await streamJob(data.job_id, textEl);
+            if (requestId !== suggestionRequest) return;
+            while (job.status === 'queued' || job.status === 'running') {
+                try {
+                    const response = await fetch('/api/get_suggestion/jobs/' + job.job_id + '?wait=20');
+                    if (!response.ok) return;
+                    job = await response.json();
+                } catch (e) {
+                    return;
+                }
+                if (requestId !== suggestionRequest) return;
+            }
+            if (job.status === 'done' && job.suggestion) {
+                showSuggestion(textEl, job.suggestion);
+            } else if (prefetchJob && job.job_id === prefetchJob) {
+                // 預取的工作未取得建議（例如背景配額不足），改以一般請求重試
+                selectSchedule(type, scheduleId);
+            }
         }
         
-        function confirmTrip() {
+        async function confirmTrip() {
             if (!currentSelection) return;
             
-            const origin = document.getElementById('origin').value;
-            const destination = document.getElementById('destination').value;
-            const departureTime = document.getElementById('departure_time').value;
-            
             const trip = {
-                id: Date.now(),
-                origin: origin,
-                destination: destination,
-                departureTime: departureTime,
+                origin: document.getElementById('origin').value,
+                destination: document.getElementById('destination').value,
+                departure_time: document.getElementById('departure_time').value,
+                schedule_id: currentSelection.scheduleId,
                 schedule: currentSelection.scheduleTitle,
                 cost: currentSelection.cost,
-                bookingLinks: currentSelection.bookingLinks
+                booking_links: currentSelection.bookingLinks
             };
             
-            bookedTrips.push(trip);
+            const response = await fetch('/api/trips', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify(trip)
+            });
+            if (!response.ok) {
+                alert('行程儲存失敗，請稍後再試');
+                return;
+            }
+            const data = await response.json();
+            bookedTrips = bookedTrips.concat(data.trips).sort(function(a, b) {
+                return a.departure_time < b.departure_time ? -1 : a.departure_time > b.departure_time ? 1 : a.id - b.id;
+            });
             updateBookedTrips();
             
             alert('✓ 行程已加入！');
@@ -471,14 +732,14 @@ HTML_TEMPLATE = """
             
             let html = '';
             bookedTrips.forEach(function(trip) {
-                const date = new Date(trip.departureTime);
+                const date = new Date(trip.departure_time);
                 const formattedDate = date.getFullYear() + '/' + 
                                       (date.getMonth() + 1) + '/' + 
                                       date.getDate() + ' ' +
                                       String(date.getHours()).padStart(2, '0') + ':' +
                                       String(date.getMinutes()).padStart(2, '0');
                 
-                html += '<div class="trip-item">' +
+                html += '<div class="trip-item" data-trip="' + trip.id + '">' +
                     '<div class="trip-item-header">' +
                     '<div class="trip-route">' + trip.origin + ' → ' + trip.destination + '</div>' +
                     '<button class="delete-trip" onclick="deleteTrip(' + trip.id + ')">刪除</button>' +
@@ -491,9 +752,29 @@ HTML_TEMPLATE = """
             
             tripsList.innerHTML = html;
             bookedTripsDiv.scrollIntoView({ behavior: 'smooth' });
+            checkTripConflicts();
+        }
+        
+        // 由伺服器檢查行程是否前後銜接，在有問題的行程下方顯示提醒
+        async function checkTripConflicts() {
+            const response = await fetch('/api/trips/validate');
+            if (!response.ok) return;
+            const data = await response.json();
+            data.conflicts.forEach(function(conflict) {
+                const item = document.querySelector('.trip-item[data-trip="' + conflict.trip_id + '"]');
+                if (item) {
+                    item.insertAdjacentHTML('beforeend',
+                        '<div class="trip-detail" style="color: #d32f2f;">⚠️ ' + conflict.message + '</div>');
+                }
+            });
         }
         
-        function deleteTrip(tripId) {
+        async function deleteTrip(tripId) {
+            const response = await fetch('/api/trips/' + tripId, {method: 'DELETE'});
+            if (!response.ok && response.status !== 404) {
+                alert('刪除失敗，請稍後再試');
+                return;
+            }
             bookedTrips = bookedTrips.filter(function(trip) {
                 return trip.id !== tripId;
             });
@@ -504,219 +785,790 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# 首頁沒有動態內容：啟動時編譯一次，CSS/JS 拆成帶指紋的長效快取檔案
+with app.app_context():
+    home_html, page_assets = split_assets(render_template_string(
+        HTML_TEMPLATE,
+        static_plans_url=STATIC_PLANS_URL,
+        plans_version=catalog_version(catalog, router.timetable.digest),
+        live_delays=bool(delay_feed.source)
+    ))
+home_page = PrecompiledResponse(home_html, "text/html")
+
 @app.route('/')
 def home():
-    return render_template_string(HTML_TEMPLATE)
+    return home_page.response(request)
+
+@app.route('/assets/<name>')
+def asset(name):
+    page_asset = page_assets.get(name)
+    if page_asset is None:
+        abort(404)
+    return page_asset.response(request)
+
+WEEKDAYS = "一二三四五六日"
+
+def parse_departure(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M")
+    except (TypeError, ValueError):
+        return datetime.now()
 
 @app.route('/api/get_schedules', methods=['GET'])
 def get_schedules():
     route_type = request.args.get('type')
+    origin = request.args.get('origin', '台中市')
+    destination = request.args.get('destination', '花蓮縣')
+    departure = parse_departure(request.args.get('departure_time'))
     
-    if route_type == 'fastest':
-        schedules = [
-            {
-                "id": 1,
-                "title": "高鐵1202 (07:21→08:04) + 台鐵3000-472 (08:40→11:05)",
-                "detail": "台中07:21出發 → 花蓮11:05抵達",
-                "duration": "3小時44分",
-                "cost": "1,283"
-            },
-            {
-                "id": 2,
-                "title": "高鐵0204 (07:48→08:34) + 台鐵212 (08:52→11:51)",
-                "detail": "台中07:48出發 → 花蓮11:51抵達",
-                "duration": "4小時3分",
-                "cost": "1,283"
-            }
-        ]
-    elif route_type == 'cheapest':
-        schedules = [
-            {
-                "id": 3,
-                "title": "台鐵自強170 (07:24→12:44)",
-                "detail": "台中直達花蓮，無需轉乘",
-                "duration": "5小時20分",
-                "cost": "966"
-            },
-            {
-                "id": 4,
-                "title": "台鐵自強3000-280 (07:49→12:11)",
-                "detail": "台中直達花蓮，無需轉乘",
-                "duration": "4小時22分",
-                "cost": "966"
-            }
-        ]
-    else:
-        schedules = [
-            {
-                "id": 5,
-                "title": "高鐵0802 (07:25→08:29) + 台鐵3000-418 (09:26→11:46)",
-                "detail": "台中07:25出發 → 花蓮11:46抵達（轉乘時間57分鐘）",
-                "duration": "4小時21分",
-                "cost": "1,283"
-            },
-            {
-                "id": 6,
-                "title": "高鐵1602 (07:40→08:39) + 台鐵3000-280 (09:45→12:11)",
-                "detail": "台中07:40出發 → 花蓮12:11抵達（轉乘時間66分鐘）",
-                "duration": "4小時31分",
-                "cost": "1,283"
-            }
-        ]
+    found = catalog.search(origin, destination, departure.hour * 60 + departure.minute, route_type)
+    schedules = [live_payload(s, departure.date()) for s in found]
     
     return jsonify({"schedules": schedules})
 
+def live_status(schedule, travel_date):
+    # 誤點資料只反映今天的列車
+    if travel_date != datetime.now().date():
+        return None
+    return catalog.live(schedule)
+
+def live_detail(schedule, status):
+    # 例如：台鐵自強472 誤點12分鐘，南港轉乘時間剩3分鐘
+    parts = [f"{segment.name} 誤點{delay}分鐘" for segment, delay in zip(schedule.segments, status.delays) if delay]
+    for transfer in status.transfers:
+        name = router.timetable.stations[transfer.station].name
+        if transfer.slack < 0:
+            parts.append(f"{name}轉乘已來不及")
+        elif transfer.slack < MIN_TRANSFER:
+            parts.append(f"{name}轉乘時間剩{transfer.slack}分鐘，恐怕來不及")
+        else:
+            parts.append(f"{name}轉乘時間剩{transfer.slack}分鐘")
+    return "，".join(parts)
+
+def live_payload(schedule, travel_date):
+    status = live_status(schedule, travel_date)
+    if status is None:
+        return schedule.payload
+    return dict(schedule.payload, live={
+        "delay": status.arrival_delay,
+        "transfer_type": status.transfer_type,
+        "feasible": status.feasible,
+        "detail": live_detail(schedule, status)
+    })
+
+@app.route('/api/estimate', methods=['GET'])
+def estimate():
+    origin = request.args.get('origin', '台中市')
+    destination = request.args.get('destination', '花蓮縣')
+    departure = parse_departure(request.args.get('departure_time'))
+    
+    # 由預先計算的矩陣查表，不執行班次搜尋
+    routes = {}
+    for route_type, (minutes, fare) in estimates.lookup(origin, destination, departure.hour).items():
+        routes[route_type] = {"duration": format_duration(minutes), "cost": f"{fare:,}",
+                              "minutes": minutes, "fare": fare}
+    
+    return jsonify({"routes": routes})
+
+@app.route('/api/plan', methods=['GET'])
+def plan():
+    origin = request.args.get('origin', '台中市')
+    destination = request.args.get('destination', '花蓮縣')
+    departure = parse_departure(request.args.get('departure_time'))
+    
+    # 一次回傳三種方案與各自的班次；內容只取決於查詢條件與時刻表，可由瀏覽器快取並以 ETag 重新驗證
+    found = catalog.plan(origin, destination, departure.hour * 60 + departure.minute)
+    routes = {}
+    for route_type, schedules in found.items():
+        routes[route_type] = {
+            "label": route_label(schedules[0]) if schedules else None,
+            "schedules": [live_payload(s, departure.date()) for s in schedules]
+        }
+    return public_json({"routes": routes})
+
+def public_json(payload):
+    # 以內容雜湊作為 ETag，可由瀏覽器與 CDN 快取
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = fingerprint(body)
+    
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age=60"
+    return response
+
+@app.route('/api/reachable', methods=['GET'])
+def reachable():
+    origin = request.args.get('origin', '台北市')
+    departure = parse_departure(request.args.get('departure_time'))
+    start = departure.hour * 60 + departure.minute
+    
+    # 時間上限可用抵達時間（arrive_by=12:00）或車程分鐘數（max_minutes），票價上限為 max_fare
+    arrive_by = None
+    try:
+        if request.args.get('arrive_by'):
+            arrive_by = parse_time(request.args['arrive_by'])
+    except ValueError:
+        return jsonify({"error": "arrive_by 格式應為 HH:MM"}), 400
+    max_minutes = request.args.get('max_minutes', type=int)
+    if max_minutes is not None:
+        arrive_by = min(arrive_by if arrive_by is not None else start + max_minutes, start + max_minutes)
+    max_fare = request.args.get('max_fare', type=int)
+    
+    # 一次掃描時刻表即得到所有縣市的最早抵達與最便宜行程
+    counties = []
+    for county, (earliest, cheapest) in catalog.reachable(origin, start, arrive_by, max_fare).items():
+        counties.append({
+            "county": county,
+            "earliest": dict(earliest.payload, arrival=format_time(earliest.arrival), fare=earliest.fare),
+            "cheapest": dict(cheapest.payload, arrival=format_time(cheapest.arrival), fare=cheapest.fare)
+        })
+    reached = {c["county"] for c in counties}
+    unreachable = [c for c in COUNTIES if c != origin and c not in reached]
+    
+    return public_json({"origin": origin, "counties": counties, "unreachable": unreachable})
+
+ROUTE_TYPES = ("fastest", "cheapest", "recommended")
+
+def batch_query(row):
+    # 接受 [起點, 終點, 出發時間] 或 {"origin", "destination", "departure_time"}；時間可為 HH:MM 或 YYYY-MM-DDTHH:MM
+    if isinstance(row, dict):
+        row = (row.get("origin"), row.get("destination"), row.get("departure_time"))
+    origin, destination, departure = row
+    if not isinstance(origin, str) or not isinstance(destination, str):
+        raise ValueError("origin and destination must be strings")
+    if not catalog.known(origin, destination):
+        raise ValueError("unknown county")
+    departure = parse_time(str(departure).rpartition("T")[2][:5])
+    if not 0 <= departure < 24 * 60:
+        raise ValueError("departure_time out of range")
+    return origin, destination, departure
+
+def batch_column(plans, route_type, field):
+    column = []
+    for plan in plans:
+        found = plan[route_type]
+        column.append(getattr(found[0], field) if found else None)
+    return column
+
+@app.route('/api/plan_batch', methods=['POST'])
+def plan_batch():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "請求內容必須為 JSON 物件"}), 400
+    rows = data.get("queries")
+    if not isinstance(rows, list):
+        return jsonify({"error": "queries 必須為陣列"}), 400
+    if len(rows) > BATCH_LIMIT:
+        return jsonify({"error": f"單次最多 {BATCH_LIMIT} 筆查詢"}), 413
+    
+    queries = []
+    for i, row in enumerate(rows):
+        try:
+            queries.append(batch_query(row))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"第 {i} 筆查詢格式錯誤：{e}"}), 400
+    try:
+        limit = max(1, min(int(data.get("limit") or 1), PLAN_LIMIT))
+    except (TypeError, ValueError, OverflowError):
+        return jsonify({"error": "limit 必須為整數"}), 400
+    plans = catalog.plan_many(queries, limit)
+    
+    # NDJSON：每筆查詢一行，依輸入順序逐行輸出
+    if data.get("format") == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson":
+        def lines():
+            for (origin, destination, departure), plan in zip(queries, plans):
+                row = {"origin": origin, "destination": destination, "departure_time": format_time(departure)}
+                for route_type in ROUTE_TYPES:
+                    row[route_type] = [
+                        {"id": s.id, "departure": format_time(s.departure), "arrival": format_time(s.arrival),
+                         "fare": s.fare, "transfers": len(s.transfers)}
+                        for s in plan[route_type]
+                    ]
+                yield json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n"
+        return Response(lines(), mimetype="application/x-ndjson")
+    
+    # 欄式格式：各方案排名第一的行程，時間以當日分鐘數表示，查無行程時為 null
+    columns = {}
+    for route_type in ROUTE_TYPES:
+        columns[f"{route_type}_id"] = batch_column(plans, route_type, "id")
+        columns[f"{route_type}_departure"] = batch_column(plans, route_type, "departure")
+        columns[f"{route_type}_arrival"] = batch_column(plans, route_type, "arrival")
+        columns[f"{route_type}_fare"] = batch_column(plans, route_type, "fare")
+        columns[f"{route_type}_transfers"] = [len(t) if t is not None else None
+                                             for t in batch_column(plans, route_type, "transfers")]
+    return jsonify({"count": len(queries), "columns": columns})
+
+def trip_user():
+    # 以 cookie 識別使用者；第一次使用時發給新的識別碼
+    user = request.cookies.get("uid")
+    if not user:
+        user = g.new_user = secrets.token_urlsafe(16)
+    return user
+
+@app.before_request
+def start_timer():
+    g.metrics_endpoint = request.endpoint or "unknown"
+    g.metrics_started = time.perf_counter()
+    http_in_progress.inc(g.metrics_endpoint)
+
+@app.after_request
+def record_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def record_latency(error=None):
+    # 串流回應只量到開始傳送為止
+    endpoint = g.pop("metrics_endpoint", None)
+    if endpoint is None:
+        return
+    status = g.pop("metrics_status", 500)
+    http_latency.observe(time.perf_counter() - g.pop("metrics_started"), endpoint, request.method, status)
+    http_in_progress.dec(endpoint)
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.after_request
+def remember_user(response):
+    new_user = g.pop("new_user", None)
+    if new_user:
+        response.set_cookie("uid", new_user, max_age=5 * 365 * 24 * 3600, httponly=True, samesite="Lax")
+    return response
+
+def conditional(payload, etag):
+    # 條件式 GET：內容未變時回傳 304
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+@app.route('/api/trips', methods=['GET'])
+def list_trips():
+    user = trip_user()
+    cursor = request.args.get("cursor") or None
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    
+    # 版本號在每次寫入時遞增，不需查詢行程即可判斷內容是否改變
+    etag = f"{trip_store.version(user)}-{limit}-{cursor or ''}"
+    if request.if_none_match.contains(etag):
+        return conditional(None, etag)
+    try:
+        trips, next_cursor = trip_store.list(user, cursor, limit)
+    except TripError as e:
+        return jsonify({"error": str(e)}), 400
+    return conditional({"trips": trips, "next_cursor": next_cursor}, etag)
+
+@app.route('/api/trips', methods=['POST'])
+def create_trips():
+    # 接受單筆行程或 {"trips": [...]} 批次新增
+    data = request.get_json(silent=True)
+    rows = data.get("trips") if isinstance(data, dict) and "trips" in data else [data]
+    if not isinstance(rows, list):
+        return jsonify({"error": "trips 必須為陣列"}), 400
+    try:
+        trips = trip_store.insert_many(trip_user(), rows)
+    except TripError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"trips": trips}), 201
+
+@app.route('/api/trips', methods=['DELETE'])
+def delete_trips():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "請求內容必須為 JSON 物件"}), 400
+    ids = data.get("ids")
+    if not isinstance(ids, list):
+        return jsonify({"error": "ids 必須為陣列"}), 400
+    try:
+        deleted = trip_store.delete_many(trip_user(), ids)
+    except TripError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"deleted": deleted})
+
+@app.route('/api/trips/validate', methods=['GET'])
+def validate_booked_trips():
+    # 檢查目前使用者的已訂行程是否前後銜接
+    user = trip_user()
+    trips, cursor = trip_store.list(user, limit=MAX_PAGE_SIZE)
+    while cursor:
+        page, cursor = trip_store.list(user, cursor, MAX_PAGE_SIZE)
+        trips.extend(page)
+    return jsonify({"conflicts": validate_trips(catalog, trips)})
+
+@app.route('/api/tour', methods=['POST'])
+def plan_tour():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "請求內容必須為 JSON 物件"}), 400
+    origin = data.get('origin', '台北市')
+    counties = data.get('counties') or []
+    departure = parse_departure(data.get('departure_time'))
+    objective = data.get('objective', 'time')
+    end = data.get('end') or None
+    stay = data.get('stay_minutes', DEFAULT_STAY)
+    
+    if not isinstance(counties, list) or not 0 < len(counties) <= MAX_STOPS:
+        return jsonify({"error": f"請選擇 1 到 {MAX_STOPS} 個縣市"}), 400
+    if not all(isinstance(c, str) for c in counties + [origin] + ([end] if end else [])):
+        return jsonify({"error": "縣市名稱必須為字串"}), 400
+    known = router.timetable.county_stations
+    unknown = [c for c in counties + [origin] + ([end] if end else []) if c not in known]
+    if unknown:
+        return jsonify({"error": "沒有火車站的縣市：" + "、".join(map(str, unknown))}), 400
+    if objective not in OBJECTIVES or not isinstance(stay, int) or isinstance(stay, bool) or stay < 0:
+        return jsonify({"error": "objective 或 stay_minutes 不正確"}), 400
+    end_time = data.get('end_time') or None
+    if end_time is not None and not isinstance(end_time, str):
+        return jsonify({"error": "end_time 格式應為 HH:MM"}), 400
+    try:
+        deadline = parse_time(end_time) if end_time else None
+    except ValueError:
+        return jsonify({"error": "end_time 格式應為 HH:MM"}), 400
+    
+    start = departure.hour * 60 + departure.minute
+    # 區域搜尋會用滿 SEARCH_BUDGET 的 CPU 時間（首次另需建立各段的行程索引），
+    # 改在原生執行緒執行，不卡住同一 worker 的串流與 long-poll
+    tour = run_blocking(tour_planner.plan, origin, counties, start, deadline if deadline is not None else INF,
+                        objective, stay, end)
+    # 車程由第一段出發算到最後抵達，與回傳的 departure 一致
+    duration = tour.arrival - tour.schedules[0].departure if tour.schedules else 0
+    legs = [dict(s.payload, origin=s.origin, destination=s.destination,
+                 departure=format_time(s.departure), arrival=format_time(s.arrival), fare=s.fare)
+            for s in tour.schedules]
+    return jsonify({
+        "feasible": tour.feasible,
+        "order": list(tour.order),
+        "legs": legs,
+        "departure": format_time(tour.schedules[0].departure) if tour.schedules else None,
+        "arrival": format_time(tour.arrival) if tour.schedules else None,
+        "duration": format_duration(duration),
+        "fare": tour.fare,
+        "cost": f"{tour.fare:,}"
+    })
+
+@app.route('/api/trips/<int:trip_id>', methods=['GET'])
+def get_trip(trip_id):
+    trip = trip_store.get(trip_user(), trip_id)
+    if trip is None:
+        return jsonify({"error": "找不到此行程"}), 404
+    return conditional(trip, f"trip-{trip_id}")
+
+@app.route('/api/trips/<int:trip_id>', methods=['DELETE'])
+def delete_trip(trip_id):
+    if not trip_store.delete_many(trip_user(), [trip_id]):
+        return jsonify({"error": "找不到此行程"}), 404
+    return "", 204
+
 @app.route('/api/get_suggestion', methods=['POST'])
 def get_suggestion():
     data = request.get_json()
     schedule_id = data.get('schedule_id')
+    departure = parse_departure(data.get('departure_time'))
     
     # 獲取班次詳細資訊
-    schedule_info = {
-        1: {"title": "高鐵1202 (07:21→08:04) + 台鐵3000-472 (08:40→11:05)", "cost": "1,283"},
-        2: {"title": "高鐵0204 (07:48→08:34) + 台鐵212 (08:52→11:51)", "cost": "1,283"},
-        3: {"title": "台鐵自強170 (07:24→12:44)", "cost": "966"},
-        4: {"title": "台鐵自強3000-280 (07:49→12:11)", "cost": "966"},
-        5: {"title": "高鐵0802 (07:25→08:29) + 台鐵3000-418 (09:26→11:46)", "cost": "1,283"},
-        6: {"title": "高鐵1602 (07:40→08:39) + 台鐵3000-280 (09:45→12:11)", "cost": "1,283"}
-    }
+    schedule = catalog.get(schedule_id)
+    if schedule is None:
+        return jsonify({"error": "找不到此班次"}), 404
     
-    suggestion = generate_gpt_suggestion(schedule_id)
+    prefetch_job = data.get('prefetch_job')
+    if not isinstance(prefetch_job, str):
+        prefetch_job = None
+    suggestion, source, job_id = generate_gpt_suggestion(schedule_id, departure.date(), prefetch_job)
     
-    if schedule_id in [1, 2, 5, 6]:
-        booking_links = {
-            "hsr": "https://www.thsrc.com.tw/",
-            "tra": "https://www.railway.gov.tw/"
-        }
-    else:
-        booking_links = {
-            "tra": "https://www.railway.gov.tw/"
-        }
+    # 模型的建議尚未產生時回傳 202 與工作代碼，由用戶端查詢或 long-poll 結果
+    body = dict(schedule_meta(schedule), suggestion=suggestion, source=source)
+    if job_id is None:
+        return jsonify(body)
+    location = f"/api/get_suggestion/jobs/{job_id}"
+    return jsonify(dict(body, job_id=job_id, status="queued")), 202, {"Location": location}
+
+@app.route('/api/get_suggestion/prefetch', methods=['POST'])
+def prefetch_suggestions():
+    # 展開方案時預先產生各班次的建議；cancel 為先前預取的工作代碼，尚未開始的會被取消
+    data = request.get_json(silent=True) or {}
+    schedule_ids = data.get('schedule_ids') or []
+    cancel = data.get('cancel') or []
+    if not isinstance(schedule_ids, list) or not isinstance(cancel, list):
+        return jsonify({"error": "schedule_ids 與 cancel 必須是陣列"}), 400
     
-    return jsonify({
-        "suggestion": suggestion,
+    cancelled = prefetch_jobs.cancel(cancel)
+    departure = parse_departure(data.get('departure_time'))
+    jobs = {}
+    for schedule_id in schedule_ids[:PREFETCH_LIMIT]:
+        if isinstance(schedule_id, str):
+            job_id = prefetch_suggestion(schedule_id, departure.date())
+            if job_id is not None:
+                jobs[schedule_id] = job_id
+    return jsonify({"jobs": jobs, "cancelled": cancelled}), 202 if jobs else 200
+
+def job_queue(job_id):
+    # 預取的工作由預取佇列回應，在建立工作的 worker 上可由行程內的通知立即喚醒
+    return prefetch_jobs if prefetch_jobs.owns(job_id) else suggestion_jobs
+
+def job_body(job):
+    body = {"job_id": job["id"], "status": job["status"]}
+    if job["status"] == "done":
+        body["suggestion"] = job["result"]
+    elif job["status"] == "failed":
+        body["error"] = job["error"]
+    return body
+
+@app.route('/api/get_suggestion/jobs/<job_id>', methods=['GET'])
+def suggestion_job(job_id):
+    wait = request.args.get('wait', 0, type=float)
+    job = job_queue(job_id).wait(job_id, wait)
+    if job is None:
+        return jsonify({"error": "找不到此工作"}), 404
+    return jsonify(job_body(job))
+
+@app.route('/api/get_suggestion/jobs/<job_id>/stream', methods=['GET'])
+def stream_suggestion_job(job_id):
+    queue = job_queue(job_id)
+    if queue.get(job_id) is None:
+        return jsonify({"error": "找不到此工作"}), 404
+    
+    # 以 Server-Sent Events 逐段轉送工作中模型已產生的文字，任何 worker 都能回應；
+    # 最後以 done 事件送出工作狀態，逾時仍未完成時狀態為 queued/running，由前端改以 long-poll 等待
+    def events():
+        sent = ""
+        job = None
+        for job in queue.follow(job_id):
+            text = job["result"] or ""
+            if job["status"] in ("running", "done") and text.startswith(sent) and len(text) > len(sent):
+                yield sse_event({"delta": text[len(sent):]})
+                sent = text
+        if job is not None:
+            yield sse_event(job_body(job), "done")
+    
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def schedule_meta(schedule):
+    booking_links = {}
+    if "HSR" in schedule.modes:
+        booking_links["hsr"] = "https://www.thsrc.com.tw/"
+    if "TRA" in schedule.modes:
+        booking_links["tra"] = "https://www.railway.gov.tw/"
+    return {
         "booking_links": booking_links,
-        "schedule_title": schedule_info[schedule_id]["title"],
-        "cost": schedule_info[schedule_id]["cost"]
-    })
+        "schedule_title": schedule.payload["title"],
+        "cost": schedule.payload["cost"]
+    }
 
-# 修改後的 generate_gpt_suggestion 函數
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return prefix + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-# 修改後的 generate_gpt_suggestion 函數
+def suggestion_detail(schedule):
+    # 例如：高鐵07:21出發，08:04抵達台北，轉乘08:40台鐵，11:05抵達花蓮
+    segments = schedule.segments
+    if len(segments) == 1:
+        s = segments[0]
+        return f"{s.name}{format_time(s.departure)}直達，{format_time(s.arrival)}抵達{s.destination}"
+    first = segments[0]
+    parts = [f"{MODE_NAMES[first.mode]}{format_time(first.departure)}出發，{format_time(first.arrival)}抵達{first.destination}"]
+    for s in segments[1:]:
+        parts.append(f"轉乘{format_time(s.departure)}{MODE_NAMES[s.mode]}，{format_time(s.arrival)}抵達{s.destination}")
+    return "，".join(parts)
 
-def generate_gpt_suggestion(schedule_id):
-    try:
-        api_key = os.environ.get('OPENAI_API_KEY')
-        if not api_key:
-            return "請設定 OPENAI_API_KEY"
-        
-        # 班次資訊包含轉乘時間細節
-        schedules_info = {
-            1: {
-                "detail": "高鐵07:21出發，08:04抵達台北，轉乘08:40台鐵，11:05抵達花蓮",
-                "transfer_time": 36,  # 分鐘
-                "transfer_type": "medium"
-            },
-            2: {
-                "detail": "高鐵07:48出發，08:34抵達台北，轉乘08:52台鐵，11:51抵達花蓮",
-                "transfer_time": 18,  # 分鐘
-                "transfer_type": "tight"
-            },
-            3: {
-                "detail": "台鐵自強號07:24直達，12:44抵達花蓮",
-                "transfer_time": 0,
-                "transfer_type": "direct"
-            },
-            4: {
-                "detail": "台鐵自強3000號07:49直達，12:11抵達花蓮",
-                "transfer_time": 0,
-                "transfer_type": "direct"
-            },
-            5: {
-                "detail": "高鐵07:25出發，08:29抵達台北，轉乘09:26台鐵，11:46抵達花蓮",
-                "transfer_time": 57,  # 分鐘
-                "transfer_type": "long"
-            },
-            6: {
-                "detail": "高鐵07:40出發，08:39抵達台北，轉乘09:45台鐵，12:11抵達花蓮",
-                "transfer_time": 66,  # 分鐘
-                "transfer_type": "long"
-            }
-        }
-        
-        info = schedules_info.get(schedule_id, {})
-        detail = info.get("detail", "")
-        transfer_time = info.get("transfer_time", 0)
-        transfer_type = info.get("transfer_type", "")
-        
-        # 根據轉乘時間類型生成不同的 prompt
-        url = "https://api.openai.com/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        # 基本資訊
-        base_info = f"""行程：從台中到花蓮
+def time_of_day(minutes):
+    hour = minutes // 60 % 24
+    if hour < 5:
+        return f"凌晨{hour}點多"
+    if hour < 11:
+        return f"早上{hour}點多"
+    if hour < 13:
+        return f"中午{hour}點多"
+    if hour < 18:
+        return f"下午{hour - 12}點多"
+    return f"晚上{hour - 12}點多"
+
+def transfer_context(schedule, travel_date):
+    # 回傳 (即時狀態, 轉乘類型, 最短轉乘時間, 轉乘站)；當天有誤點時以實際轉乘時間為準
+    transfer_type_ = schedule.transfer_type
+    transfers = schedule.transfers
+    status = live_status(schedule, travel_date)
+    if status is not None:
+        transfer_type_ = status.transfer_type if status.feasible else "missed"
+        transfers = status.transfers
+    if not transfers:
+        return status, transfer_type_, 0, ""
+    binding = min(transfers, key=lambda t: t.slack)
+    return status, transfer_type_, binding.slack, router.timetable.stations[binding.station].name
+
+# 各月份的穿著提醒
+SEASON_TIPS = {
+    12: "天氣偏冷，建議穿保暖外套", 1: "天氣偏冷，建議穿保暖外套", 2: "天氣偏冷，建議穿保暖外套",
+    3: "早晚溫差大，建議洋蔥式穿搭", 4: "早晚溫差大，建議洋蔥式穿搭",
+    5: "梅雨季節，記得攜帶雨具", 6: "梅雨季節，記得攜帶雨具",
+    7: "天氣炎熱，注意防曬並攜帶雨具以防午後雷陣雨", 8: "天氣炎熱，注意防曬並攜帶雨具以防午後雷陣雨",
+    9: "天氣仍熱，留意颱風動態", 10: "早晚微涼，建議帶件薄外套", 11: "早晚微涼，建議帶件薄外套",
+}
+
+def local_suggestion(schedule, travel_date):
+    # 與 build_suggestion_request 相同的轉乘分類規則，直接組出建議文字，不需呼叫模型
+    status, transfer_type_, transfer_time, transfer_station = transfer_context(schedule, travel_date)
+    destination = schedule.destination
+    lines = [f"{travel_date.month}月的{destination}{SEASON_TIPS[travel_date.month]}。"]
+    if status is not None:
+        lines.append(f"即時狀況：{live_detail(schedule, status)}。")
+    
+    if transfer_type_ == "missed":
+        lines.append(f"原定在{transfer_station}站的轉乘已經來不及，抵達後請先向站務人員確認下一班可搭乘的列車，"
+                     "並保留車票以便改票或退費。")
+    elif transfer_type_ == "direct":
+        duration = format_duration(schedule.arrival - schedule.departure)
+        lines.append(f"直達班次無需轉乘，車程約{duration}，記得攜帶水或點心。")
+        lines.append(f"抵達{schedule.segments[-1].destination}後可先在車站附近走走，再前往{destination}的景點。")
+    elif transfer_type_ == "tight":
+        lines.append(f"轉乘時間只有{transfer_time}分鐘，建議在車上或出發前先吃點東西，"
+                     f"抵達{transfer_station}站後直接前往下一班車的月台。")
+        lines.append("途中可以稍微休息一下。")
+    elif transfer_type_ == "medium":
+        lines.append(f"轉乘時間約{transfer_time}分鐘，可以在{transfer_station}站內快速買點東西吃或逛逛商店，"
+                     "記得預留10-15分鐘前往月台。")
+    else:
+        lines.append(f"轉乘時間充裕（約{transfer_time}分鐘），可以在{transfer_station}站周邊悠閒地用餐或逛逛商店，"
+                     "提前10-20分鐘前往月台即可。")
+    return "\n".join(lines)
+
+def build_suggestion_request(schedule, travel_date):
+    # 班次資訊包含轉乘時間細節
+    origin = schedule.origin
+    destination = schedule.destination
+    detail = suggestion_detail(schedule)
+    status, transfer_type_, transfer_time, transfer_station = transfer_context(schedule, travel_date)
+    month = travel_date.month
+    
+    # 基本資訊
+    base_info = f"""行程：從{origin}到{destination}
 班次：{detail}
-日期：2026年1月13日（週二）
-出發時間：早上7點多
+日期：{travel_date.year}年{month}月{travel_date.day}日（週{WEEKDAYS[travel_date.weekday()]}）
+出發時間：{time_of_day(schedule.departure)}
 
-天氣狀況：1月的花蓮正值東北季風盛行期，天氣偏涼，建議穿著保暖衣物。"""
-        
-        # 根據轉乘類型調整建議重點
-        if transfer_type == "direct":
-            prompt = f"""{base_info}
+天氣狀況：請依{month}月{destination}的季節天氣提醒穿著。"""
+    if status is not None:
+        base_info += f"\n即時狀況：{live_detail(schedule, status)}"
+    
+    # 根據轉乘類型調整建議重點
+    if transfer_type_ == "missed":
+        prompt = f"""{base_info}
+
+因前一班車誤點，原定在{transfer_station}站的轉乘已經來不及。請用繁體中文提供簡潔建議（100字內）：
+1. 抵達{transfer_station}站後先向站務人員確認下一班可搭乘的列車
+2. 提醒保留車票與誤點證明，以便改票或退費
+3. 依{month}月{destination}天氣的穿著建議"""
+    
+    elif transfer_type_ == "direct":
+        prompt = f"""{base_info}
 
 這是直達班次，無需轉乘。請用繁體中文提供簡潔建議（100字內）：
-1. 早上出發的穿著建議（1月花蓮天氣涼）
+1. 依{month}月{destination}天氣的穿著建議
 2. 車程較長，提醒攜帶水或點心
-3. 簡單的花蓮景點提醒"""
-        
-        elif transfer_type == "tight":
-            # 18分鐘轉乘
-            prompt = f"""{base_info}
+3. 簡單的{destination}景點提醒"""
+    
+    elif transfer_type_ == "tight":
+        # 30分鐘以內轉乘
+        prompt = f"""{base_info}
 轉乘時間：約{transfer_time}分鐘
 
 這是緊湊的轉乘時間。請用繁體中文提供簡潔建議（100字內）：
-1. 1月花蓮東北季風強，天氣涼，建議穿著保暖
-2. 轉乘時間緊迫（{transfer_time}分鐘），建議在高鐵上或高鐵出發前吃點東西，抵達台北車站後直接前往台鐵月台
-3. 早上出發，可以稍微休息一下"""
-        
-        elif transfer_type == "medium":
-            # 30-40分鐘轉乘
-            prompt = f"""{base_info}
+1. 依{month}月{destination}天氣的穿著建議
+2. 轉乘時間緊迫（{transfer_time}分鐘），建議在車上或出發前吃點東西，抵達{transfer_station}站後直接前往下一班車的月台
+3. 提醒途中可以稍微休息一下"""
+    
+    elif transfer_type_ == "medium":
+        # 30-45分鐘轉乘
+        prompt = f"""{base_info}
 轉乘時間：約{transfer_time}分鐘
 
 轉乘時間適中。請用繁體中文提供簡潔建議（100字內）：
-1. 1月花蓮東北季風強，天氣涼，建議穿著保暖
-2. 轉乘時間約{transfer_time}分鐘，可以在台北車站地下街快速買點東西吃或逛逛商店，台鐵月台在地下層很方便
+1. 依{month}月{destination}天氣的穿著建議
+2. 轉乘時間約{transfer_time}分鐘，可以在{transfer_station}站內快速買點東西吃或逛逛商店
 3. 提醒：不要花太多時間，預留10-15分鐘前往月台"""
-        
-        else:  # long (57-66分鐘)
-            prompt = f"""{base_info}
+    
+    else:  # long (45分鐘以上)
+        prompt = f"""{base_info}
 轉乘時間：約{transfer_time}分鐘
 
 轉乘時間充裕。請用繁體中文提供簡潔建議（100字內）：
-1. 1月花蓮東北季風強，天氣涼，建議穿著保暖
-2. 轉乘時間充裕（約{transfer_time}分鐘），可以在台北車站地下街悠閒地吃個早餐或逛逛商店。高鐵和台鐵月台都在地下層，在地下街活動最方便，不用跑到地面樓層
-3. 建議提前10-20分鐘前往台鐵月台即可"""
-        
-        request_data = {
-            "model": "gpt-4o-mini",
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 300
-        }
-        
-        response = requests.post(url, headers=headers, json=request_data, timeout=30)
-        
-        if response.status_code == 200:
-            return response.json()['choices'][0]['message']['content']
-        else:
-            return "GPT建議暫時無法使用"
-            
+1. 依{month}月{destination}天氣的穿著建議
+2. 轉乘時間充裕（約{transfer_time}分鐘），可以在{transfer_station}站周邊悠閒地用餐或逛逛商店
+3. 建議提前10-20分鐘前往月台即可"""
+    
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": 300
+    }
+
+def openai_headers(api_key):
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+
+def record_usage(usage):
+    if usage:
+        llm_tokens.inc("prompt", amount=usage.get("prompt_tokens", 0))
+        llm_tokens.inc("completion", amount=usage.get("completion_tokens", 0))
+
+def lookup_suggestion(cache_key):
+    cached, stale = suggestion_cache.lookup(cache_key)
+    cache_requests.inc("miss" if cached is None else "stale" if stale else "hit")
+    return cached, stale
+
+def fetch_suggestion(cache_key, request_data, api_key, priority=INTERACTIVE):
+    # 同一 prompt 同時只送出一個上游請求，其餘請求等待同一結果
+    def fetch():
+        ticket = rate_limiter.admit(request_data, priority)
+        response = openai_client.post("/chat/completions", request_data, headers=openai_headers(api_key))
+        body = response.json()
+        record_usage(body.get('usage'))
+        ticket.settle(body.get('usage'))
+        suggestion = body['choices'][0]['message']['content']
+        suggestion_cache.set(cache_key, suggestion)
+        return suggestion
+    
+    return suggestion_flights.do(cache_key, fetch)
+
+def stream_suggestion(cache_key, request_data, api_key, priority=INTERACTIVE):
+    # 逐段產生模型的建議文字，完成後寫入快取；失敗時丟出 UpstreamError（含 Overloaded）。
+    # 已有相同 prompt 在產生中時等待其完整結果，不另開上游串流
+    flight = suggestion_flights.begin(cache_key)
+    if not flight.leader:
+        result = flight.wait()
+        if result is not None:
+            yield result
+            return
+    
+    parts = []
+    try:
+        # include_usage 讓最後一個事件附上 token 用量
+        ticket = rate_limiter.admit(request_data, priority)
+        stream_request = dict(request_data, stream=True, stream_options={"include_usage": True})
+        events = openai_client.stream("/chat/completions", stream_request, headers=openai_headers(api_key))
+        for event in events:
+            record_usage(event.get('usage'))
+            ticket.settle(event.get('usage'))
+            choices = event.get('choices') or [{}]
+            delta = choices[0].get('delta', {}).get('content')
+            if delta:
+                parts.append(delta)
+                yield delta
     except Exception as e:
-        return f"AI建議載入中..."
+        flight.fail(e)
+        raise
+    except BaseException as e:
+        # 例如 greenlet 被終止，讓等待者不必等到逾時
+        flight.fail(UpstreamError(f"stream aborted: {e!r}"))
+        raise
+    
+    suggestion = "".join(parts)
+    if not suggestion:
+        error = UpstreamError("empty completion")
+        flight.fail(error)
+        raise error
+    suggestion_cache.set(cache_key, suggestion)
+    flight.finish(suggestion)
+
+def warmup_jobs():
+    # 熱門路線在各出發時段的所有方案，逐日產生 prompt
+    if not os.environ.get('OPENAI_API_KEY'):
+        return
+    popular = load_catalog()
+    today = datetime.now().date()
+    seen = set()
+    for day in range(popular.get("days", 1)):
+        travel_date = today + timedelta(days=day)
+        for origin, destination in popular.get("routes", []):
+            for departure in popular.get("departures", []):
+                for route_type in ROUTE_TYPES:
+                    for schedule in catalog.search(origin, destination, parse_time(departure), route_type):
+                        request_data = build_suggestion_request(schedule, travel_date)
+                        cache_key = make_key(request_data)
+                        if cache_key not in seen:
+                            seen.add(cache_key)
+                            yield cache_key, request_data
+
+def warmup_fetch(cache_key, request_data):
+    # 配額不足時略過，下一輪再產生
+    try:
+        fetch_suggestion(cache_key, request_data, os.environ.get('OPENAI_API_KEY'), BACKGROUND)
+    except Overloaded:
+        pass
+
+def run_suggestion_job(job, progress, priority=INTERACTIVE):
+    # 以串流向模型取得建議，逐段回報目前的文字，頁面可在產生過程中顯示
+    cache_key, request_data = job
+    parts = []
+    for delta in stream_suggestion(cache_key, request_data, os.environ.get('OPENAI_API_KEY'), priority):
+        parts.append(delta)
+        progress("".join(parts))
+    return "".join(parts)
+
+def run_prefetch_job(job, progress):
+    # 預取只使用保留給背景工作的配額，不與使用者的請求競爭
+    return run_suggestion_job(job, progress, BACKGROUND)
+
+def prefetch_suggestion(schedule_id, travel_date):
+    # 回傳預取工作代碼；已有快取、未設定 API key 或預取佇列已滿時不預取
+    schedule = catalog.get(schedule_id)
+    if schedule is None or not os.environ.get('OPENAI_API_KEY'):
+        return None
+    request_data = build_suggestion_request(schedule, travel_date)
+    cache_key = make_key(request_data)
+    if lookup_suggestion(cache_key)[0] is not None:
+        return None
+    try:
+        return prefetch_jobs.submit(cache_key, (cache_key, request_data))
+    except QueueFull:
+        return None
+
+def generate_gpt_suggestion(schedule_id, travel_date=None, prefetch_job=None):
+    # 回傳 (建議, 來源, 工作代碼)；快取中已有模型的建議時直接使用，
+    # 否則立即回傳本地規則產生的建議，並沿用仍在進行的預取工作或排入背景工作向模型取得
+    schedule = catalog.get(schedule_id)
+    if schedule is None:
+        return None, None, None
+    travel_date = travel_date or datetime.now().date()
+    job_id = None
+    try:
+        if os.environ.get('OPENAI_API_KEY'):
+            request_data = build_suggestion_request(schedule, travel_date)
+            cache_key = make_key(request_data)
+            cached, stale = lookup_suggestion(cache_key)
+            if cached is not None:
+                if stale:
+                    suggestion_warmer.refresh(cache_key, request_data)
+                return cached, "llm", None
+            prefetched = prefetch_jobs.get(prefetch_job) if prefetch_job else None
+            if prefetched is not None and prefetched["status"] in ("queued", "running"):
+                job_id = prefetch_job
+            else:
+                job_id = suggestion_jobs.submit(cache_key, (cache_key, request_data))
+    except QueueFull:
+        app.logger.warning("suggestion job queue is full")
+    except Exception:
+        app.logger.exception("generate_gpt_suggestion failed for %s", schedule_id)
+    return local_suggestion(schedule, travel_date), "local", job_id
+
+# 背景預先產生熱門路線的建議（需在函式定義之後建立）
+suggestion_warmer = SuggestionWarmer(suggestion_cache, warmup_jobs, warmup_fetch)
+suggestion_warmer.start(WARMUP_INTERVAL)
+# 模型建議的背景工作；web worker 只負責排入與查詢
+suggestion_jobs = JobQueue(run_suggestion_job)
+# 預取工作另用較少的執行緒，使用者切換方案時可取消
+prefetch_jobs = JobQueue(run_prefetch_job, name="prefetch", workers=PREFETCH_WORKERS,
+                         max_depth=PREFETCH_QUEUE_DEPTH)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
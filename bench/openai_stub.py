@@ -0,0 +1,140 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 模擬 chat completions 回應的文字，串流時逐段送出
+REPLY = ('依十月天氣建議穿著薄外套，早晚溫差較大。', '車程較長，記得帶水與點心。', '抵達後可先到車站附近走走，',
+         '再前往預定的景點。', '轉乘時請留意月台資訊。')
+
+
+class StubState:
+    def __init__(self, latency, jitter, chunk_interval, error_rate, rate_limit_rate, seed):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_interval = chunk_interval
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'streams': 0, 'errors': 0, 'rate_limited': 0}
+
+    def draw(self):
+        with self.lock:
+            self.stats['requests'] += 1
+            roll = self.random.random()
+            delay = max(0.0, self.random.gauss(self.latency, self.jitter))
+        if roll < self.error_rate:
+            outcome = 'error'
+        elif roll < self.error_rate + self.rate_limit_rate:
+            outcome = 'rate_limited'
+        else:
+            outcome = 'ok'
+        return outcome, delay
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_chunk(self, data):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path == '/stats':
+                with state.lock:
+                    self.send_json(200, dict(state.stats))
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if not self.path.endswith('/chat/completions'):
+                self.send_json(404, {'error': 'not found'})
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            outcome, delay = state.draw()
+            time.sleep(delay)
+
+            if outcome == 'error':
+                state.count('errors')
+                self.send_json(503, {'error': {'message': 'stub overloaded'}})
+                return
+            if outcome == 'rate_limited':
+                state.count('rate_limited')
+                self.send_json(429, {'error': {'message': 'stub rate limit'}}, {'Retry-After': '1'})
+                return
+
+            prompt_tokens = len(json.dumps(payload.get('messages', []), ensure_ascii=False)) // 2
+            completion_tokens = sum(len(part) for part in REPLY)
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                     'total_tokens': prompt_tokens + completion_tokens}
+            if not payload.get('stream'):
+                self.send_json(200, {
+                    'id': 'chatcmpl-stub',
+                    'object': 'chat.completion',
+                    'model': payload.get('model'),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(REPLY)},
+                                 'finish_reason': 'stop'}],
+                    'usage': usage,
+                })
+                return
+
+            state.count('streams')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for part in REPLY:
+                event = {'choices': [{'index': 0, 'delta': {'content': part}}]}
+                self.send_chunk(f'data: {json.dumps(event, ensure_ascii=False)}\n\n'.encode('utf-8'))
+                time.sleep(state.chunk_interval)
+            if (payload.get('stream_options') or {}).get('include_usage'):
+                self.send_chunk(f'data: {json.dumps({"choices": [], "usage": usage})}\n\n'.encode('utf-8'))
+            self.send_chunk(b'data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI chat completions API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=0.8, help='mean seconds before the first byte')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--chunk-interval', type=float, default=0.05, help='seconds between streamed chunks')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of 429 responses')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    state = StubState(args.latency, args.jitter, args.chunk_interval, args.error_rate, args.rate_limit_rate,
+                      args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
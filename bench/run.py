@@ -0,0 +1,357 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import requests
+
+# 離線壓力測試：以本機 OpenAI stub 取代上游，用 gunicorn 啟動 app 後依情境施壓
+#   python bench/run.py                      執行全部情境，結果寫到 bench/results/
+#   python bench/run.py -s home-sync         只執行指定情境
+#   python bench/run.py --save-baseline      將結果存成 bench/baseline.json
+#   python bench/run.py --compare            與 baseline 比較，有退步時以非 0 結束
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+SCENARIOS_PATH = os.path.join(BENCH_DIR, 'scenarios.json')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# 開始計時前的暖身秒數，不計入結果
+WARMUP = 2
+# 與 baseline 相比可容忍的退步比例
+TOLERANCE = 0.2
+# 固定的旅行日期，讓每次執行產生相同的 prompt
+BASE_DATE = date(2030, 1, 7)
+ROUTE_TYPES = ('fastest', 'cheapest', 'recommended')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'{url} did not become ready')
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    k = min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def worker_rss(master_pid):
+    # 各 gunicorn worker 的常駐記憶體（MB），由 /proc 讀取
+    sizes = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            if ppid != master_pid:
+                continue
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        sizes.append(round(int(line.split()[1]) / 1024, 1))
+        except (OSError, ValueError, IndexError):
+            continue
+    return sorted(sizes)
+
+
+def worker_class_available(worker_class):
+    module = {'gevent': 'gevent', 'eventlet': 'eventlet'}.get(worker_class)
+    if module is None:
+        return True
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+class LoadGenerator:
+    # 固定並行數的封閉式負載：每個執行緒送出請求、等回應後再送下一個
+    def __init__(self, base_url, scenario, config, schedule_ids):
+        self.base_url = base_url
+        self.scenario = scenario
+        self.config = config
+        self.schedule_ids = schedule_ids
+        self.kinds = list(scenario['mix'])
+        self.weights = [scenario['mix'][k] for k in self.kinds]
+        self.dates = [BASE_DATE + timedelta(days=i) for i in range(scenario.get('suggestion_dates', 1))]
+        self.lock = threading.Lock()
+        self.latencies = {kind: [] for kind in self.kinds}
+        self.errors = {kind: 0 for kind in self.kinds}
+
+    def request(self, session, rng, kind):
+        # 回傳是否成功
+        if kind == 'home':
+            return session.get(self.base_url + '/', timeout=60).status_code < 400
+        if kind == 'schedules':
+            origin, destination = rng.choice(self.config['routes'])
+            params = {
+                'type': rng.choice(ROUTE_TYPES),
+                'origin': origin,
+                'destination': destination,
+                'departure_time': f'{BASE_DATE.isoformat()}T{rng.choice(self.config["departures"])}',
+            }
+            return session.get(self.base_url + '/api/get_schedules', params=params, timeout=60).status_code < 400
+        departure_time = f'{rng.choice(self.dates).isoformat()}T07:00'
+        schedule_id = rng.choice(self.schedule_ids)
+        return self.suggestion(session, schedule_id, departure_time, stream=kind == 'stream')
+
+    def suggestion(self, session, schedule_id, departure_time, stream=False):
+        # 模型的建議在背景工作中產生（202），與頁面相同以 SSE 串流或 long-poll 等到完成，計入完整的等待時間
+        response = session.post(self.base_url + '/api/get_suggestion', timeout=60,
+                                json={'schedule_id': schedule_id, 'departure_time': departure_time})
+        if response.status_code >= 400:
+            return False
+        job = response.json()
+        if stream and job.get('job_id'):
+            job = self.follow(session, job['job_id']) or job
+        wait = self.scenario.get('suggestion_wait', 20)
+        while job.get('job_id') and job.get('status') in ('queued', 'running'):
+            response = session.get(f"{self.base_url}/api/get_suggestion/jobs/{job['job_id']}",
+                                   params={'wait': wait}, timeout=wait + 30)
+            if response.status_code >= 400:
+                return False
+            job = response.json()
+        return job.get('status', 'done') == 'done'
+
+    def follow(self, session, job_id):
+        # 讀到 done 事件為止，回傳其中的工作狀態；串流中斷時回傳 None
+        response = session.get(f'{self.base_url}/api/get_suggestion/jobs/{job_id}/stream', stream=True, timeout=60)
+        if response.status_code >= 400:
+            return None
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith('event:'):
+                event = line[6:].strip()
+            elif line.startswith('data:') and event == 'done':
+                response.close()
+                return json.loads(line[5:])
+        return None
+
+    def worker(self, n, started, deadline):
+        rng = random.Random(n)
+        session = requests.Session()
+        while time.time() < deadline:
+            kind = rng.choices(self.kinds, self.weights)[0]
+            begin = time.perf_counter()
+            try:
+                ok = self.request(session, rng, kind)
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - begin
+            if time.time() - elapsed < started:
+                continue
+            with self.lock:
+                self.latencies[kind].append(elapsed)
+                if not ok:
+                    self.errors[kind] += 1
+
+    def run(self):
+        started = time.time() + WARMUP
+        deadline = started + self.scenario['duration']
+        threads = [threading.Thread(target=self.worker, args=(n, started, deadline))
+                   for n in range(self.scenario['concurrency'])]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        def summary(values, errors):
+            values = sorted(values)
+            return {
+                'count': len(values),
+                'errors': errors,
+                'p50_ms': round(percentile(values, 50) * 1000, 2) if values else None,
+                'p95_ms': round(percentile(values, 95) * 1000, 2) if values else None,
+                'p99_ms': round(percentile(values, 99) * 1000, 2) if values else None,
+            }
+
+        everything = [v for values in self.latencies.values() for v in values]
+        return {
+            'throughput_rps': round(len(everything) / self.scenario['duration'], 2),
+            'overall': summary(everything, sum(self.errors.values())),
+            'endpoints': {kind: summary(self.latencies[kind], self.errors[kind]) for kind in self.kinds},
+        }
+
+
+def start_stub(settings):
+    port = free_port()
+    args = [sys.executable, os.path.join(BENCH_DIR, 'openai_stub.py'), '--port', str(port)]
+    for name, value in settings.items():
+        args += ['--' + name.replace('_', '-'), str(value)]
+    process = subprocess.Popen(args)
+    wait_ready(f'http://127.0.0.1:{port}/stats')
+    return process, port
+
+
+def start_app(scenario, env, port):
+    args = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+            '--workers', str(scenario.get('workers', 1)), '--worker-class', scenario['worker_class'],
+            '--log-level', 'warning']
+    if scenario['worker_class'] == 'gthread':
+        args += ['--threads', str(scenario.get('threads', 4))]
+    if scenario['worker_class'] in ('gevent', 'eventlet'):
+        args += ['--worker-connections', str(scenario.get('worker_connections', 200))]
+    process = subprocess.Popen(args, cwd=ROOT, env=env)
+    wait_ready(f'http://127.0.0.1:{port}/')
+    return process
+
+
+def collect_schedule_ids(base_url, config):
+    ids = []
+    for origin, destination in config['routes']:
+        for departure in config['departures']:
+            for route_type in ROUTE_TYPES:
+                response = requests.get(base_url + '/api/get_schedules', timeout=30, params={
+                    'type': route_type, 'origin': origin, 'destination': destination,
+                    'departure_time': f'{BASE_DATE.isoformat()}T{departure}',
+                })
+                ids += [s['id'] for s in response.json()['schedules'] if s['id'] not in ids]
+    return ids
+
+
+def run_scenario(scenario, config, workdir):
+    if not worker_class_available(scenario['worker_class']):
+        return {'skipped': f'worker class {scenario["worker_class"]} is not installed'}
+
+    # 每個情境使用全新的快取與資料庫，結果不受前一個情境影響
+    scenario_dir = os.path.join(workdir, scenario['name'])
+    os.makedirs(scenario_dir)
+    stub, stub_port = start_stub(scenario.get('stub', {}))
+    app_port = free_port()
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY='bench',
+        OPENAI_BASE_URL=f'http://127.0.0.1:{stub_port}',
+        SUGGESTION_WARMUP_INTERVAL='0',
+        SUGGESTION_CACHE_PATH=os.path.join(scenario_dir, 'suggestions.sqlite3'),
+        TRIPS_PATH=os.path.join(scenario_dir, 'trips.sqlite3'),
+        RATELIMIT_PATH=os.path.join(scenario_dir, 'ratelimit.sqlite3'),
+        SUGGESTION_JOBS_PATH=os.path.join(scenario_dir, 'jobs.sqlite3'),
+        METRICS_DIR=os.path.join(scenario_dir, 'metrics'),
+        ESTIMATES_PATH=os.path.join(workdir, 'estimates.bin'),
+        TIMETABLE_BIN_PATH=os.path.join(workdir, 'timetable.bin'),
+    )
+    app = None
+    try:
+        app = start_app(scenario, env, app_port)
+        base_url = f'http://127.0.0.1:{app_port}'
+        schedule_ids = collect_schedule_ids(base_url, config)
+        result = LoadGenerator(base_url, scenario, config, schedule_ids).run()
+        result['rss_mb_per_worker'] = worker_rss(app.pid)
+        result['upstream'] = requests.get(f'http://127.0.0.1:{stub_port}/stats', timeout=5).json()
+        result['config'] = {k: scenario[k] for k in ('worker_class', 'workers', 'concurrency', 'duration')}
+        return result
+    finally:
+        for process in (app, stub):
+            if process is not None:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # 吞吐量下降或 p95 延遲上升超過容忍比例即視為退步
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous or 'skipped' in current or 'skipped' in previous:
+            continue
+        if current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append(f'{name}: throughput {previous["throughput_rps"]} -> {current["throughput_rps"]} rps')
+        before, after = previous['overall']['p95_ms'], current['overall']['p95_ms']
+        if before and after and after > before * (1 + tolerance) and after - before > 5:
+            regressions.append(f'{name}: p95 {before} -> {after} ms')
+        before_errors = previous['overall']['errors'] / max(1, previous['overall']['count'])
+        after_errors = current['overall']['errors'] / max(1, current['overall']['count'])
+        if after_errors > before_errors + 0.05:
+            regressions.append(f'{name}: error rate {before_errors:.1%} -> {after_errors:.1%}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load-test benchmark for the travel planner')
+    parser.add_argument('-s', '--scenario', action='append', help='run only the named scenario(s)')
+    parser.add_argument('--duration', type=float, help='override every scenario duration (seconds)')
+    parser.add_argument('--save-baseline', action='store_true', help=f'write results to {BASELINE_PATH}')
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH, help='compare against a baseline file')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    with open(SCENARIOS_PATH, encoding='utf-8') as f:
+        config = json.load(f)
+    scenarios = [s for s in config['scenarios'] if not args.scenario or s['name'] in args.scenario]
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'scenarios': {},
+    }
+    workdir = tempfile.mkdtemp(prefix='travel-bench-')
+    try:
+        # 預先編譯時刻表並產生預估矩陣，避免每個 worker 啟動時各自重建
+        build_env = dict(os.environ, ESTIMATES_PATH=os.path.join(workdir, 'estimates.bin'),
+                         TIMETABLE_BIN_PATH=os.path.join(workdir, 'timetable.bin'))
+        subprocess.run([sys.executable, 'timetable_bin.py'], cwd=ROOT, check=True, env=build_env)
+        subprocess.run([sys.executable, 'estimates.py'], cwd=ROOT, check=True, env=build_env)
+        for scenario in scenarios:
+            if args.duration:
+                scenario = dict(scenario, duration=args.duration)
+            print(f'running {scenario["name"]} ...', flush=True)
+            result = results['scenarios'][scenario['name']] = run_scenario(scenario, config, workdir)
+            if 'skipped' in result:
+                print(f'  skipped: {result["skipped"]}')
+            else:
+                overall = result['overall']
+                print(f'  {result["throughput_rps"]} rps, p50 {overall["p50_ms"]} ms, p95 {overall["p95_ms"]} ms, '
+                      f'p99 {overall["p99_ms"]} ms, errors {overall["errors"]}, rss {result["rss_mb_per_worker"]} MB')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    for target in [path] + ([BASELINE_PATH] if args.save_baseline else []):
+        with open(target, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f'results written to {path}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            sys.exit(1)
+        print('no regressions against', args.compare)
+
+
+if __name__ == '__main__':
+    main()
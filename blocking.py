@@ -0,0 +1,10 @@
+import sys
+
+
+def run_blocking(fn, *args):
+    # gevent worker 中 SQLite 寫入等待鎖（busy_timeout 最長 5 秒）或長時間計算會卡住整個 hub，
+    # 改在原生執行緒池執行；fn 不可沿用呼叫端執行緒的 SQLite 連線，也不應等待 gevent 的 Event
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return sys.modules['gevent'].get_hub().threadpool.apply(fn, args)
+    return fn(*args)
@@ -0,0 +1,254 @@
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from delays import DelayBoard, live_status
+from ranking import Ranker
+from routing import INF, VARIANTS, format_time, transfer_type
+
+MODE_NAMES = {'HSR': '高鐵', 'TRA': '台鐵'}
+
+# 查詢時只考慮出發時間起算此時段內的班次（分鐘）
+SEARCH_WINDOW = 180
+# 每種搜尋條件最多取幾個候選行程
+MAX_CANDIDATES = 64
+# 批次規劃單次請求的查詢數上限
+BATCH_LIMIT = int(os.environ.get('PLAN_BATCH_LIMIT', 10000))
+# 記憶的排名結果每種方案保留幾個行程；查詢的數量不超過此值時由記憶結果截取
+PLAN_LIMIT = 5
+
+Segment = namedtuple('Segment', 'mode name origin destination departure arrival')
+Schedule = namedtuple(
+    'Schedule',
+    'id legs segments origin destination departure arrival fare fares transfers transfer_type modes payload',
+)
+RouteIndex = namedtuple('RouteIndex', 'departures schedules')
+# 一個起訖對的查詢區段：bounds 為候選範圍改變的出發分鐘，plans 為各區段記憶的排名結果
+RouteSegments = namedtuple('RouteSegments', 'bounds indexes plans')
+# 時刻表中沒有的縣市一律查無行程，不建立索引
+EMPTY_ROUTE = RouteIndex(array('i'), ())
+
+
+def format_duration(minutes):
+    return f'{minutes // 60}小時{minutes % 60}分'
+
+
+def route_label(schedule):
+    # 例如：高鐵+台鐵、台鐵直達、台鐵轉乘
+    names = []
+    for segment in schedule.segments:
+        if MODE_NAMES[segment.mode] not in names:
+            names.append(MODE_NAMES[segment.mode])
+    if not schedule.transfers:
+        return names[0] + '直達'
+    return '+'.join(names) if len(names) > 1 else names[0] + '轉乘'
+
+
+def make_schedule(timetable, journey, fares, category_names):
+    # 將行程整理成不可變的班次紀錄，顯示用字串只在建立時產生一次；fares 為 {旅客類別: 票價}
+    segments = []
+    for leg in journey.legs:
+        trip = timetable.trips[leg.trip]
+        board, alight = trip.stops[leg.board], trip.stops[leg.alight]
+        segments.append(Segment(
+            trip.mode,
+            MODE_NAMES[trip.mode] + (trip.cls if trip.mode == 'TRA' else '') + trip.no,
+            timetable.stations[board.station].name,
+            timetable.stations[alight.station].name,
+            board.dep,
+            alight.arr,
+        ))
+    first, last = journey.legs[0], journey.legs[-1]
+    origin = timetable.stations[timetable.trips[first.trip].stops[first.board].station].county
+    destination = timetable.stations[timetable.trips[last.trip].stops[last.alight].station].county
+
+    title = ' + '.join(f'{s.name} ({format_time(s.departure)}→{format_time(s.arrival)})' for s in segments)
+    if not journey.transfers:
+        detail = f'{segments[0].origin}直達{segments[-1].destination}，無需轉乘'
+    else:
+        slack = '、'.join(f'{timetable.stations[t.station].name}{t.slack}分鐘' for t in journey.transfers)
+        detail = (f'{segments[0].origin}{format_time(journey.departure)}出發 → '
+                  f'{segments[-1].destination}{format_time(journey.arrival)}抵達（轉乘時間{slack}）')
+    kind = transfer_type(journey)
+    payload = {
+        'id': journey.id,
+        'title': title,
+        'detail': detail,
+        'duration': format_duration(journey.arrival - journey.departure),
+        'cost': f'{journey.fare:,}',
+        'transfer_type': kind,
+        'fares': [{'category': k, 'name': category_names[k], 'cost': f'{v:,}'} for k, v in fares.items()],
+    }
+    return Schedule(
+        journey.id, journey.legs, tuple(segments), origin, destination,
+        journey.departure, journey.arrival, journey.fare, fares, journey.transfers, kind,
+        frozenset(s.mode for s in segments), payload,
+    )
+
+
+class ScheduleCatalog:
+    # 由時刻表推導出的班次目錄：依代碼、以及 (起點, 終點, 方案) 與出發時間建立索引
+    def __init__(self, router, ranker=None):
+        self.router = router
+        self.ranker = ranker or Ranker()
+        self.timetable = router.timetable
+        self._by_id = {}
+        self._routes = {}
+        self._segments = {}
+        self._lock = threading.Lock()
+        # 即時誤點：各車次經過的班次（trip index → {班次代碼}）與受影響班次的即時狀態
+        self.delays = DelayBoard(self.timetable)
+        self._by_trip = {}
+        self._live = {}
+        self._delay_lock = threading.Lock()
+
+    def _intern_many(self, journeys):
+        # 整批計算各旅客類別的票價後建立班次紀錄
+        fares = self.router.fares
+        totals = fares.price_many(journeys)
+        schedules = []
+        for i, journey in enumerate(journeys):
+            schedule = self._by_id.get(journey.id)
+            if schedule is None:
+                by_category = {category: column[i] for category, column in totals.items()}
+                schedule = make_schedule(self.timetable, journey, by_category, fares.category_names)
+                with self._delay_lock:
+                    if journey.id not in self._by_id:
+                        for leg in journey.legs:
+                            self._by_trip.setdefault(leg.trip, set()).add(journey.id)
+                        status = live_status(self.timetable, self.delays, journey.legs)
+                        if status is not None:
+                            self._live[journey.id] = status
+                    schedule = self._by_id.setdefault(journey.id, schedule)
+            schedules.append(schedule)
+        return schedules
+
+    def apply_delays(self, updates):
+        # 套用誤點更新，只重算經過變動車次的班次；回傳受影響的班次數
+        with self._delay_lock:
+            changed = self.delays.update(updates)
+            affected = set()
+            for trip in changed:
+                affected.update(self._by_trip.get(trip, ()))
+            for schedule_id in affected:
+                status = live_status(self.timetable, self.delays, self._by_id[schedule_id].legs)
+                if status is None:
+                    self._live.pop(schedule_id, None)
+                else:
+                    self._live[schedule_id] = status
+        return len(affected)
+
+    def live(self, schedule):
+        # 班次的即時狀態，沒有誤點時為 None
+        return self._live.get(schedule.id)
+
+    def get(self, schedule_id):
+        schedule = self._by_id.get(schedule_id)
+        if schedule is None:
+            journey = self.router.journey(schedule_id)
+            if journey is None:
+                return None
+            schedule = self._intern_many([journey])[0]
+        return schedule
+
+    def known(self, origin, destination):
+        # 索引與排名結果會一直保留，只為時刻表中的縣市建立，任意字串不會讓記憶體持續增長
+        stations = self.timetable.county_stations
+        return origin in stations and destination in stations
+
+    def route(self, origin, destination, route_type):
+        if not self.known(origin, destination):
+            return EMPTY_ROUTE
+        key = (origin, destination, route_type)
+        index = self._routes.get(key)
+        if index is None:
+            with self._lock:
+                index = self._routes.get(key)
+                if index is None:
+                    schedules = tuple(self._intern_many(self.router.itineraries(origin, destination, route_type)))
+                    index = RouteIndex(array('i', (s.departure for s in schedules)), schedules)
+                    self._routes[key] = index
+        return index
+
+    def _window(self, indexes, departure):
+        # 各搜尋條件在時段內的行程範圍（第一班不受時段限制）
+        window = []
+        for index in indexes:
+            start = bisect_left(index.departures, departure)
+            end = bisect_right(index.departures, departure + SEARCH_WINDOW, start)
+            window.append((start, min(max(end, start + 1), start + MAX_CANDIDATES)))
+        return tuple(window)
+
+    def _candidates(self, indexes, window):
+        # 合併各搜尋條件的行程，同一行程只保留一份
+        found = {}
+        for index, (start, end) in zip(indexes, window):
+            for schedule in index.schedules[start:end]:
+                found[schedule.id] = schedule
+        return sorted(found.values(), key=lambda s: s.departure)
+
+    def candidates(self, origin, destination, departure):
+        indexes = [self.route(origin, destination, t) for t in VARIANTS]
+        return self._candidates(indexes, self._window(indexes, departure))
+
+    def segments(self, origin, destination):
+        # 候選範圍只在出發分鐘越過某行程的出發時間、或時段終點越過某行程時改變；
+        # 而同一範圍內所有候選的等候時間差相同、不影響排序，因此每個區段只需排名一次
+        if not self.known(origin, destination):
+            return RouteSegments(array('i'), (EMPTY_ROUTE,) * len(VARIANTS), {})
+        key = (origin, destination)
+        segments = self._segments.get(key)
+        if segments is None:
+            indexes = tuple(self.route(origin, destination, t) for t in VARIANTS)
+            bounds = set()
+            for index in indexes:
+                for departure in index.departures:
+                    bounds.add(departure + 1)
+                    bounds.add(departure - SEARCH_WINDOW)
+            segments = self._segments.setdefault(key, RouteSegments(array('i', sorted(bounds)), indexes, {}))
+        return segments
+
+    def _plan(self, segments, departure, limit):
+        if limit > PLAN_LIMIT:
+            window = self._window(segments.indexes, departure)
+            return self.ranker.rank(self._candidates(segments.indexes, window), departure, limit)
+        i = bisect_right(segments.bounds, departure)
+        plan = segments.plans.get(i)
+        if plan is None:
+            window = self._window(segments.indexes, departure)
+            plan = segments.plans[i] = self.ranker.rank(self._candidates(segments.indexes, window),
+                                                        departure, PLAN_LIMIT)
+        if limit == PLAN_LIMIT:
+            return plan
+        return {route_type: schedules[:limit] for route_type, schedules in plan.items()}
+
+    def plan(self, origin, destination, departure, limit=2):
+        # 回傳 {方案: [Schedule, ...]}，三種方案都由同一個 Pareto 前緣推導
+        return self._plan(self.segments(origin, destination), departure, limit)
+
+    def plan_many(self, queries, limit=2):
+        # 批次規劃 [(起點, 終點, 出發分鐘), ...]，結果與輸入順序相同；
+        # 各查詢只需一次二分搜尋，同一區段的查詢（含先前的請求）共用一次排名結果
+        results = []
+        segments = {}
+        for origin, destination, departure in queries:
+            pair = segments.get((origin, destination))
+            if pair is None:
+                pair = segments[(origin, destination)] = self.segments(origin, destination)
+            results.append(self._plan(pair, departure, limit))
+        return results
+
+    def reachable(self, origin, departure, arrive_by=None, max_fare=None):
+        # {縣市: (最早抵達的班次, 最便宜的班次)}，依最早抵達時間排序；由一次正向掃描求得
+        found = self.router.reachable(origin, departure, INF if arrive_by is None else arrive_by,
+                                      INF if max_fare is None else max_fare)
+        schedules = self._intern_many([j for pair in found.values() for j in pair])
+        pairs = dict(zip(found, zip(schedules[::2], schedules[1::2])))
+        return dict(sorted(pairs.items(), key=lambda item: (item[1][0].arrival, item[1][0].fare)))
+
+    def search(self, origin, destination, departure, route_type='fastest', limit=2):
+        if route_type not in VARIANTS:
+            route_type = 'recommended'
+        return self.plan(origin, destination, departure, limit)[route_type]
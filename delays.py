@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from routing import MIN_TRANSFER, Transfer, transfer_type
+
+# 誤點資料來源：file:<路徑>（JSON lines，持續讀取新增的行）或 tcp:<主機>:<埠>（逐行 JSON 的串流）
+DELAY_FEED = os.environ.get('DELAY_FEED', '')
+DELAY_FEED_POLL = float(os.environ.get('DELAY_FEED_POLL', 2))
+RECONNECT_DELAY = 5
+
+# delay：終點站的誤點分鐘數；transfers：以實際時間重算的轉乘時間；feasible：每次轉乘都還來得及
+LiveStatus = namedtuple('LiveStatus', 'delays arrival_delay transfers transfer_type feasible')
+
+logger = logging.getLogger(__name__)
+
+
+class DelayBoard:
+    # 各車次目前的誤點：trip index → (誤點分鐘, 自第幾站起)
+    def __init__(self, timetable):
+        self.timetable = timetable
+        self.delays = {}
+
+    def update(self, updates):
+        # updates 為 [{"trip": 車次代碼, "delay": 分鐘, "from": 站序}]，delay 為 0 表示恢復正常；回傳有變動的車次
+        changed = []
+        for update in updates:
+            trip = self.timetable.trip_index.get(update.get('trip'))
+            if trip is None:
+                continue
+            try:
+                delay = int(update.get('delay') or 0)
+                start = int(update.get('from') or 0)
+            except (TypeError, ValueError):
+                continue
+            value = (delay, start) if delay else None
+            if self.delays.get(trip) == value:
+                continue
+            if value is None:
+                self.delays.pop(trip, None)
+            else:
+                self.delays[trip] = value
+            changed.append(trip)
+        return changed
+
+    def shift(self, trip, seq):
+        delay = self.delays.get(trip)
+        if delay is None or seq < delay[1]:
+            return 0
+        return delay[0]
+
+
+def live_status(timetable, board, legs):
+    # 只在行程中有車次誤點時回傳 LiveStatus，否則為 None
+    shifts = [(board.shift(leg.trip, leg.board), board.shift(leg.trip, leg.alight)) for leg in legs]
+    if not any(dep or arr for dep, arr in shifts):
+        return None
+    transfers = []
+    for i in range(len(legs) - 1):
+        prev, nxt = legs[i], legs[i + 1]
+        arrived = timetable.trips[prev.trip].stops[prev.alight]
+        boarding = timetable.trips[nxt.trip].stops[nxt.board]
+        slack = (boarding.dep + shifts[i + 1][0]) - (arrived.arr + shifts[i][1])
+        transfers.append(Transfer(arrived.station, slack))
+    transfers = tuple(transfers)
+    status = LiveStatus(
+        delays=tuple(arr for _, arr in shifts),
+        arrival_delay=shifts[-1][1],
+        transfers=transfers,
+        transfer_type=None,
+        feasible=all(t.slack >= MIN_TRANSFER for t in transfers),
+    )
+    return status._replace(transfer_type=transfer_type(status))
+
+
+class DelayFeed:
+    # 在背景讀取誤點資料並套用到目錄；每筆更新的成本只與受影響的車次數成正比
+    def __init__(self, catalog, source=DELAY_FEED, poll_interval=DELAY_FEED_POLL):
+        self.catalog = catalog
+        self.source = source
+        self.poll_interval = poll_interval
+        self._thread = None
+
+    def apply_lines(self, lines):
+        updates = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                message = json.loads(line)
+            except ValueError:
+                logger.warning('ignoring malformed delay update: %r', line[:200])
+                continue
+            updates.extend(message if isinstance(message, list) else [message])
+        if updates:
+            self.catalog.apply_delays([u for u in updates if isinstance(u, dict)])
+
+    def follow_file(self, path):
+        # 類似 tail -F：檔案被截斷或替換時從頭讀起
+        offset, inode, pending = 0, None, ''
+        while True:
+            try:
+                stat = os.stat(path)
+                if stat.st_ino != inode or stat.st_size < offset:
+                    offset, inode, pending = 0, stat.st_ino, ''
+                if stat.st_size > offset:
+                    with open(path, encoding='utf-8') as f:
+                        f.seek(offset)
+                        chunk = f.read()
+                        offset = f.tell()
+                    lines = (pending + chunk).split('\n')
+                    pending = lines.pop()
+                    self.apply_lines(lines)
+            except FileNotFoundError:
+                pass
+            time.sleep(self.poll_interval)
+
+    def follow_socket(self, host, port):
+        while True:
+            try:
+                with socket.create_connection((host, port), timeout=30) as conn:
+                    conn.settimeout(None)
+                    with conn.makefile(encoding='utf-8') as stream:
+                        for line in stream:
+                            self.apply_lines([line])
+            except OSError as e:
+                logger.warning('delay feed %s:%s unavailable: %s', host, port, e)
+            time.sleep(RECONNECT_DELAY)
+
+    def start(self):
+        if not self.source or self._thread is not None:
+            return
+        kind, _, target = self.source.partition(':')
+        if kind == 'file':
+            run, args = self.follow_file, (target,)
+        elif kind == 'tcp':
+            host, _, port = target.rpartition(':')
+            run, args = self.follow_socket, (host, int(port))
+        else:
+            raise ValueError(f'unsupported DELAY_FEED: {self.source}')
+        self._thread = threading.Thread(target=run, args=args, name='delay-feed', daemon=True)
+        self._thread.start()
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+from precompiled import fingerprint
+from ranking import RANKING_VERSION
+from routing import TIMETABLE_PATH
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+ESTIMATES_PATH = os.environ.get('ESTIMATES_PATH', os.path.join(INSTANCE_DIR, 'estimates.bin'))
+
+# 與頁面下拉選單相同的縣市順序
+COUNTIES = (
+    '基隆市', '台北市', '新北市', '桃園市', '新竹市', '新竹縣', '苗栗縣', '台中市', '彰化縣', '南投縣', '雲林縣',
+    '嘉義市', '嘉義縣', '台南市', '高雄市', '屏東縣', '宜蘭縣', '花蓮縣', '台東縣', '澎湖縣', '金門縣', '連江縣',
+)
+ROUTE_TYPES = ('fastest', 'cheapest', 'recommended')
+HOURS = 24
+# 每格存 (車程分鐘, 票價)
+FIELDS = 2
+MISSING = 0xFFFF
+
+# magic, 位元組順序, 縣市數, 時段數, 方案數, 規劃結果版本, 縣市名稱長度
+HEADER = struct.Struct('<4sc3H16sI')
+MAGIC = b'TPE3'
+
+logger = logging.getLogger(__name__)
+
+
+def timetable_digest(path=TIMETABLE_PATH):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()[:16]
+
+
+def plans_version(digest, fares_digest, weights):
+    # 預先計算的規劃結果取決於時刻表、票價表與排序方式（含 RANKING_WEIGHTS），任一改變時需重新產生
+    ranking = json.dumps([RANKING_VERSION, weights], sort_keys=True).encode('utf-8')
+    return fingerprint(digest + fares_digest + ranking)
+
+
+def catalog_version(catalog, digest=None):
+    return plans_version(digest or timetable_digest(), catalog.router.fares.digest, catalog.ranker.weights)
+
+
+def build(catalog, path=ESTIMATES_PATH, digest=None):
+    # 以每個整點出發查詢各縣市對的三種方案，寫成 [起點][終點][時段][方案][欄位] 的 uint16 陣列
+    n = len(COUNTIES)
+    queries = [(o, d, h * 60) for o in COUNTIES for d in COUNTIES for h in range(HOURS)]
+    plans = catalog.plan_many(queries, limit=1)
+    cells = array('H', [MISSING]) * (len(queries) * len(ROUTE_TYPES) * FIELDS)
+    for i, plan in enumerate(plans):
+        for t, route_type in enumerate(ROUTE_TYPES):
+            found = plan[route_type]
+            if found:
+                offset = (i * len(ROUTE_TYPES) + t) * FIELDS
+                cells[offset] = min(found[0].arrival - found[0].departure, MISSING - 1)
+                cells[offset + 1] = min(found[0].fare, MISSING - 1)
+
+    names = '\n'.join(COUNTIES).encode('utf-8')
+    header = HEADER.pack(MAGIC, sys.byteorder[0].encode(), n, HOURS, len(ROUTE_TYPES),
+                         catalog_version(catalog, digest).encode(), len(names))
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 先寫暫存檔再替換，其他 worker 不會讀到寫到一半的檔案
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        f.write(names)
+        f.write(b'\0' * (-(HEADER.size + len(names)) % cells.itemsize))
+        cells.tofile(f)
+    os.replace(tmp, path)
+
+
+class Estimates:
+    # 唯讀 mmap 的預估矩陣；各 worker 共用作業系統的頁面快取
+    def __init__(self, path=ESTIMATES_PATH):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byteorder, n, hours, types, version, names_len = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or byteorder != sys.byteorder[0].encode():
+            raise ValueError('unsupported estimates file')
+        self.version = version.decode('ascii')
+        names = self._mmap[HEADER.size:HEADER.size + names_len].decode('utf-8').split('\n')
+        self.county_index = {name: i for i, name in enumerate(names)}
+        self.hours = hours
+        self.types = types
+        offset = HEADER.size + names_len
+        offset += -offset % 2
+        self.cells = memoryview(self._mmap)[offset:].cast('H')
+
+    def lookup(self, origin, destination, hour):
+        # O(1) 查表，回傳 {方案: (車程分鐘, 票價)}，查無行程的方案不列出
+        o = self.county_index.get(origin)
+        d = self.county_index.get(destination)
+        if o is None or d is None or not 0 <= hour < self.hours:
+            return {}
+        base = ((o * len(self.county_index) + d) * self.hours + hour) * self.types * FIELDS
+        found = {}
+        for t, route_type in enumerate(ROUTE_TYPES[:self.types]):
+            minutes, fare = self.cells[base + t * FIELDS], self.cells[base + t * FIELDS + 1]
+            if minutes != MISSING:
+                found[route_type] = (minutes, fare)
+        return found
+
+
+def load_estimates(catalog, path=ESTIMATES_PATH, digest=None):
+    # 檔案不存在，或時刻表、票價表、排序方式有變時重新產生；digest 由呼叫端提供時不讀取時刻表 JSON
+    digest = digest or timetable_digest()
+    try:
+        estimates = Estimates(path)
+        if estimates.version == catalog_version(catalog, digest):
+            return estimates
+    except (OSError, ValueError, struct.error):
+        pass
+    started = time.time()
+    build(catalog, path, digest)
+    logger.info('built travel estimates in %.1fs', time.time() - started)
+    return Estimates(path)
+
+
+if __name__ == '__main__':
+    # web 行程啟動 gunicorn 前執行：python estimates.py；
+    # 先在同一個檔案系統上產生編譯時刻表與預估矩陣，各 worker 啟動時直接載入，已是最新時不重建
+    logging.basicConfig(level=logging.INFO)
+    from catalog import ScheduleCatalog
+    from routing import Router
+    from timetable_bin import load_timetable
+
+    started = time.time()
+    timetable = load_timetable()
+    load_estimates(ScheduleCatalog(Router(timetable)), digest=timetable.digest)
+    logger.info('%s ready in %.1fs', ESTIMATES_PATH, time.time() - started)
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+from array import array
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+FARES_PATH = os.environ.get('FARES_PATH', os.path.join(DATA_DIR, 'fares.json'))
+
+DEFAULT_CATEGORY = 'adult'
+
+
+class FareEngine:
+    # 高鐵依站間票價表、台鐵依里程計價；各旅客類別的折扣只套用在對應運具
+    def __init__(self, timetable, tables):
+        self.timetable = timetable
+        # 票價表的雜湊：預先計算的結果（靜態規劃、預估矩陣）以此判斷票價是否改變
+        self.digest = hashlib.sha256(json.dumps(tables, sort_keys=True).encode('utf-8')).digest()[:16]
+        self.categories = tables['categories']
+        self.category_names = {k: v['name'] for k, v in self.categories.items()}
+
+        hsr = tables['HSR']
+        self.hsr_position = {timetable.station_index[sid]: i for i, sid in enumerate(hsr['stations'])}
+        self.hsr_tables = hsr['tables']
+        self.tra_rates = tables['TRA']['rates']
+        self.tra_minimum = tables['TRA'].get('minimum', {})
+
+        # 台鐵站間里程表：取第一個經過兩站的車次
+        self.tra_km = {}
+        for trip in timetable.trips:
+            if trip.mode != 'TRA':
+                continue
+            for i, a in enumerate(trip.stops):
+                for b in trip.stops[i + 1:]:
+                    self.tra_km.setdefault((a.station, b.station), b.km - a.km)
+
+        # (上車站, 下車站, 車種, 類別) → 票價
+        self._memo = {}
+
+    @classmethod
+    def load(cls, timetable, path=FARES_PATH):
+        with open(path, encoding='utf-8') as f:
+            return cls(timetable, json.load(f))
+
+    def _base_fare(self, mode, cls, board, alight):
+        if mode == 'HSR':
+            table = self.hsr_tables[cls]
+            return table[self.hsr_position[board]][self.hsr_position[alight]]
+        km = self.tra_km[(board, alight)]
+        return max(int(km * self.tra_rates[cls] + 0.5), self.tra_minimum.get(cls, 0))
+
+    def fare(self, mode, cls, board, alight, category=DEFAULT_CATEGORY):
+        key = (board, alight, cls, category)
+        fare = self._memo.get(key)
+        if fare is None:
+            ratio = self.categories[category][mode]
+            fare = self._memo[key] = int(self._base_fare(mode, cls, board, alight) * ratio + 0.5)
+        return fare
+
+    def leg_fare(self, leg, category=DEFAULT_CATEGORY):
+        trip = self.timetable.trips[leg.trip]
+        board, alight = trip.stops[leg.board].station, trip.stops[leg.alight].station
+        return self.fare(trip.mode, trip.cls, board, alight, category)
+
+    def journey_fare(self, legs, category=DEFAULT_CATEGORY):
+        return sum(self.leg_fare(leg, category) for leg in legs)
+
+    def price_many(self, journeys, categories=None):
+        # 一次計算整批行程在各類別的總票價：先將所有路段去重，每段只查一次票價表，
+        # 回傳 {類別: array('i')}，順序與輸入相同
+        trips = self.timetable.trips
+        keys = {}
+        rows = []
+        for journey in journeys:
+            row = []
+            for leg in journey.legs:
+                trip = trips[leg.trip]
+                key = (trip.mode, trip.cls, trip.stops[leg.board].station, trip.stops[leg.alight].station)
+                row.append(keys.setdefault(key, len(keys)))
+            rows.append(row)
+
+        totals = {}
+        for category in categories or self.categories:
+            leg_fares = [self.fare(*key, category=category) for key in keys]
+            totals[category] = array('i', (sum(leg_fares[k] for k in row) for row in rows))
+        return totals
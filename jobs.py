@@ -0,0 +1,253 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from blocking import run_blocking
+from metrics import job_duration, job_queue_limit, job_workers, jobs_queued, jobs_running, jobs_total
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+JOBS_PATH = os.environ.get('SUGGESTION_JOBS_PATH', os.path.join(INSTANCE_DIR, 'jobs.sqlite3'))
+# 每個 worker 同時執行的工作數，以及排隊（含執行中）的上限
+JOB_WORKERS = int(os.environ.get('SUGGESTION_JOB_WORKERS', 4))
+JOB_QUEUE_DEPTH = int(os.environ.get('SUGGESTION_JOB_QUEUE_DEPTH', 64))
+# 工作結果保留多久（秒）
+JOB_TTL = int(os.environ.get('SUGGESTION_JOB_TTL', 3600))
+# long-poll 最長等待時間，以及等待其他 worker 的工作時查詢的間隔（秒）
+MAX_WAIT = float(os.environ.get('SUGGESTION_JOB_MAX_WAIT', 25))
+POLL_INTERVAL = 0.2
+# 串流工作的部分結果：最長串流時間，以及查詢與寫入部分結果的間隔（秒）
+STREAM_TIMEOUT = float(os.environ.get('SUGGESTION_JOB_STREAM_TIMEOUT', 120))
+STREAM_INTERVAL = 0.1
+PROGRESS_INTERVAL = 0.2
+
+# 預取建議的執行緒數與排隊上限，與使用者點選後的工作分開，不佔用其執行緒
+PREFETCH_WORKERS = int(os.environ.get('SUGGESTION_PREFETCH_WORKERS', 2))
+PREFETCH_QUEUE_DEPTH = int(os.environ.get('SUGGESTION_PREFETCH_QUEUE_DEPTH', 16))
+# 單次預取最多幾個班次（三種方案各兩班）
+PREFETCH_LIMIT = int(os.environ.get('SUGGESTION_PREFETCH_LIMIT', 6))
+
+# 每建立幾筆工作清一次過期資料
+PURGE_EVERY = 256
+# 單次最多取消幾個工作
+MAX_CANCEL = 64
+
+FINISHED = frozenset(['done', 'failed', 'cancelled'])
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    # run(payload, progress) 在背景執行緒執行並回傳結果字串，執行中可呼叫 progress(目前的文字) 回報部分結果；
+    # 工作狀態存在各 worker 共用的 SQLite，因此任何 worker 都能回應查詢，
+    # 建立工作的 worker 以 Event 喚醒自己行程內的等待者。
+    # 工作代碼以 name 開頭，同一資料表中的多個佇列各自只處理自己的工作
+    def __init__(self, run, name='suggestion', path=JOBS_PATH, workers=JOB_WORKERS, max_depth=JOB_QUEUE_DEPTH,
+                 ttl=JOB_TTL):
+        self.run = run
+        self.name = name
+        self.path = path
+        self.workers = workers
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._depth = 0
+        self._events = {}
+        self._by_key = {}
+        self._partial = {}
+        self._created = 0
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, status TEXT NOT NULL, result TEXT, error TEXT, expires REAL NOT NULL)'
+            )
+            self._local.conn = conn
+        return conn
+
+    @property
+    def executor(self):
+        # 每個 worker 行程各自建立執行緒池，fork 之後不沿用父行程的執行緒
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix='suggestion-job')
+                    self._pid = os.getpid()
+                    self._depth = 0
+                    self._events = {}
+                    self._by_key = {}
+                    self._partial = {}
+                    job_workers.inc(self.name, amount=self.workers)
+                    job_queue_limit.inc(self.name, amount=self.max_depth)
+        return self._executor
+
+    def _update(self, job_id, status, result=None, error=None):
+        self._db().execute('UPDATE jobs SET status = ?, result = ?, error = ? WHERE id = ?',
+                           (status, result, error, job_id))
+
+    def _save_progress(self, job_id, text):
+        self._db().execute("UPDATE jobs SET result = ? WHERE id = ? AND status = 'running'", (text, job_id))
+
+    def _progress(self, job_id, text):
+        # 部分結果在行程內立即可見；寫入 SQLite 供其他 worker 讀取，每 PROGRESS_INTERVAL 最多一次
+        now = time.monotonic()
+        with self._lock:
+            saved_at = self._partial[job_id][1] if job_id in self._partial else 0
+            due = now - saved_at >= PROGRESS_INTERVAL
+            self._partial[job_id] = (text, now if due else saved_at)
+        if due:
+            run_blocking(self._save_progress, job_id, text)
+
+    def _insert(self, job_id, now, purge):
+        db = self._db()
+        db.execute('INSERT INTO jobs (id, status, expires) VALUES (?, ?, ?)', (job_id, 'queued', now + self.ttl))
+        if purge:
+            db.execute('DELETE FROM jobs WHERE expires <= ?', (now,))
+
+    def submit(self, key, payload):
+        # 回傳工作代碼；相同 key 的工作尚未完成時共用同一個工作
+        executor = self.executor
+        with self._lock:
+            job_id = self._by_key.get(key)
+        # 相同 key 的工作可能已被（任何 worker）取消，此時另建新的工作
+        if job_id is not None and self._status(job_id) != 'cancelled':
+            return job_id
+        with self._lock:
+            current = self._by_key.get(key)
+            if current is not None and current != job_id:
+                return current
+            if self._depth >= self.max_depth:
+                jobs_total.inc(self.name, 'rejected')
+                raise QueueFull('suggestion job queue is full')
+            job_id = f'{self.name}-{secrets.token_urlsafe(12)}'
+            self._depth += 1
+            self._events[job_id] = threading.Event()
+            self._by_key[key] = job_id
+        # 寫入在 gevent worker 中改由原生執行緒執行，等待 SQLite 鎖時不卡住其他請求
+        self._created += 1
+        run_blocking(self._insert, job_id, time.time(), self._created % PURGE_EVERY == 0)
+        jobs_queued.inc(self.name)
+        executor.submit(self._work, job_id, key, payload)
+        return job_id
+
+    def _status(self, job_id):
+        row = self._db().execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def _claim(self, job_id):
+        # 只有仍在排隊的工作會開始執行；排隊期間可能已被任何 worker 取消
+        cursor = self._db().execute("UPDATE jobs SET status = 'running' WHERE id = ? AND status = 'queued'",
+                                    (job_id,))
+        return cursor.rowcount > 0
+
+    def _cancel(self, job_ids):
+        cursor = self._db().execute(
+            f"UPDATE jobs SET status = 'cancelled' WHERE status = 'queued' AND id IN ({', '.join('?' * len(job_ids))})",
+            job_ids,
+        )
+        return cursor.rowcount
+
+    def _work(self, job_id, key, payload):
+        jobs_queued.dec(self.name)
+        started = time.perf_counter()
+        result = error = None
+        try:
+            if not run_blocking(self._claim, job_id):
+                status = 'cancelled'
+            else:
+                jobs_running.inc(self.name)
+                try:
+                    result = self.run(payload, lambda text: self._progress(job_id, text))
+                    status = 'done'
+                finally:
+                    jobs_running.dec(self.name)
+        except Exception as e:
+            status, result, error = 'failed', None, str(e)
+        try:
+            if status != 'cancelled':
+                run_blocking(self._update, job_id, status, result, error)
+        finally:
+            jobs_total.inc(self.name, status)
+            job_duration.observe(time.perf_counter() - started, self.name, status)
+            with self._lock:
+                self._depth -= 1
+                if self._by_key.get(key) == job_id:
+                    del self._by_key[key]
+                self._partial.pop(job_id, None)
+                event = self._events.pop(job_id, None)
+            if event is not None:
+                event.set()
+
+    def cancel(self, job_ids):
+        # 取消尚未開始的工作，回傳取消的數量；執行中的工作會照常完成並寫入快取
+        job_ids = [job_id for job_id in job_ids if self.owns(job_id)][:MAX_CANCEL]
+        if not job_ids:
+            return 0
+        return run_blocking(self._cancel, job_ids)
+
+    def owns(self, job_id):
+        return isinstance(job_id, str) and job_id.startswith(self.name + '-')
+
+    def get(self, job_id):
+        if not self.owns(job_id):
+            return None
+        row = self._db().execute(
+            'SELECT status, result, error FROM jobs WHERE id = ? AND expires > ?', (job_id, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        result = row[1]
+        if row[0] == 'running':
+            # 本 worker 執行中的工作以記憶體中最新的部分結果為準
+            partial = self._partial.get(job_id)
+            if partial is not None:
+                result = partial[0]
+        return {'id': job_id, 'status': row[0], 'result': result, 'error': row[2]}
+
+    def wait(self, job_id, timeout):
+        # long-poll：等到工作完成或逾時後回傳目前狀態
+        job = self.get(job_id)
+        timeout = min(max(timeout, 0), MAX_WAIT)
+        if job is None or job['status'] in FINISHED or timeout == 0:
+            return job
+        event = self._events.get(job_id) if self._pid == os.getpid() else None
+        if event is not None:
+            event.wait(timeout)
+            return self.get(job_id)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            job = self.get(job_id)
+            if job is None or job['status'] in FINISHED:
+                break
+        return job
+
+    def follow(self, job_id, timeout=STREAM_TIMEOUT):
+        # 串流：狀態或部分結果改變時產生目前的工作，直到工作結束或逾時
+        deadline = time.monotonic() + min(max(timeout, 0), STREAM_TIMEOUT)
+        last = None
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                return
+            if (job['status'], job['result']) != last:
+                last = (job['status'], job['result'])
+                yield job
+            if job['status'] in FINISHED or time.monotonic() >= deadline:
+                return
+            time.sleep(STREAM_INTERVAL)
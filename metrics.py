@@ -0,0 +1,293 @@
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(INSTANCE_DIR, 'metrics'))
+# 各 worker 寫出快照的間隔（秒）
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+# 已結束的 worker 檔案超過此數量時合併成一個
+COMPACT_AFTER = 16
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    def __init__(self, registry, name, help, kind, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = tuple(labels)
+
+
+class Counter(Metric):
+    def __init__(self, registry, name, help, labels=()):
+        super().__init__(registry, name, help, 'counter', labels)
+
+    def inc(self, *labels, amount=1):
+        key = (self.name, labels)
+        values = self.registry.values
+        with self.registry.lock:
+            values[key] = values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    # 只統計仍在執行的 worker（例如處理中的請求數）
+    def __init__(self, registry, name, help, labels=()):
+        super().__init__(registry, name, help, 'gauge', labels)
+
+    def inc(self, *labels, amount=1):
+        key = (self.name, labels)
+        values = self.registry.gauges
+        with self.registry.lock:
+            values[key] = values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    def __init__(self, registry, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, 'histogram', labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # 各區間分開計數，輸出時再累加成 Prometheus 的 le 累積值；最後一格為 +Inf
+        key = (self.name, labels)
+        i = bisect_left(self.buckets, value)
+        values = self.registry.values
+        with self.registry.lock:
+            state = values.get(key)
+            if state is None:
+                state = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[i] += 1
+            state[-1] += value
+
+
+class Registry:
+    # 每個 worker 在記憶體中累計，定期寫到 METRICS_DIR/<pid>-<token>.json；
+    # /metrics 讀取所有 worker 的檔案後加總
+    def __init__(self, path=METRICS_DIR, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.metrics = {}
+        self.values = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._thread = None
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(self, name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, help, labels, buckets))
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def _own_file(self):
+        # fork 後的子行程重新開始計數，避免重複計入父行程的數值
+        if self._pid != os.getpid():
+            with self.lock:
+                if self._pid is not None:
+                    self.values.clear()
+                    self.gauges.clear()
+                self._pid = os.getpid()
+                self._file = os.path.join(self.path, f'{self._pid}-{uuid.uuid4().hex[:8]}.json')
+        return self._file
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'values': [[name, list(labels), value if not isinstance(value, list) else list(value)]
+                           for (name, labels), value in self.values.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self.gauges.items()],
+            }
+
+    def flush(self):
+        path = self._own_file()
+        os.makedirs(self.path, exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def start(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._own_file()
+
+        def loop():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except OSError:
+                    pass
+
+        self._thread = threading.Thread(target=loop, name='metrics-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _compact(self, dead):
+        # 將已結束 worker 的累計值併入 dead.json；先改名取得檔案所有權，避免多個 worker 重複合併
+        claimed = []
+        for path in dead:
+            target = path + '.merging'
+            try:
+                os.rename(path, target)
+                claimed.append(target)
+            except OSError:
+                pass
+        if not claimed:
+            return
+        archive = os.path.join(self.path, 'dead.json')
+        with open(os.path.join(self.path, 'dead.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = {}
+            for path in [archive] + claimed:
+                try:
+                    with open(path) as f:
+                        self._merge(totals, json.load(f)['values'])
+                except (OSError, ValueError):
+                    pass
+            tmp = archive + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'values': [[n, list(l), v] for (n, l), v in totals.items()], 'gauges': []}, f)
+            os.replace(tmp, archive)
+        for path in claimed:
+            os.remove(path)
+
+    @staticmethod
+    def _merge(totals, rows):
+        for name, labels, value in rows:
+            key = (name, tuple(labels))
+            current = totals.get(key)
+            if current is None:
+                totals[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                totals[key] = [a + b for a, b in zip(current, value)]
+            else:
+                totals[key] = current + value
+
+    def collect(self):
+        # 回傳 (累計值, 量測值)；累計值包含已結束的 worker，量測值只含仍在執行的 worker
+        own = self._own_file()
+        totals, gauges = {}, {}
+        dead = []
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            path = os.path.join(self.path, name)
+            if not name.endswith('.json') or path == own:
+                continue
+            alive = True
+            if name != 'dead.json':
+                try:
+                    alive = pid_alive(int(name.split('-', 1)[0]))
+                except ValueError:
+                    continue
+                if not alive:
+                    dead.append(path)
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self._merge(totals, data['values'])
+            if alive:
+                self._merge(gauges, data['gauges'])
+        data = self.snapshot()
+        self._merge(totals, data['values'])
+        self._merge(gauges, data['gauges'])
+        if len(dead) > COMPACT_AFTER:
+            self._compact(dead)
+        return totals, gauges
+
+    def render(self):
+        # Prometheus 文字格式
+        totals, gauges = self.collect()
+        lines = []
+        for metric in self.metrics.values():
+            source = gauges if metric.kind == 'gauge' else totals
+            rows = sorted((labels, value) for (name, labels), value in source.items() if name == metric.name)
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for labels, value in rows:
+                if metric.kind != 'histogram':
+                    lines.append(f'{metric.name}{format_labels(metric.labels, labels)} {format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f'{metric.name}_bucket{format_labels(metric.labels, labels, le)} {cumulative}')
+                lines.append(f'{metric.name}_sum{format_labels(metric.labels, labels)} {format_value(value[-1])}')
+                lines.append(f'{metric.name}_count{format_labels(metric.labels, labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_latency = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency by endpoint', ('endpoint', 'method', 'status'))
+http_in_progress = registry.gauge(
+    'http_requests_in_progress', 'HTTP requests currently being handled', ('endpoint',))
+upstream_latency = registry.histogram(
+    'upstream_request_duration_seconds', 'Upstream LLM call latency per attempt', ('status',))
+llm_tokens = registry.counter('llm_tokens_total', 'Tokens reported by the LLM completion usage', ('type',))
+cache_requests = registry.counter(
+    'suggestion_cache_requests_total', 'Suggestion cache lookups by result', ('result',))
+llm_admissions = registry.counter(
+    'llm_admissions_total', 'LLM calls admitted, shed or timed out by the rate limiter', ('priority', 'result'))
+llm_queue_wait = registry.histogram(
+    'llm_queue_wait_seconds', 'Time LLM calls spent waiting for rate-limit capacity', ('priority',))
+jobs_queued = registry.gauge('suggestion_jobs_queued', 'Suggestion jobs waiting for a job worker thread', ('queue',))
+jobs_running = registry.gauge('suggestion_jobs_running', 'Suggestion jobs currently running', ('queue',))
+job_workers = registry.gauge('suggestion_job_workers', 'Configured suggestion job threads across live workers',
+                             ('queue',))
+job_queue_limit = registry.gauge('suggestion_job_queue_limit', 'Configured suggestion job queue depth across live workers',
+                                 ('queue',))
+jobs_total = registry.counter('suggestion_jobs_total', 'Suggestion jobs by outcome', ('queue', 'result'))
+job_duration = registry.histogram('suggestion_job_duration_seconds', 'Suggestion job run time', ('queue', 'status'))
@@ -0,0 +1,104 @@
+import gzip
+import hashlib
+import re
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:  # brotli 為選用套件，未安裝時只提供 gzip
+    brotli = None
+
+PAGE_CACHE_CONTROL = 'no-cache'
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# 依偏好排序的壓縮格式
+ENCODINGS = ('br', 'gzip')
+
+STYLE_RE = re.compile(r'<style>(.*?)</style>', re.S)
+SCRIPT_RE = re.compile(r'<script>(.*?)</script>', re.S)
+
+
+def fingerprint(body):
+    return hashlib.sha256(body).hexdigest()[:16]
+
+
+def parse_accept_encoding(header):
+    # 回傳 {encoding: q}
+    accepted = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+class PrecompiledResponse:
+    # 啟動時預先產生的回應：原始與壓縮版本、各版本的強 ETag
+    def __init__(self, body, mimetype, cache_control=PAGE_CACHE_CONTROL):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self.digest = fingerprint(body)
+        self.variants = {'identity': body}
+        compressed = {'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body, quality=11)
+        for encoding, data in compressed.items():
+            if len(data) < len(body):
+                self.variants[encoding] = data
+
+    def etag(self, encoding):
+        if encoding == 'identity':
+            return self.digest
+        return f'{self.digest}-{encoding}'
+
+    def negotiate(self, accept_encoding):
+        accepted = parse_accept_encoding(accept_encoding)
+        wildcard = accepted.get('*', 0)
+        for encoding in ENCODINGS:
+            if encoding in self.variants and accepted.get(encoding, wildcard) > 0:
+                return encoding
+        return 'identity'
+
+    def response(self, request):
+        encoding = self.negotiate(request.headers.get('Accept-Encoding'))
+        etag = self.etag(encoding)
+        headers = {
+            'ETag': f'"{etag}"',
+            'Cache-Control': self.cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(self.variants[encoding], mimetype=self.mimetype, headers=headers)
+
+
+def split_assets(html, prefix='/assets/'):
+    # 將 inline CSS/JS 抽成以內容雜湊命名的靜態檔，回傳改寫後的 HTML 與 {檔名: 回應}
+    assets = {}
+
+    def extract(regex, ext, mimetype, tag):
+        nonlocal html
+        match = regex.search(html)
+        if match is None:
+            return
+        asset = PrecompiledResponse(match.group(1), mimetype, ASSET_CACHE_CONTROL)
+        name = f'app.{asset.digest}.{ext}'
+        assets[name] = asset
+        html = html[:match.start()] + tag.format(prefix + name) + html[match.end():]
+
+    extract(STYLE_RE, 'css', 'text/css', '<link rel="stylesheet" href="{}">')
+    extract(SCRIPT_RE, 'js', 'text/javascript', '<script src="{}"></script>')
+    return html, assets
@@ -0,0 +1,76 @@
+import json
+import os
+from collections import namedtuple
+
+from routing import RELAXED_TRANSFER
+
+# 轉乘時間超過此值不再加分（分鐘），直達視同此值
+SLACK_CAP = 60
+
+# 推薦方案的評分權重（換算成「等效分鐘」，越低越好），可用 RANKING_WEIGHTS 覆寫部分項目
+DEFAULT_WEIGHTS = {
+    'duration': 1.0,     # 每分鐘車程
+    'wait': 0.5,         # 距離指定出發時間的每分鐘等候
+    'fare': 0.1,         # 每 1 元票價
+    'transfers': 15.0,   # 每次轉乘
+    'slack': 1.0,        # 轉乘時間低於 RELAXED_TRANSFER 的每分鐘
+}
+RANKING_WEIGHTS = dict(DEFAULT_WEIGHTS, **json.loads(os.environ.get('RANKING_WEIGHTS') or '{}'))
+
+# 排序邏輯改變、結果與先前不同時遞增，讓預先計算的結果重新產生
+RANKING_VERSION = 2
+
+Criteria = namedtuple('Criteria', 'arrival duration fare transfers slack')
+
+
+def criteria(schedule):
+    # 皆為越小越好；slack 取負值讓轉乘時間越充裕越好。
+    # 抵達時間也是準則之一，較晚出發、車程只短一點的班次不會淘汰較早抵達的班次
+    slack = min([t.slack for t in schedule.transfers] + [SLACK_CAP])
+    return Criteria(schedule.arrival, schedule.arrival - schedule.departure, schedule.fare,
+                    len(schedule.transfers), -slack)
+
+
+def dominates(a, b):
+    return a != b and all(x <= y for x, y in zip(a, b))
+
+
+def pareto_frontier(items, key=criteria):
+    # Sort-Filter-Skyline：依各項總和排序後，被支配者必排在支配者之後，
+    # 每個候選只需與目前的前緣比較，成本為 O(n log n + n·前緣大小)
+    scored = sorted(((key(item), item) for item in items), key=lambda p: (sum(p[0]), p[0]))
+    frontier = []
+    for vector, item in scored:
+        if not any(dominates(other, vector) for other, _ in frontier):
+            frontier.append((vector, item))
+    return frontier
+
+
+class Ranker:
+    def __init__(self, weights=None, score=None):
+        self.weights = dict(RANKING_WEIGHTS, **(weights or {}))
+        if score is not None:
+            self.score = score
+
+    def score(self, schedule, vector, departure):
+        w = self.weights
+        return (
+            w['duration'] * vector.duration
+            + w['wait'] * max(0, schedule.departure - departure)
+            + w['fare'] * vector.fare
+            + w['transfers'] * vector.transfers
+            + w['slack'] * max(0, RELAXED_TRANSFER + vector.slack) * (vector.transfers > 0)
+        )
+
+    def rank(self, candidates, departure, limit=2):
+        # 由 Pareto 前緣推導三種方案，各自依不同準則排序
+        frontier = pareto_frontier(candidates)
+        # 最快方案以最早抵達為準，同時抵達時取車程較短者
+        by_arrival = sorted(frontier, key=lambda p: (p[0].arrival, p[0].duration, p[0].fare))
+        by_fare = sorted(frontier, key=lambda p: (p[0].fare, p[0].arrival, p[0].duration))
+        by_score = sorted(frontier, key=lambda p: (self.score(p[1], p[0], departure), p[1].departure))
+        return {
+            'fastest': [item for _, item in by_arrival[:limit]],
+            'cheapest': [item for _, item in by_fare[:limit]],
+            'recommended': [item for _, item in by_score[:limit]],
+        }
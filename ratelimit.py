@@ -0,0 +1,192 @@
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from blocking import run_blocking
+from metrics import llm_admissions, llm_queue_wait
+from upstream import UpstreamError
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+RATELIMIT_PATH = os.environ.get('RATELIMIT_PATH', os.path.join(INSTANCE_DIR, 'ratelimit.sqlite3'))
+# 上游配額：每分鐘請求數與每分鐘 token 數
+REQUESTS_PER_MINUTE = float(os.environ.get('LLM_REQUESTS_PER_MINUTE', 500))
+TOKENS_PER_MINUTE = float(os.environ.get('LLM_TOKENS_PER_MINUTE', 200000))
+# 桶子容量相當於幾秒的配額；越小越平滑，但能吸收的突發流量越少
+BURST_SECONDS = float(os.environ.get('LLM_BURST_SECONDS', 10))
+# 每個 worker 最多排隊的請求數，以及排隊的最長時間（秒）
+MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', 64))
+QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', 10))
+# 背景工作只在桶內還剩此比例以上的配額時才放行，保留給使用者的請求
+BACKGROUND_RESERVE = float(os.environ.get('LLM_BACKGROUND_RESERVE', 0.5))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+
+class Overloaded(UpstreamError):
+    # 排隊已滿或等不到配額；retry_after 為建議的重試秒數
+    def __init__(self, message, retry_after=1):
+        super().__init__(message, 503)
+        self.retry_after = retry_after
+
+
+def estimate_tokens(request_data):
+    # 送出前無法得知實際用量：以 prompt 字數粗估（中文約每字一個 token）加上回覆上限
+    prompt = json.dumps(request_data.get('messages', []), ensure_ascii=False)
+    return len(prompt) + request_data.get('max_tokens', 0)
+
+
+class TokenBucket:
+    # 各 worker 共用的兩個桶子（請求數、token 數），存在 SQLite 並以 BEGIN IMMEDIATE 原子地補充與扣除
+    def __init__(self, path=RATELIMIT_PATH, requests_per_minute=REQUESTS_PER_MINUTE,
+                 tokens_per_minute=TOKENS_PER_MINUTE, burst_seconds=BURST_SECONDS):
+        self.path = path
+        self.rates = {'requests': requests_per_minute / 60, 'tokens': tokens_per_minute / 60}
+        self.capacity = {name: max(rate * burst_seconds, 1) for name, rate in self.rates.items()}
+        self._local = threading.local()
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS buckets ('
+                'name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)'
+            )
+            self._local.conn = conn
+        return conn
+
+    def _levels(self, db, now):
+        levels = {name: capacity for name, capacity in self.capacity.items()}
+        for name, level, updated in db.execute('SELECT name, level, updated FROM buckets'):
+            if name in levels:
+                levels[name] = min(self.capacity[name], level + max(now - updated, 0) * self.rates[name])
+        return levels
+
+    def _save(self, db, levels, now):
+        db.executemany('INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)',
+                       [(name, level, now) for name, level in levels.items()])
+
+    def take(self, tokens, reserve=0.0):
+        # 取得一個請求與 tokens 個 token 的配額；成功回傳 0，否則回傳還需等待的秒數
+        costs = {'requests': 1, 'tokens': min(tokens, self.capacity['tokens'])}
+        now = time.time()
+        try:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                levels = self._levels(db, now)
+                wait = 0.0
+                for name, cost in costs.items():
+                    floor = min(reserve * self.capacity[name], self.capacity[name] - cost)
+                    shortfall = cost + floor - levels[name]
+                    if shortfall > 0:
+                        wait = max(wait, shortfall / self.rates[name])
+                if wait == 0:
+                    for name, cost in costs.items():
+                        levels[name] -= cost
+                    self._save(db, levels, now)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            # 無法使用共用狀態時不限流，交由上游的 429 與重試處理
+            return 0.0
+        return wait
+
+    def settle(self, estimated, actual):
+        # 收到實際用量後補回或追扣 token；可扣到負值，之後的請求會等到補滿為止
+        if not actual or actual == estimated:
+            return
+        now = time.time()
+        try:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                levels = self._levels(db, now)
+                levels['tokens'] = min(self.capacity['tokens'], levels['tokens'] + estimated - actual)
+                self._save(db, levels, now)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        except sqlite3.Error:
+            pass
+
+
+class Ticket:
+    def __init__(self, bucket, estimated):
+        self.bucket = bucket
+        self.estimated = estimated
+
+    def settle(self, usage):
+        if usage:
+            run_blocking(self.bucket.settle, self.estimated, usage.get('total_tokens', 0))
+
+
+class RateLimiter:
+    # 超出配額的呼叫在行程內依 (優先序, 截止時間, 先後) 排隊，只有排頭向共用桶子取配額；
+    # 佇列已滿或在截止前等不到配額時丟出 Overloaded
+    def __init__(self, bucket=None, max_queue=MAX_QUEUE, timeout=QUEUE_TIMEOUT,
+                 background_reserve=BACKGROUND_RESERVE):
+        self.bucket = bucket or TokenBucket()
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.background_reserve = background_reserve
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, tokens, priority=INTERACTIVE, timeout=None):
+        started = time.monotonic()
+        deadline = started + (self.timeout if timeout is None else timeout)
+        entry = (priority, deadline, next(self._counter))
+        name = PRIORITY_NAMES[priority]
+        reserve = self.background_reserve if priority == BACKGROUND else 0.0
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                llm_admissions.inc(name, 'shed')
+                raise Overloaded('suggestion queue is full')
+            heapq.heappush(self._queue, entry)
+            self._cond.notify_all()
+        try:
+            while True:
+                with self._cond:
+                    while self._queue[0] is not entry:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            llm_admissions.inc(name, 'timeout')
+                            raise Overloaded('timed out waiting for upstream capacity')
+                        self._cond.wait(remaining)
+                # 向共用桶子取配額的交易可能等待其他行程的鎖，不在持有 _cond 時進行
+                wait = run_blocking(self.bucket.take, tokens, reserve)
+                if wait == 0:
+                    break
+                with self._cond:
+                    if wait > deadline - time.monotonic():
+                        # 截止前等不到配額就立即放棄，不佔用佇列
+                        llm_admissions.inc(name, 'timeout')
+                        raise Overloaded('upstream rate limit exceeded', retry_after=max(1, round(wait)))
+                    # 等待期間若有更優先的請求加入，會被喚醒並讓出排頭
+                    self._cond.wait(wait)
+        finally:
+            with self._cond:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+        llm_admissions.inc(name, 'admitted')
+        llm_queue_wait.observe(time.monotonic() - started, name)
+        return Ticket(self.bucket, tokens)
+
+    def admit(self, request_data, priority=INTERACTIVE):
+        return self.acquire(estimate_tokens(request_data), priority)
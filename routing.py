@@ -0,0 +1,385 @@
+import json
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from functools import lru_cache
+
+from fares import FareEngine
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TIMETABLE_PATH = os.environ.get('TIMETABLE_PATH', os.path.join(DATA_DIR, 'timetable.json'))
+
+INF = 1 << 30
+
+# 同站換車最短時間（分鐘）
+MIN_TRANSFER = 5
+# 推薦方案要求的最短轉乘時間（分鐘）
+RELAXED_TRANSFER = 30
+# 轉乘時間分類：< TIGHT 為緊湊，<= LONG 為適中，其餘為充裕
+TIGHT_TRANSFER = 30
+LONG_TRANSFER = 45
+
+# 每種方案對應的搜尋條件：(可搭乘運具, 最短轉乘時間)
+VARIANTS = {
+    'fastest': (('HSR', 'TRA'), MIN_TRANSFER),
+    'cheapest': (('TRA',), MIN_TRANSFER),
+    'recommended': (('HSR', 'TRA'), RELAXED_TRANSFER),
+}
+
+Station = namedtuple('Station', 'id name county mode')
+Stop = namedtuple('Stop', 'station arr dep km')
+Trip = namedtuple('Trip', 'id mode cls no stops')
+Leg = namedtuple('Leg', 'trip board alight')
+Journey = namedtuple('Journey', 'id legs departure arrival fare transfers')
+Transfer = namedtuple('Transfer', 'station slack')
+
+
+def parse_time(value):
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def format_time(minutes):
+    return '%02d:%02d' % (minutes // 60 % 24, minutes % 60)
+
+
+def transfer_type(journey):
+    if not journey.transfers:
+        return 'direct'
+    slack = min(t.slack for t in journey.transfers)
+    if slack < TIGHT_TRANSFER:
+        return 'tight'
+    if slack <= LONG_TRANSFER:
+        return 'medium'
+    return 'long'
+
+
+class Timetable:
+    def __init__(self, data):
+        self.stations = [Station(*row) for row in data['stations']]
+        self.station_index = {s.id: i for i, s in enumerate(self.stations)}
+
+        # 各縣市的代表車站（規劃的起訖點），未指定時使用縣市內所有車站
+        county_stations = {}
+        for i, s in enumerate(self.stations):
+            county_stations.setdefault(s.county, []).append(i)
+        for county, ids in data.get('counties', {}).items():
+            county_stations[county] = [self.station_index[sid] for sid in ids]
+        self.county_stations = {k: tuple(v) for k, v in county_stations.items()}
+
+        self.trips = []
+        for row in data['trips']:
+            stops = tuple(
+                Stop(self.station_index[sid], parse_time(arr), parse_time(dep), km)
+                for sid, arr, dep, km in row['stops']
+            )
+            self.trips.append(Trip(row['id'], row['mode'], row['class'], row['no'], stops))
+        self.trip_index = {t.id: i for i, t in enumerate(self.trips)}
+        self.trip_mode = [t.mode for t in self.trips]
+
+        # 站間步行/轉乘連結（雙向）
+        self.transfers = [[] for _ in self.stations]
+        for a, b, minutes in data.get('transfers', []):
+            a, b = self.station_index[a], self.station_index[b]
+            self.transfers[a].append((b, minutes))
+            self.transfers[b].append((a, minutes))
+
+        self._build_connections()
+
+    def _build_connections(self):
+        rows = []
+        for t, trip in enumerate(self.trips):
+            for seq in range(len(trip.stops) - 1):
+                a, b = trip.stops[seq], trip.stops[seq + 1]
+                rows.append((a.dep, b.arr, a.station, b.station, t, seq))
+        rows.sort()
+
+        # 依出發時間排序的連結陣列
+        self.c_dep = array('i', (r[0] for r in rows))
+        self.c_arr = array('i', (r[1] for r in rows))
+        self.c_from = array('i', (r[2] for r in rows))
+        self.c_to = array('i', (r[3] for r in rows))
+        self.c_trip = array('i', (r[4] for r in rows))
+        self.c_seq = array('i', (r[5] for r in rows))
+
+    @classmethod
+    def load(cls, path=TIMETABLE_PATH):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def footpaths(self, min_transfer):
+        # 每站可轉乘的目標站（含原站換車），轉乘時間不少於 min_transfer
+        return [
+            ((s, min_transfer),) + tuple((t, max(m, min_transfer)) for t, m in self.transfers[s])
+            for s in range(len(self.stations))
+        ]
+
+
+class Profile:
+    # 單一目的地的全日 profile：每站保存 (出發, 抵達, 上車連結, 下車連結)，出發時間遞減
+    def __init__(self, timetable, targets, modes, min_transfer):
+        self.timetable = timetable
+        self.is_target = bytearray(len(timetable.stations))
+        for s in targets:
+            self.is_target[s] = 1
+        self.footpaths = timetable.footpaths(min_transfer)
+        self.entries = [[] for _ in timetable.stations]
+        self.neg_deps = [[] for _ in timetable.stations]
+        self._scan(set(modes))
+
+    def _scan(self, modes):
+        tt = self.timetable
+        c_dep, c_arr, c_from, c_to, c_trip = tt.c_dep, tt.c_arr, tt.c_from, tt.c_to, tt.c_trip
+        allowed = [m in modes for m in tt.trip_mode]
+        trip_arr = [INF] * len(tt.trips)
+        trip_exit = [-1] * len(tt.trips)
+        is_target, footpaths = self.is_target, self.footpaths
+        entries, neg_deps = self.entries, self.neg_deps
+
+        for i in range(len(c_dep) - 1, -1, -1):
+            trip = c_trip[i]
+            if not allowed[trip]:
+                continue
+            arr = c_arr[i]
+            to = c_to[i]
+            if is_target[to]:
+                best = arr
+            else:
+                # 下車轉乘：查轉乘站 profile 中最早可搭的行程
+                best = INF
+                for fp_to, walk in footpaths[to]:
+                    k = bisect_right(neg_deps[fp_to], -(arr + walk)) - 1
+                    if k >= 0 and entries[fp_to][k][1] < best:
+                        best = entries[fp_to][k][1]
+            if best < trip_arr[trip]:
+                trip_arr[trip] = best
+                trip_exit[trip] = i
+            else:
+                best = trip_arr[trip]
+            if best >= INF:
+                continue
+
+            frm = c_from[i]
+            dep = c_dep[i]
+            station_entries = entries[frm]
+            entry = (dep, best, i, trip_exit[trip])
+            if station_entries:
+                last = station_entries[-1]
+                if best >= last[1]:
+                    continue
+                if last[0] == dep:
+                    station_entries[-1] = entry
+                    continue
+            station_entries.append(entry)
+            neg_deps[frm].append(-dep)
+
+    def departures(self, station, departure):
+        # 回傳該站 departure 之後的行程，依出發時間遞增
+        k = bisect_right(self.neg_deps[station], -departure) - 1
+        station_entries = self.entries[station]
+        while k >= 0:
+            yield station_entries[k]
+            k -= 1
+
+    def unpack(self, entry):
+        tt = self.timetable
+        legs = []
+        while True:
+            dep, arr, enter, exit_ = entry
+            legs.append(Leg(tt.c_trip[enter], tt.c_seq[enter], tt.c_seq[exit_] + 1))
+            stop = tt.c_to[exit_]
+            if self.is_target[stop]:
+                return tuple(legs)
+            t = tt.c_arr[exit_]
+            for fp_to, walk in self.footpaths[stop]:
+                k = bisect_right(self.neg_deps[fp_to], -(t + walk)) - 1
+                if k >= 0 and self.entries[fp_to][k][1] == arr:
+                    entry = self.entries[fp_to][k]
+                    break
+            else:
+                raise RuntimeError('profile entry cannot be unpacked')
+
+
+class Reach:
+    # 由起點出發的單次正向掃描：每站保存 (抵達, 票價) 的 Pareto 標籤，
+    # 標籤為 (抵達, 票價, 車次, 上車站序, 下車站序, 前一個標籤)，起點標籤的車次為 -1
+    def __init__(self, timetable, fares, origins, departure, modes, min_transfer, arrive_by=INF, max_fare=INF):
+        self.timetable = timetable
+        self.fares = fares
+        self.labels = [[] for _ in timetable.stations]
+        for s in origins:
+            self.labels[s].append((departure, 0, -1, 0, 0, None))
+        self._scan(set(modes), min_transfer, departure, arrive_by, max_fare)
+
+    def _insert(self, station, label):
+        labels = self.labels[station]
+        arr, fare = label[0], label[1]
+        for other in labels:
+            if other[0] <= arr and other[1] <= fare:
+                return
+        labels[:] = [o for o in labels if not (arr <= o[0] and fare <= o[1])]
+        labels.append(label)
+
+    def _scan(self, modes, min_transfer, departure, arrive_by, max_fare):
+        tt = self.timetable
+        c_dep, c_arr, c_from, c_to, c_trip, c_seq = tt.c_dep, tt.c_arr, tt.c_from, tt.c_to, tt.c_trip, tt.c_seq
+        footpaths = tt.footpaths(min_transfer)
+        allowed = [m in modes for m in tt.trip_mode]
+        # 各車次目前可搭乘的上車方式：[(上車前票價, 上車站序, 前一個標籤)]，
+        # 以及留在車上到目前這站的最低票價；後者不高於在此站上車時，不另增上車方式（票價可分段相加時成立）
+        bags = {}
+        riding = {}
+        labels = self.labels
+
+        for i in range(bisect_left(c_dep, departure), len(c_dep)):
+            dep = c_dep[i]
+            if dep > arrive_by:
+                break
+            trip = c_trip[i]
+            if not allowed[trip]:
+                continue
+            frm = c_from[i]
+
+            # 上車：在此之前抵達（含轉乘時間）的標籤中票價最低者
+            best = None
+            for fp_from, walk in footpaths[frm]:
+                for label in labels[fp_from]:
+                    if label[2] < 0:
+                        # 起點標籤只能在該站直接上車
+                        if fp_from != frm or label[0] > dep:
+                            continue
+                    elif label[0] + walk > dep:
+                        continue
+                    if best is None or label[1] < best[1]:
+                        best = label
+            bag = bags.get(trip)
+            if best is not None and best[1] < riding.get(trip, INF):
+                if bag is None:
+                    bag = bags[trip] = []
+                bag.append((best[1], c_seq[i], best))
+            if not bag or c_arr[i] > arrive_by:
+                continue
+
+            # 下車：各上車方式到此站的總票價取最低
+            info = tt.trips[trip]
+            to = c_to[i]
+            alight = c_seq[i] + 1
+            label = None
+            for fare, board, prev in bag:
+                total = fare + self.fares.fare(info.mode, info.cls, info.stops[board].station, to)
+                if label is None or total < label[1]:
+                    label = (c_arr[i], total, trip, board, alight, prev)
+            riding[trip] = label[1]
+            if label[1] <= max_fare:
+                self._insert(to, label)
+
+    def legs(self, label):
+        legs = []
+        while label[2] >= 0:
+            legs.append(Leg(label[2], label[3], label[4]))
+            label = label[5]
+        legs.reverse()
+        return tuple(legs)
+
+
+class Router:
+    def __init__(self, timetable, fares=None):
+        self.timetable = timetable
+        self.fares = fares or FareEngine.load(timetable)
+        self._profile = lru_cache(maxsize=256)(self._build_profile)
+        self._reachable = lru_cache(maxsize=256)(self._build_reachable)
+
+    @classmethod
+    def load(cls, path=TIMETABLE_PATH):
+        return cls(Timetable.load(path))
+
+    def _build_profile(self, destination, variant):
+        modes, min_transfer = VARIANTS[variant]
+        targets = self.timetable.county_stations.get(destination, ())
+        return Profile(self.timetable, targets, modes, min_transfer)
+
+    def itineraries(self, origin, destination, route_type):
+        # 全日所有 Pareto 最佳行程（出發較晚或抵達較早），依出發時間排序
+        tt = self.timetable
+        origins = tt.county_stations.get(origin, ())
+        if not origins or destination not in tt.county_stations or origin == destination:
+            return []
+        profile = self._profile(destination, route_type)
+
+        entries = [e for station in origins for e in profile.entries[station]]
+        entries.sort(key=lambda e: (-e[0], e[1]))
+        earliest = INF
+        journeys = []
+        for entry in entries:
+            if entry[1] >= earliest:
+                continue
+            earliest = entry[1]
+            journeys.append(self.journey_from_legs(profile.unpack(entry)))
+        journeys.reverse()
+        return journeys
+
+    def reachable(self, origin, departure, arrive_by=INF, max_fare=INF):
+        # 一次掃描求出起點到各縣市最早抵達與最便宜的行程：{縣市: (最早抵達, 最便宜)}
+        return self._reachable(origin, departure, arrive_by, max_fare)
+
+    def _build_reachable(self, origin, departure, arrive_by, max_fare):
+        tt = self.timetable
+        origins = tt.county_stations.get(origin, ())
+        if not origins:
+            return {}
+        modes, min_transfer = VARIANTS['fastest']
+        reach = Reach(tt, self.fares, origins, departure, modes, min_transfer, arrive_by, max_fare)
+        found = {}
+        for county, stations in tt.county_stations.items():
+            if county == origin:
+                continue
+            labels = [l for s in stations for l in reach.labels[s] if l[2] >= 0]
+            if not labels:
+                continue
+            earliest = min(labels, key=lambda l: (l[0], l[1]))
+            cheapest = min(labels, key=lambda l: (l[1], l[0]))
+            found[county] = (self.journey_from_legs(reach.legs(earliest)),
+                             self.journey_from_legs(reach.legs(cheapest)))
+        return found
+
+    def journey_from_legs(self, legs):
+        tt = self.timetable
+        transfers = []
+        for prev, nxt in zip(legs, legs[1:]):
+            arrived = tt.trips[prev.trip].stops[prev.alight]
+            boarding = tt.trips[nxt.trip].stops[nxt.board]
+            transfers.append(Transfer(arrived.station, boarding.dep - arrived.arr))
+        first, last = legs[0], legs[-1]
+        return Journey(
+            id='_'.join('%s.%d.%d' % (tt.trips[l.trip].id, l.board, l.alight) for l in legs),
+            legs=tuple(legs),
+            departure=tt.trips[first.trip].stops[first.board].dep,
+            arrival=tt.trips[last.trip].stops[last.alight].arr,
+            fare=self.fares.journey_fare(legs),
+            transfers=tuple(transfers),
+        )
+
+    def journey(self, journey_id):
+        # 由行程代碼還原行程，格式為 "<車次>.<上車站序>.<下車站序>" 以 "_" 串接
+        tt = self.timetable
+        legs = []
+        try:
+            for part in str(journey_id).split('_'):
+                trip_id, board, alight = part.rsplit('.', 2)
+                legs.append(Leg(tt.trip_index[trip_id], int(board), int(alight)))
+        except (KeyError, ValueError):
+            return None
+        for i, leg in enumerate(legs):
+            stops = tt.trips[leg.trip].stops
+            if not 0 <= leg.board < leg.alight < len(stops):
+                return None
+            if i:
+                prev = legs[i - 1]
+                arrived = tt.trips[prev.trip].stops[prev.alight]
+                boarding = stops[leg.board]
+                linked = arrived.station == boarding.station or any(
+                    s == boarding.station for s, _ in tt.transfers[arrived.station])
+                if not linked or boarding.dep < arrived.arr:
+                    return None
+        return self.journey_from_legs(legs)
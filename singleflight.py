@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+import uuid
+
+LEASE_TTL = float(os.environ.get('SINGLEFLIGHT_LEASE_TTL', 60))
+WAIT_TIMEOUT = float(os.environ.get('SINGLEFLIGHT_WAIT_TIMEOUT', 60))
+POLL_INTERVAL = 0.05
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Flight:
+    # begin() 的結果：leader 負責呼叫上游並以 finish()/fail() 回報，其餘以 wait() 等待
+    def __init__(self, group, key, call, owns_call):
+        self.group = group
+        self.key = key
+        self.call = call
+        self.owns_call = owns_call
+        self.owner = None
+        self.leader = False
+
+    def _acquire(self):
+        owner = uuid.uuid4().hex
+        if self.group.cache.acquire_lease(self.key, owner, self.group.lease_ttl):
+            self.owner = owner
+            self.leader = True
+        return self.leader
+
+    def wait(self):
+        # 回傳結果；回傳 None 表示此呼叫者已改為 leader，需自行產生結果
+        deadline = time.monotonic() + self.group.wait_timeout
+        if not self.owns_call:
+            if not self.call.done.wait(self.group.wait_timeout):
+                self.leader = True
+                return None
+            if self.call.error is not None:
+                raise self.call.error
+            return self.call.result
+
+        # 其他 worker 持有租約：輪詢共用快取直到結果出現或租約釋出
+        while time.monotonic() < deadline:
+            result = self.group.cache.get(self.key)
+            if result is not None:
+                self.finish(result)
+                return result
+            if self._acquire():
+                return None
+            time.sleep(self.group.poll_interval)
+        self.leader = True
+        return None
+
+    def _resolve(self, result, error):
+        if self.owner is not None:
+            self.group.cache.release_lease(self.key, self.owner)
+            self.owner = None
+        if self.owns_call:
+            self.call.result = result
+            self.call.error = error
+            with self.group._lock:
+                if self.group._calls.get(self.key) is self.call:
+                    del self.group._calls[self.key]
+            self.call.done.set()
+            self.owns_call = False
+
+    def finish(self, result):
+        self._resolve(result, None)
+
+    def fail(self, error):
+        self._resolve(None, error)
+
+
+class SingleFlight:
+    # 合併相同鍵的並行請求：行程內以 Event 等待，跨 worker 以 SQLite 租約協調
+    def __init__(self, cache, lease_ttl=LEASE_TTL, wait_timeout=WAIT_TIMEOUT, poll_interval=POLL_INTERVAL):
+        self.cache = cache
+        self.lease_ttl = lease_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return Flight(self, key, call, owns_call=False)
+            call = self._calls[key] = _Call()
+        flight = Flight(self, key, call, owns_call=True)
+        flight._acquire()
+        return flight
+
+    def do(self, key, fn):
+        flight = self.begin(key)
+        if not flight.leader:
+            result = flight.wait()
+            if result is not None:
+                return result
+        try:
+            result = fn()
+        except BaseException as e:
+            flight.fail(e)
+            raise
+        flight.finish(result)
+        return result
@@ -0,0 +1,122 @@
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+from catalog import route_label
+from estimates import COUNTIES, catalog_version, timetable_digest
+from precompiled import brotli, fingerprint
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+STATIC_PLANS_DIR = os.environ.get('STATIC_PLANS_DIR', os.path.join(INSTANCE_DIR, 'static-plans'))
+# 匯出結果對外的網址（例如 https://cdn.example.com/plans）；未設定時頁面一律呼叫 /api/plan
+STATIC_PLANS_URL = os.environ.get('STATIC_PLANS_URL', '').rstrip('/')
+HOURS = 24
+MANIFEST = 'manifest.json'
+SHARD_DIR = 'shards'
+
+# 匯出的目錄可直接交給 nginx 或 CDN：
+#   shards/ 的檔名含內容雜湊，可設 Cache-Control: public, max-age=31536000, immutable
+#   manifest.json 每次匯出都會更新，應設 no-cache
+#   已預先壓縮成 .gz（安裝 brotli 時另有 .br），nginx 以 gzip_static / brotli_static 直接送出
+#   與網站不同網域時需加上 Access-Control-Allow-Origin
+
+logger = logging.getLogger(__name__)
+
+
+def shard_body(plans):
+    # 一個起訖對、一個整點時段內的規劃結果：結果只在候選班次範圍改變時不同，
+    # 因此只記錄結果改變的分鐘，查詢時取 from 不大於出發分鐘的最後一筆
+    body = {'plans': [{'from': minute, 'routes': routes} for minute, routes in plans]}
+    return json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def routes_payload(plan):
+    # 與 /api/plan 相同的格式（不含只在當天有意義的即時誤點資訊）
+    return {
+        route_type: {
+            'label': route_label(schedules[0]) if schedules else None,
+            'schedules': [s.payload for s in schedules],
+        }
+        for route_type, schedules in plan.items()
+    }
+
+
+def write_file(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def write_compressed(path, body):
+    # 原始檔與預先壓縮的版本；壓縮後沒有比較小就不寫
+    variants = {'': body, '.gz': gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(body, quality=11)
+    for suffix, data in variants.items():
+        if suffix and len(data) >= len(body):
+            continue
+        write_file(path + suffix, data)
+
+
+def export(catalog, out_dir=STATIC_PLANS_DIR, digest=None):
+    # 以與 /api/plan 相同的規劃邏輯，匯出每個起訖對在一天中每一分鐘出發的結果，依整點切成分片
+    shard_dir = os.path.join(out_dir, SHARD_DIR)
+    os.makedirs(shard_dir, exist_ok=True)
+    pairs = [(o, d) for o in COUNTIES for d in COUNTIES if o != d]
+    minutes = HOURS * 60
+    plans = catalog.plan_many([(o, d, m) for o, d in pairs for m in range(minutes)])
+
+    shards = {}
+    written = set()
+    for p, (origin, destination) in enumerate(pairs):
+        names = []
+        for hour in range(HOURS):
+            entries, previous = [], None
+            for minute in range(hour * 60, hour * 60 + 60):
+                plan = plans[p * minutes + minute]
+                key = tuple((t, tuple(s.id for s in schedules)) for t, schedules in plan.items())
+                if key != previous:
+                    entries.append((minute, routes_payload(plan)))
+                    previous = key
+            body = shard_body(entries)
+            name = f'{SHARD_DIR}/{fingerprint(body)}.json'
+            # 內容相同的分片（例如深夜查無班次）共用一個檔案
+            if name not in written:
+                if not os.path.exists(os.path.join(out_dir, name)):
+                    write_compressed(os.path.join(out_dir, name), body)
+                written.add(name)
+            names.append(name)
+        shards.setdefault(origin, {})[destination] = names
+
+    # manifest 最後寫入，讀到新 manifest 時它引用的分片都已存在
+    digest = digest or timetable_digest()
+    manifest = {
+        'version': catalog_version(catalog, digest),
+        'timetable': digest.hex(),
+        'fares': catalog.router.fares.digest.hex(),
+        'generated': datetime.now().isoformat(timespec='seconds'),
+        'hours': HOURS,
+        'shards': shards,
+    }
+    write_compressed(os.path.join(out_dir, MANIFEST),
+                     json.dumps(manifest, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    return len(written)
+
+
+if __name__ == '__main__':
+    # 產生靜態規劃結果：python static_plans.py [輸出目錄]
+    logging.basicConfig(level=logging.INFO)
+    from catalog import ScheduleCatalog
+    from routing import Router
+    from timetable_bin import load_timetable
+
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else STATIC_PLANS_DIR
+    started = time.time()
+    timetable = load_timetable()
+    count = export(ScheduleCatalog(Router(timetable)), out_dir, timetable.digest)
+    logger.info('exported %d plan shards to %s in %.1fs', count, out_dir, time.time() - started)
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from blocking import run_blocking
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+CACHE_PATH = os.environ.get('SUGGESTION_CACHE_PATH', os.path.join(INSTANCE_DIR, 'suggestions.sqlite3'))
+CACHE_SIZE = int(os.environ.get('SUGGESTION_CACHE_SIZE', 2048))
+CACHE_TTL = int(os.environ.get('SUGGESTION_CACHE_TTL', 7 * 24 * 3600))
+# 超過此時間的項目仍可回傳，但應在背景重新產生（stale-while-revalidate）
+CACHE_REFRESH = int(os.environ.get('SUGGESTION_CACHE_REFRESH', 24 * 3600))
+
+# 每寫入幾筆清一次過期資料
+PURGE_EVERY = 256
+
+
+def make_key(payload):
+    # 以 prompt 與模型參數的雜湊作為快取鍵
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class SuggestionCache:
+    # 兩層快取：行程內 LRU + 各 worker 共用的 SQLite（WAL 模式）
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_SIZE, ttl=CACHE_TTL, refresh_after=CACHE_REFRESH):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS suggestions ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, refresh_at REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS leases ('
+                'key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, value, expires, refresh_at):
+        with self._lock:
+            self._memory[key] = (expires, value, refresh_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def lookup(self, key):
+        # 回傳 (value, stale)；記憶體中的項目過了刷新時間時，先到磁碟層找其他 worker 更新過的版本
+        now = time.time()
+        stale_value = None
+        with self._lock:
+            hit = self._memory.get(key)
+            if hit is not None:
+                expires, value, refresh_at = hit
+                if expires <= now:
+                    del self._memory[key]
+                elif refresh_at > now:
+                    self._memory.move_to_end(key)
+                    return value, False
+                else:
+                    stale_value = value
+        try:
+            row = self._db().execute(
+                'SELECT value, expires, refresh_at FROM suggestions WHERE key = ? AND expires > ?', (key, now)
+            ).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is None:
+            return stale_value, stale_value is not None
+        self._remember(key, *row)
+        return row[0], row[2] <= now
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def set(self, key, value):
+        now = time.time()
+        expires = now + self.ttl
+        refresh_at = now + self.refresh_after
+        self._remember(key, value, expires, refresh_at)
+        self._writes += 1
+        try:
+            # 寫入在 gevent worker 中改由原生執行緒執行，等待 SQLite 鎖時不卡住其他請求
+            run_blocking(self._store, key, value, now, expires, refresh_at, self._writes % PURGE_EVERY == 0)
+        except sqlite3.Error:
+            pass
+
+    def _store(self, key, value, now, expires, refresh_at, purge):
+        db = self._db()
+        db.execute(
+            'INSERT OR REPLACE INTO suggestions (key, value, expires, refresh_at) VALUES (?, ?, ?, ?)',
+            (key, value, expires, refresh_at),
+        )
+        if purge:
+            db.execute('DELETE FROM suggestions WHERE expires <= ?', (now,))
+
+    def acquire_lease(self, key, owner, ttl):
+        # 跨 worker 的租約：同一鍵同時只有一個持有者，逾期可被接手
+        try:
+            return run_blocking(self._acquire, key, owner, ttl)
+        except sqlite3.Error:
+            # 無法使用磁碟層時退回只在行程內合併
+            return True
+
+    def _acquire(self, key, owner, ttl):
+        now = time.time()
+        cursor = self._db().execute(
+            'INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+            'WHERE leases.expires <= ?',
+            (key, owner, now + ttl, now),
+        )
+        return cursor.rowcount == 1
+
+    def release_lease(self, key, owner):
+        try:
+            run_blocking(self._release, key, owner)
+        except sqlite3.Error:
+            pass
+
+    def _release(self, key, owner):
+        self._db().execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, owner))
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from jobs import JobQueue, QueueFull
+
+
+def queue(tmp_path, run, name='suggestion', **kwargs):
+    return JobQueue(run, name=name, path=str(tmp_path / 'jobs.sqlite3'), **kwargs)
+
+
+def test_job_runs_to_done_and_streams_progress(tmp_path):
+    release = threading.Event()
+
+    def run(payload, progress):
+        progress('早安')
+        release.wait(5)
+        progress('早安，出發')
+        return payload
+
+    q = queue(tmp_path, run)
+    job_id = q.submit('key', '早安，出發！')
+    # 相同 key 的工作尚未完成時共用同一個工作
+    assert q.submit('key', 'other') == job_id
+    follow = q.follow(job_id, timeout=5)
+    job = next(follow)
+    while job['result'] != '早安':
+        job = next(follow)
+    assert job['status'] == 'running'
+    release.set()
+    *_, job = follow
+    assert job['status'] == 'done' and job['result'] == '早安，出發！'
+    assert q.wait(job_id, 5)['result'] == '早安，出發！'
+    # 完成後相同 key 會建立新的工作
+    assert q.submit('key', 'again') != job_id
+
+
+def test_failed_job_reports_error(tmp_path):
+    def run(payload, progress):
+        raise RuntimeError('upstream down')
+
+    q = queue(tmp_path, run)
+    job = q.wait(q.submit('key', None), 5)
+    assert job['status'] == 'failed' and job['error'] == 'upstream down' and job['result'] is None
+
+
+def test_queued_job_can_be_cancelled(tmp_path):
+    release = threading.Event()
+    q = queue(tmp_path, lambda payload, progress: release.wait(5) and payload, workers=1, max_depth=2)
+    running = q.submit('a', 'a')
+    queued = q.submit('b', 'b')
+    assert next(job for job in q.follow(running, timeout=5) if job['status'] != 'queued')['status'] == 'running'
+    with pytest.raises(QueueFull):
+        q.submit('c', 'c')
+    assert q.cancel([queued, running, 'unknown']) == 1
+    release.set()
+    assert q.wait(running, 5)['status'] == 'done'
+    assert q.wait(queued, 5)['status'] == 'cancelled'
+    # 已取消的 key 會建立新的工作
+    assert q.wait(q.submit('b', 'b'), 5)['result'] == 'b'
+
+
+def test_queues_sharing_a_table_only_see_their_own_jobs(tmp_path):
+    suggestions = queue(tmp_path, lambda payload, progress: 'suggestion')
+    prefetch = queue(tmp_path, lambda payload, progress: 'prefetch', name='prefetch')
+    job_id = prefetch.wait(prefetch.submit('key', None), 5)['id']
+    assert prefetch.owns(job_id) and not suggestions.owns(job_id)
+    assert suggestions.get(job_id) is None and suggestions.wait(job_id, 1) is None
+    assert suggestions.cancel([job_id]) == 0
+    assert prefetch.get(job_id)['result'] == 'prefetch'
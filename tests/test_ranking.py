@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+from catalog import ScheduleCatalog
+from ranking import Ranker
+from routing import Router, Timetable
+
+
+def schedule(id, departure, arrival, fare):
+    return SimpleNamespace(id=id, departure=departure, arrival=arrival, fare=fare, transfers=())
+
+
+def test_later_shorter_train_does_not_hide_earlier_arrival():
+    early = schedule('early', 421, 562, 440)
+    late = schedule('late', 566, 706, 440)
+    plan = Ranker().rank([early, late], 420)
+    assert [s.id for s in plan['fastest']] == ['early', 'late']
+    assert plan['cheapest'][0] is early
+    assert plan['recommended'][0] is early
+
+
+def test_taipei_hualien_morning_keeps_tra404():
+    catalog = ScheduleCatalog(Router(Timetable.load()))
+    plan = catalog.plan('台北市', '花蓮縣', 7 * 60)
+    for schedules in plan.values():
+        assert schedules[0].id.startswith('TRA404.')
@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+
+import ratelimit
+from ratelimit import BACKGROUND, INTERACTIVE, Overloaded, RateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'time', clock)
+    return clock
+
+
+def bucket(tmp_path):
+    # 每秒 1 個請求、10 個 token，容量為 2 秒的配額
+    return TokenBucket(str(tmp_path / 'ratelimit.sqlite3'), requests_per_minute=60, tokens_per_minute=600,
+                       burst_seconds=2)
+
+
+def test_bucket_refills_over_time(tmp_path, clock):
+    b = bucket(tmp_path)
+    assert b.take(1) == 0
+    assert b.take(1) == 0
+    assert b.take(1) == pytest.approx(1)
+    clock.now += 0.5
+    assert b.take(1) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert b.take(1) == 0
+    # 閒置再久也只補到容量為止
+    clock.now += 60
+    assert [b.take(1) for _ in range(3)] == [0, 0, pytest.approx(1)]
+
+
+def test_bucket_is_shared_and_settled(tmp_path, clock):
+    a, b = bucket(tmp_path), bucket(tmp_path)
+    assert a.take(20) == 0
+    # 另一個 worker 看到同一個桶子：token 已用完
+    assert b.take(5) == pytest.approx(0.5)
+    # 實際用量較估計少，補回差額
+    a.settle(20, 5)
+    assert b.take(5) == 0
+
+
+def test_background_keeps_a_reserve(tmp_path, clock):
+    b = bucket(tmp_path)
+    assert b.take(1, reserve=0.5) == 0
+    # 剩下的配額保留給使用者的請求
+    assert b.take(1, reserve=0.5) > 0
+    assert b.take(1) == 0
+
+
+class Gate:
+    # 只在放行後給配額的桶子，記錄取得配額的順序
+    def __init__(self):
+        self.permits = 0
+        self.admitted = []
+        self.lock = threading.Lock()
+
+    def take(self, tokens, reserve=0.0):
+        with self.lock:
+            if self.permits:
+                self.permits -= 1
+                self.admitted.append(tokens)
+                return 0.0
+        return 0.01
+
+    def allow(self):
+        with self.lock:
+            self.permits += 1
+
+
+def wait_for(predicate):
+    deadline = time.monotonic() + 5
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_interactive_requests_go_first():
+    gate = Gate()
+    limiter = RateLimiter(gate, max_queue=4, timeout=5)
+    threads = []
+    for tokens, priority in [(1, BACKGROUND), (2, BACKGROUND), (3, INTERACTIVE)]:
+        threads.append(threading.Thread(target=limiter.acquire, args=(tokens, priority)))
+        threads[-1].start()
+        wait_for(lambda: len(limiter._queue) == len(threads))
+    for _ in threads:
+        gate.allow()
+        count = len(gate.admitted) + 1
+        wait_for(lambda: len(gate.admitted) == count)
+    for t in threads:
+        t.join()
+    # 使用者的請求先於較早排隊的背景工作，同優先序依先後
+    assert gate.admitted == [3, 1, 2]
+
+
+def test_full_queue_and_deadline_shed():
+    gate = Gate()
+    limiter = RateLimiter(gate, max_queue=1, timeout=5)
+    waiting = threading.Thread(target=limiter.acquire, args=(1,))
+    waiting.start()
+    wait_for(lambda: len(limiter._queue) == 1)
+    with pytest.raises(Overloaded):
+        limiter.acquire(1)
+    gate.allow()
+    waiting.join()
+
+    # 截止前等不到配額時立即放棄
+    with pytest.raises(Overloaded) as e:
+        RateLimiter(gate, timeout=0.005).acquire(1)
+    assert e.value.retry_after >= 1
+    assert not limiter._queue
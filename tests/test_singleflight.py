@@ -0,0 +1,49 @@
+import threading
+
+from singleflight import SingleFlight
+from suggestion_cache import SuggestionCache
+
+
+def workers(tmp_path, lease_ttl):
+    # 兩個 SingleFlight 共用同一個 SQLite，模擬兩個 worker 行程
+    path = str(tmp_path / 'suggestions.sqlite3')
+    return [SingleFlight(SuggestionCache(path), lease_ttl=lease_ttl, wait_timeout=5, poll_interval=0.01)
+            for _ in range(2)]
+
+
+def test_lease_is_taken_over_after_expiry(tmp_path):
+    a, b = workers(tmp_path, lease_ttl=0.2)
+    leader = a.begin('key')
+    assert leader.leader
+    follower = b.begin('key')
+    assert not follower.leader
+    # leader 沒有回報結果（例如行程結束），租約逾期後由等待者接手
+    assert follower.wait() is None
+    # 是取得租約而成為 leader，不是等到 wait_timeout 才放棄
+    assert follower.leader and follower.owner is not None
+    follower.finish('result')
+    assert b.cache.acquire_lease('key', 'next', 30)
+
+
+def test_follower_reads_result_from_other_worker(tmp_path):
+    a, b = workers(tmp_path, lease_ttl=30)
+    leader = a.begin('key')
+    follower = b.begin('key')
+    assert not follower.leader
+    timer = threading.Timer(0.1, lambda: (a.cache.set('key', 'result'), leader.finish('result')))
+    timer.start()
+    try:
+        assert follower.wait() == 'result'
+    finally:
+        timer.join()
+    # 租約已釋出，之後的呼叫可以直接成為 leader
+    assert a.begin('other').leader and b.begin('key').leader
+
+
+def test_callers_in_one_process_share_the_call(tmp_path):
+    group = workers(tmp_path, lease_ttl=30)[0]
+    leader = group.begin('key')
+    follower = group.begin('key')
+    assert leader.leader and not follower.leader
+    leader.finish('result')
+    assert follower.wait() == 'result'
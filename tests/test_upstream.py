@@ -0,0 +1,125 @@
+import os
+
+import pytest
+import requests
+
+from upstream import CircuitBreaker, CircuitOpenError, UpstreamClient, UpstreamError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+    def close(self):
+        pass
+
+
+class Session:
+    # 依序回傳或拋出 outcomes 中的結果
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def post(self, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return Response(outcome)
+
+
+class Killed(BaseException):
+    # 模擬 greenlet 被終止（GreenletExit 不是 Exception 的子類別）
+    pass
+
+
+def client(session, clock, threshold=2):
+    c = UpstreamClient(breaker=CircuitBreaker(threshold=threshold, reset_timeout=30, clock=clock),
+                       max_retries=0, sleep=lambda delay: None)
+    c._session, c._pid = session, os.getpid()
+    return c
+
+
+def test_breaker_opens_half_opens_and_closes():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=2, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    clock.now = 30
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    # 試探進行中不放行其他請求
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+
+
+def test_failed_probe_reopens():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=2, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now = 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    clock.now = 59
+    assert not breaker.allow()
+    clock.now = 60
+    assert breaker.allow()
+
+
+def test_body_read_errors_count_as_failures():
+    clock = Clock()
+    c = client(Session(requests.exceptions.ChunkedEncodingError('eof'),
+                       requests.exceptions.ContentDecodingError('gzip'),
+                       requests.exceptions.TooManyRedirects('loop'), 200), clock)
+    for _ in range(2):
+        with pytest.raises(UpstreamError):
+            c.post('/chat/completions', {})
+    assert c.breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        c.post('/chat/completions', {})
+
+    clock.now = 30
+    with pytest.raises(UpstreamError):
+        c.post('/chat/completions', {})
+    assert c.breaker.state == 'open'
+    clock.now = 60
+    assert c.post('/chat/completions', {}).status_code == 200
+    assert c.breaker.state == 'closed'
+
+
+def test_killed_probe_does_not_wedge_breaker():
+    clock = Clock()
+    c = client(Session(500, 500, Killed(), 200), clock)
+    for _ in range(2):
+        with pytest.raises(UpstreamError):
+            c.post('/chat/completions', {})
+    clock.now = 30
+    with pytest.raises(Killed):
+        c.post('/chat/completions', {})
+    # 試探名額已釋放，下一個請求可以再試探並關閉斷路器
+    assert c.post('/chat/completions', {}).status_code == 200
+    assert c.breaker.state == 'closed'
+
+
+def test_client_errors_do_not_trip_breaker():
+    c = client(Session(400, 404, 422), Clock())
+    for _ in range(3):
+        with pytest.raises(UpstreamError) as e:
+            c.post('/chat/completions', {})
+        assert e.value.status_code in (400, 404, 422)
+    assert c.breaker.state == 'closed'
@@ -0,0 +1,254 @@
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+
+from estimates import timetable_digest
+from routing import TIMETABLE_PATH, Station, Stop, Timetable, Trip
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+TIMETABLE_BIN_PATH = os.environ.get('TIMETABLE_BIN_PATH', os.path.join(INSTANCE_DIR, 'timetable.bin'))
+# 每個 worker 保留多少筆解碼後的車站與車次記錄
+RECORD_CACHE = int(os.environ.get('TIMETABLE_RECORD_CACHE', 4096))
+
+# magic, 位元組順序, 時刻表雜湊, 區段數
+HEADER = struct.Struct('<4sc16sI')
+# 區段名稱, 型別代碼, 起始位置, 元素數
+SECTION = struct.Struct('<8sc7xQQ')
+MAGIC = b'TPT2'
+ALIGN = 8
+
+# 固定寬度的記錄（皆為 int32）：字串欄位存字串表的編號
+STATION_FIELDS = 4  # id, 名稱, 縣市, 運具
+TRIP_FIELDS = 6  # id, 運具, 車種, 車號, 第一站, 最後一站之後
+STOP_FIELDS = 3  # 車站, 抵達, 出發
+CONNECTION_FIELDS = 6  # 出發, 抵達, 上車站, 下車站, 車次, 站序
+COUNTY_FIELDS = 3  # 名稱, 第一站, 最後一站之後
+TRANSFER_FIELDS = 2  # 目標站, 分鐘
+
+logger = logging.getLogger(__name__)
+
+
+def compile_timetable(timetable, path=TIMETABLE_BIN_PATH, digest=None):
+    # 將解析後的時刻表寫成字串表、固定寬度記錄與偏移索引組成的區段
+    strings, string_ids = [], {}
+
+    def intern(value):
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value.encode('utf-8'))
+        return string_ids[value]
+
+    stations = array('i')
+    for s in timetable.stations:
+        stations.extend((intern(s.id), intern(s.name), intern(s.county), intern(s.mode)))
+
+    trips, stops, stop_km = array('i'), array('i'), array('d')
+    for t in timetable.trips:
+        start = len(stops) // STOP_FIELDS
+        for stop in t.stops:
+            stops.extend((stop.station, stop.arr, stop.dep))
+            stop_km.append(stop.km)
+        trips.extend((intern(t.id), intern(t.mode), intern(t.cls), intern(t.no), start, start + len(t.stops)))
+
+    counties, county_stations = array('i'), array('i')
+    for county, ids in timetable.county_stations.items():
+        counties.extend((intern(county), len(county_stations), len(county_stations) + len(ids)))
+        county_stations.extend(ids)
+
+    transfer_offsets, transfers = array('i', [0]), array('i')
+    for targets in timetable.transfers:
+        for target, minutes in targets:
+            transfers.extend((target, minutes))
+        transfer_offsets.append(len(transfers) // TRANSFER_FIELDS)
+
+    connections = array('i')
+    for row in zip(timetable.c_dep, timetable.c_arr, timetable.c_from, timetable.c_to,
+                   timetable.c_trip, timetable.c_seq):
+        connections.extend(row)
+
+    string_offsets = array('i', [0])
+    for value in strings:
+        string_offsets.append(string_offsets[-1] + len(value))
+
+    sections = [
+        ('strings', array('B', b''.join(strings))),
+        ('str_off', string_offsets),
+        ('stations', stations),
+        # 依 id 排序的索引，查詢代碼時二分搜尋
+        ('st_order', array('i', sorted(range(len(timetable.stations)), key=lambda i: timetable.stations[i].id))),
+        ('trips', trips),
+        ('tr_order', array('i', sorted(range(len(timetable.trips)), key=lambda i: timetable.trips[i].id))),
+        ('stops', stops),
+        ('stop_km', stop_km),
+        ('counties', counties),
+        ('cty_sta', county_stations),
+        ('xf_off', transfer_offsets),
+        ('xfers', transfers),
+        ('conns', connections),
+    ]
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for name, values in sections:
+        offset += -offset % ALIGN
+        table.append(SECTION.pack(name.encode(), values.typecode.encode(), offset, len(values)))
+        offset += len(values) * values.itemsize
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 先寫暫存檔再替換，其他 worker 不會讀到寫到一半的檔案
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, sys.byteorder[0].encode(), digest or timetable_digest(), len(sections)))
+        for entry in table:
+            f.write(entry)
+        for _, values in sections:
+            f.write(b'\0' * (-f.tell() % ALIGN))
+            values.tofile(f)
+    os.replace(tmp, path)
+
+
+class Records(Sequence):
+    # 依需要才解碼的唯讀序列，最近用過的記錄留在快取
+    def __init__(self, length, decode, cache=RECORD_CACHE):
+        self._length = length
+        self._decode = lru_cache(maxsize=cache)(decode)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._decode(j) for j in range(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('record index out of range')
+        return self._decode(i)
+
+
+class SortedIndex(Mapping):
+    # 代碼 → 索引；以依代碼排序的索引陣列二分搜尋，不在記憶體中建 dict
+    def __init__(self, order, key):
+        self._order = order
+        self._key = key
+
+    def __getitem__(self, value):
+        if not isinstance(value, str):
+            raise KeyError(value)
+        lo, hi = 0, len(self._order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(self._order[mid]) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._order) and self._key(self._order[lo]) == value:
+            return self._order[lo]
+        raise KeyError(value)
+
+    def __iter__(self):
+        return (self._key(i) for i in self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+
+class CompiledTimetable(Timetable):
+    # 唯讀 mmap 的時刻表，介面與 Timetable 相同；開啟時不解析，連結陣列直接指向檔案內容，
+    # 各 worker 共用作業系統的頁面快取
+    def __init__(self, path=TIMETABLE_BIN_PATH):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byteorder, self.digest, count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or byteorder != sys.byteorder[0].encode():
+            raise ValueError('unsupported timetable file')
+        view = memoryview(self._mmap)
+        sections = {}
+        for i in range(count):
+            name, typecode, offset, length = SECTION.unpack_from(self._mmap, HEADER.size + i * SECTION.size)
+            typecode = typecode.decode()
+            end = offset + length * struct.calcsize(typecode)
+            if end > len(self._mmap):
+                raise ValueError('truncated timetable file')
+            sections[name.rstrip(b'\0').decode()] = view[offset:end].cast(typecode)
+
+        self._strings = sections['strings']
+        self._string_offsets = sections['str_off']
+        self._string = lru_cache(maxsize=RECORD_CACHE)(self._decode_string)
+        self._station_rows = sections['stations']
+        self._trip_rows = sections['trips']
+        self._stop_rows = sections['stops']
+        self._stop_km = sections['stop_km']
+
+        n_stations = len(self._station_rows) // STATION_FIELDS
+        n_trips = len(self._trip_rows) // TRIP_FIELDS
+        self.stations = Records(n_stations, self._station)
+        self.station_index = SortedIndex(sections['st_order'], lambda i: self.stations[i].id)
+        self.trips = Records(n_trips, self._trip)
+        self.trip_index = SortedIndex(sections['tr_order'], lambda i: self.trips[i].id)
+        trip_rows = self._trip_rows
+        self.trip_mode = Records(n_trips, lambda t: self._string(trip_rows[t * TRIP_FIELDS + 1]))
+
+        # 縣市數量很少，直接解碼
+        counties, county_stations = sections['counties'], sections['cty_sta']
+        self.county_stations = {
+            self._string(counties[k]): tuple(county_stations[counties[k + 1]:counties[k + 2]])
+            for k in range(0, len(counties), COUNTY_FIELDS)
+        }
+
+        xf_off, xfers = sections['xf_off'], sections['xfers']
+        self.transfers = Records(n_stations, lambda s: [
+            (xfers[k * TRANSFER_FIELDS], xfers[k * TRANSFER_FIELDS + 1]) for k in range(xf_off[s], xf_off[s + 1])
+        ])
+
+        # 固定寬度的連結記錄，各欄位以間隔切片取出，不複製
+        conns = sections['conns']
+        self.c_dep, self.c_arr, self.c_from, self.c_to, self.c_trip, self.c_seq = (
+            conns[k::CONNECTION_FIELDS] for k in range(CONNECTION_FIELDS)
+        )
+
+    def _decode_string(self, i):
+        return bytes(self._strings[self._string_offsets[i]:self._string_offsets[i + 1]]).decode('utf-8')
+
+    def _station(self, i):
+        row = self._station_rows[i * STATION_FIELDS:(i + 1) * STATION_FIELDS]
+        return Station(*(self._string(k) for k in row))
+
+    def _trip(self, t):
+        row = self._trip_rows[t * TRIP_FIELDS:(t + 1) * TRIP_FIELDS]
+        stops = tuple(
+            Stop(self._stop_rows[k * STOP_FIELDS], self._stop_rows[k * STOP_FIELDS + 1],
+                 self._stop_rows[k * STOP_FIELDS + 2], self._stop_km[k])
+            for k in range(row[4], row[5])
+        )
+        return Trip(self._string(row[0]), self._string(row[1]), self._string(row[2]), self._string(row[3]), stops)
+
+
+def load_timetable(path=TIMETABLE_BIN_PATH, source=TIMETABLE_PATH):
+    # 編譯檔不存在或與目前的時刻表不符時重新編譯；只部署編譯檔（沒有原始 JSON）時直接使用
+    digest = timetable_digest(source) if os.path.exists(source) else None
+    try:
+        timetable = CompiledTimetable(path)
+        if digest is None or timetable.digest == digest:
+            return timetable
+    except (OSError, ValueError, struct.error):
+        pass
+    started = time.time()
+    compile_timetable(Timetable.load(source), path, digest)
+    logger.info('compiled timetable in %.2fs', time.time() - started)
+    return CompiledTimetable(path)
+
+
+if __name__ == '__main__':
+    # 部署時執行：python timetable_bin.py
+    logging.basicConfig(level=logging.INFO)
+    started = time.time()
+    compile_timetable(Timetable.load())
+    logger.info('compiled timetable in %.2fs', time.time() - started)
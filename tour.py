@@ -0,0 +1,262 @@
+import itertools
+import random
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from routing import INF, MIN_TRANSFER, VARIANTS
+
+# 每個縣市預設停留時間（分鐘）
+DEFAULT_STAY = 120
+# 一次最多安排幾個縣市
+MAX_STOPS = 12
+# 停靠點不多時直接列舉所有順序；最短時間模式在 DP_STOPS 以內以子集合 DP 求最佳解，其餘改用區域搜尋
+EXACT_STOPS = 6
+DP_STOPS = 10
+# 區域搜尋的時間上限（秒）
+SEARCH_BUDGET = 0.5
+# 各段班次的記憶筆數上限，超過時清空
+MEMO_SIZE = 100000
+
+OBJECTIVES = ('time', 'fare')
+# 省錢模式每段允許比最早抵達晚多少分鐘（分別試算後取最佳），較大的值省錢但可能來不及走完
+FARE_SLACKS = (0, 30, 60, 120, 240, INF)
+
+Tour = namedtuple('Tour', 'order schedules departure arrival fare feasible')
+
+
+class TourPlanner:
+    # 多縣市行程：找出造訪順序與每段的班次；每段以 (起點, 終點, 可出發時間, 最晚抵達) 記憶結果
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._legs = {}
+
+    def leg(self, origin, destination, ready, deadline, objective, slack=INF):
+        key = (origin, destination, ready, deadline, objective, slack)
+        if key in self._legs:
+            return self._legs[key]
+        best = None
+        if objective == 'fare' and slack < INF:
+            earliest = self.leg(origin, destination, ready, deadline, 'time')
+            if earliest is not None:
+                deadline = min(deadline, earliest.arrival + slack)
+        # 各搜尋條件的全日行程依出發時間排序，出發越晚抵達越晚
+        for route_type in VARIANTS if objective == 'fare' else ('fastest',):
+            index = self.catalog.route(origin, destination, route_type)
+            for schedule in index.schedules[bisect_left(index.departures, ready):]:
+                if schedule.arrival > deadline:
+                    break
+                rank = (schedule.fare, schedule.arrival) if objective == 'fare' else (schedule.arrival, schedule.fare)
+                if best is None or rank < best[0]:
+                    best = (rank, schedule)
+                if objective != 'fare':
+                    break
+        if len(self._legs) >= MEMO_SIZE:
+            self._legs.clear()
+        schedule = self._legs[key] = best[1] if best else None
+        return schedule
+
+    def evaluate(self, start, order, departure, deadline, objective, stay, end=None):
+        if objective == 'fare':
+            tours = [self._simulate(start, order, departure, deadline, objective, stay, end, slack)
+                     for slack in FARE_SLACKS]
+            return min(tours, key=lambda tour: self.cost(tour, objective))
+        return self._simulate(start, order, departure, deadline, objective, stay, end)
+
+    def _simulate(self, start, order, departure, deadline, objective, stay, end=None, slack=INF):
+        stops = list(order) + ([end] if end else [])
+        schedules = []
+        at, ready, fare = start, departure, 0
+        for i, county in enumerate(stops):
+            # 保留之後各站的停留時間，避免前段選了太晚的班次
+            remaining = len(order) - i - 1 if i < len(order) else 0
+            schedule = self.leg(at, county, ready, deadline - remaining * stay, objective, slack)
+            if schedule is None:
+                break
+            schedules.append(schedule)
+            fare += schedule.fare
+            at = county
+            ready = schedule.arrival + (stay if i < len(order) - 1 or end else 0)
+        arrival = schedules[-1].arrival if schedules else departure
+        return Tour(tuple(order), tuple(schedules), departure, arrival, fare, len(schedules) == len(stops))
+
+    @staticmethod
+    def cost(tour, objective):
+        # 可行的行程優先；不可行時以完成的段數排序
+        if not tour.feasible:
+            return (1, -len(tour.schedules), tour.arrival, tour.fare)
+        if objective == 'fare':
+            return (0, 0, tour.fare, tour.arrival)
+        return (0, 0, tour.arrival, tour.fare)
+
+    def plan(self, start, counties, departure, deadline=INF, objective='time', stay=DEFAULT_STAY, end=None):
+        counties = [c for c in dict.fromkeys(counties) if c != start]
+        if not counties:
+            return Tour((), (), departure, departure, 0, True)
+
+        def run(order):
+            tour = self.evaluate(start, order, departure, deadline, objective, stay, end)
+            return self.cost(tour, objective), tour
+
+        if len(counties) <= EXACT_STOPS:
+            return min((run(order) for order in itertools.permutations(counties)), key=lambda r: r[0])[1]
+        # 初始順序：最短時間模式下的最佳（或最近鄰）順序；省錢模式另試最便宜的最近鄰順序
+        if len(counties) <= DP_STOPS:
+            order = self._earliest_order(start, counties, departure, deadline, stay, end)
+        else:
+            order = self._greedy_order(start, counties, departure, deadline, 'time', stay)
+        best = run(order)
+        if objective == 'fare':
+            best = min(best, run(self._greedy_order(start, counties, departure, deadline, objective, stay)),
+                       key=lambda r: r[0])
+
+        # 由目前最佳順序做區域搜尋，卡在局部最佳時改從隨機順序重新開始，直到時間上限
+        stop_at = time.monotonic() + SEARCH_BUDGET
+        rng = random.Random(0)
+        current = best
+        while time.monotonic() < stop_at:
+            current = self._improve(run, current, stop_at)
+            if current[0] < best[0]:
+                best = current
+            if objective == 'time' and len(counties) <= DP_STOPS:
+                break
+            order = list(counties)
+            rng.shuffle(order)
+            current = run(order)
+        return best[1]
+
+    def _greedy_order(self, start, counties, departure, deadline, objective, stay):
+        # 最近鄰：每次前往下一段最快抵達（或最便宜）的縣市
+        order, at, ready = [], start, departure
+        left = list(counties)
+        while left:
+            def rank(county):
+                schedule = self.leg(at, county, ready, deadline, objective)
+                if schedule is None:
+                    return (1, 0, 0)
+                return (0, schedule.fare, schedule.arrival) if objective == 'fare' else (0, schedule.arrival, 0)
+            nxt = min(left, key=rank)
+            schedule = self.leg(at, nxt, ready, deadline, objective)
+            left.remove(nxt)
+            order.append(nxt)
+            at = nxt
+            if schedule is not None:
+                ready = schedule.arrival + stay
+        return order
+
+    def _earliest_order(self, start, counties, departure, deadline, stay, end):
+        # 子集合 DP：班次出發越晚抵達越晚，因此每個 (已造訪集合, 目前縣市) 只需保留最早抵達的狀態
+        n = len(counties)
+        best = {}
+        for j, county in enumerate(counties):
+            schedule = self.leg(start, county, departure, deadline - (n - 1) * stay, 'time')
+            if schedule is not None:
+                best[(1 << j, j)] = (schedule.arrival, schedule.fare, None)
+        for mask in range(1, 1 << n):
+            visited = bin(mask).count('1')
+            for j in range(n):
+                state = best.get((mask, j))
+                if state is None:
+                    continue
+                ready = state[0] + stay
+                for k in range(n):
+                    if mask & (1 << k):
+                        continue
+                    schedule = self.leg(counties[j], counties[k], ready, deadline - (n - visited - 1) * stay, 'time')
+                    if schedule is None:
+                        continue
+                    key = (mask | (1 << k), k)
+                    value = (schedule.arrival, state[1] + schedule.fare, (mask, j))
+                    if key not in best or value[:2] < best[key][:2]:
+                        best[key] = value
+
+        full = (1 << n) - 1
+        finals = []
+        for j in range(n):
+            state = best.get((full, j))
+            if state is None:
+                continue
+            arrival, fare = state[0], state[1]
+            if end:
+                schedule = self.leg(counties[j], end, arrival + stay, deadline, 'time')
+                if schedule is None:
+                    continue
+                arrival, fare = schedule.arrival, fare + schedule.fare
+            finals.append(((arrival, fare), (full, j)))
+        if not finals:
+            return self._greedy_order(start, counties, departure, deadline, 'time', stay)
+        key = min(finals)[1]
+        order = []
+        while key is not None:
+            order.append(counties[key[1]])
+            key = best[key][2]
+        return order[::-1]
+
+    @staticmethod
+    def _improve(run, best, stop_at):
+        # 搬移（relocate）與區段反轉（2-opt），採第一個改善，直到沒有改善或超過時間上限
+        order = list(best[1].order)
+        improved = True
+        while improved and time.monotonic() < stop_at:
+            improved = False
+            for i, j in itertools.permutations(range(len(order)), 2):
+                moved = order[:i] + order[i + 1:]
+                moved.insert(j, order[i])
+                candidates = [moved]
+                if i < j:
+                    candidates.append(order[:i] + order[i:j + 1][::-1] + order[j + 1:])
+                for candidate in candidates:
+                    result = run(candidate)
+                    if result[0] < best[0]:
+                        best, order, improved = result, candidate, True
+                        break
+                if improved or time.monotonic() >= stop_at:
+                    break
+        return best
+
+
+def parse_trip_time(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M')
+    except (TypeError, ValueError):
+        return None
+
+
+def validate_trips(catalog, trips, min_gap=MIN_TRANSFER):
+    # 檢查依出發時間排序的行程是否前後銜接：起訖縣市是否相接、時間是否重疊或轉乘時間不足
+    timed = []
+    conflicts = []
+    for trip in trips:
+        day = parse_trip_time(trip.get('departure_time'))
+        schedule = catalog.get(trip.get('schedule_id')) if trip.get('schedule_id') else None
+        if day is None:
+            conflicts.append({'trip_id': trip.get('id'), 'kind': 'invalid_time', 'message': '出發時間格式錯誤'})
+            continue
+        if schedule is None:
+            departure = arrival = day
+        else:
+            midnight = day.replace(hour=0, minute=0)
+            departure = midnight + timedelta(minutes=schedule.departure)
+            arrival = midnight + timedelta(minutes=schedule.arrival)
+        timed.append((departure, arrival, trip))
+    timed.sort(key=lambda item: (item[0], item[2].get('id') or 0))
+
+    for (_, prev_arrival, prev), (departure, _, trip) in zip(timed, timed[1:]):
+        if prev['destination'] != trip['origin']:
+            conflicts.append({
+                'trip_id': trip.get('id'), 'previous_id': prev.get('id'), 'kind': 'discontinuous',
+                'message': f"前一段行程抵達{prev['destination']}，但此行程從{trip['origin']}出發",
+            })
+        gap = (departure - prev_arrival).total_seconds() // 60
+        if gap < 0:
+            conflicts.append({
+                'trip_id': trip.get('id'), 'previous_id': prev.get('id'), 'kind': 'overlap',
+                'message': f'此行程出發時前一段行程尚未抵達（相差{int(-gap)}分鐘）',
+            })
+        elif gap < min_gap:
+            conflicts.append({
+                'trip_id': trip.get('id'), 'previous_id': prev.get('id'), 'kind': 'tight',
+                'message': f'與前一段行程只相隔{int(gap)}分鐘',
+            })
+    return conflicts
@@ -0,0 +1,185 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from blocking import run_blocking
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+TRIPS_PATH = os.environ.get('TRIPS_PATH', os.path.join(INSTANCE_DIR, 'trips.sqlite3'))
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# 單次批次新增/刪除的筆數上限
+MAX_BULK = 1000
+
+FIELDS = ('origin', 'destination', 'departure_time', 'schedule_id', 'schedule', 'cost', 'booking_links')
+
+
+class TripError(ValueError):
+    pass
+
+
+def encode_cursor(departure_time, trip_id):
+    raw = f'{departure_time}|{trip_id}'.encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        departure_time, trip_id = raw.rsplit('|', 1)
+        return departure_time, int(trip_id)
+    except ValueError:
+        raise TripError('invalid cursor')
+
+
+def clean_trip(data):
+    if not isinstance(data, dict):
+        raise TripError('trip must be an object')
+    trip = {}
+    for field in FIELDS:
+        value = data.get(field)
+        if field == 'booking_links':
+            trip[field] = value if isinstance(value, dict) else {}
+        elif value is None:
+            trip[field] = ''
+        else:
+            trip[field] = str(value)[:500]
+    for field in ('origin', 'destination', 'departure_time'):
+        if not trip[field]:
+            raise TripError(f'{field} is required')
+    return trip
+
+
+class TripStore:
+    # 已確認行程：SQLite WAL，寫入不阻擋讀取；每位使用者有版本號供條件式 GET 使用
+    def __init__(self, path=TRIPS_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS trips ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, user TEXT NOT NULL, '
+                'origin TEXT NOT NULL, destination TEXT NOT NULL, departure_time TEXT NOT NULL, '
+                'schedule_id TEXT NOT NULL, schedule TEXT NOT NULL, cost TEXT NOT NULL, '
+                'booking_links TEXT NOT NULL, created REAL NOT NULL)'
+            )
+            # 列表依 (使用者, 出發時間, id) 做 keyset 分頁
+            conn.execute('CREATE INDEX IF NOT EXISTS trips_user_departure ON trips (user, departure_time, id)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS trip_versions (user TEXT PRIMARY KEY, version INTEGER NOT NULL)'
+            )
+            self._local.conn = conn
+        return conn
+
+    def _bump(self, db, user):
+        db.execute(
+            'INSERT INTO trip_versions (user, version) VALUES (?, 1) '
+            'ON CONFLICT(user) DO UPDATE SET version = version + 1',
+            (user,),
+        )
+
+    @staticmethod
+    def _row(row):
+        trip = {field: row[field] for field in FIELDS}
+        trip['id'] = row['id']
+        trip['booking_links'] = json.loads(row['booking_links'])
+        return trip
+
+    def version(self, user):
+        row = self._db().execute('SELECT version FROM trip_versions WHERE user = ?', (user,)).fetchone()
+        return row['version'] if row else 0
+
+    def insert_many(self, user, trips):
+        if len(trips) > MAX_BULK:
+            raise TripError(f'at most {MAX_BULK} trips per request')
+        trips = [clean_trip(t) for t in trips]
+        # 寫入交易在 gevent worker 中改由原生執行緒執行，BEGIN IMMEDIATE 等待鎖時不卡住其他請求
+        ids = run_blocking(self._insert, user, trips)
+        return [dict(trip, id=trip_id) for trip, trip_id in zip(trips, ids)]
+
+    def _insert(self, user, trips):
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            ids = []
+            for trip in trips:
+                cursor = db.execute(
+                    'INSERT INTO trips (user, origin, destination, departure_time, schedule_id, schedule, '
+                    'cost, booking_links, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (user, trip['origin'], trip['destination'], trip['departure_time'], trip['schedule_id'],
+                     trip['schedule'], trip['cost'], json.dumps(trip['booking_links'], ensure_ascii=False), now),
+                )
+                ids.append(cursor.lastrowid)
+            if ids:
+                self._bump(db, user)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return ids
+
+    def delete_many(self, user, ids):
+        try:
+            ids = [int(i) for i in ids]
+        except (TypeError, ValueError):
+            raise TripError('ids must be integers')
+        if len(ids) > MAX_BULK:
+            raise TripError(f'at most {MAX_BULK} ids per request')
+        return run_blocking(self._delete, user, ids)
+
+    def _delete(self, user, ids):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            deleted = 0
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                deleted += db.execute(
+                    f'DELETE FROM trips WHERE user = ? AND id IN ({",".join("?" * len(chunk))})',
+                    [user] + chunk,
+                ).rowcount
+            if deleted:
+                self._bump(db, user)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return deleted
+
+    def get(self, user, trip_id):
+        row = self._db().execute('SELECT * FROM trips WHERE user = ? AND id = ?', (user, trip_id)).fetchone()
+        return self._row(row) if row else None
+
+    def list(self, user, cursor=None, limit=PAGE_SIZE):
+        # 回傳 (行程, 下一頁 cursor)；依出發時間排序
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        if cursor:
+            after = decode_cursor(cursor)
+            rows = self._db().execute(
+                'SELECT * FROM trips WHERE user = ? AND (departure_time, id) > (?, ?) '
+                'ORDER BY departure_time, id LIMIT ?',
+                (user, after[0], after[1], limit + 1),
+            ).fetchall()
+        else:
+            rows = self._db().execute(
+                'SELECT * FROM trips WHERE user = ? ORDER BY departure_time, id LIMIT ?', (user, limit + 1)
+            ).fetchall()
+        trips = [self._row(r) for r in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor(trips[-1]['departure_time'], trips[-1]['id'])
+        return trips, next_cursor
@@ -0,0 +1,196 @@
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import upstream_latency
+
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+
+# 連線與讀取分開設定逾時（秒）
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 20))
+POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 10))
+MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 2))
+BACKOFF_BASE = float(os.environ.get('UPSTREAM_BACKOFF_BASE', 0.5))
+BACKOFF_CAP = float(os.environ.get('UPSTREAM_BACKOFF_CAP', 4))
+# 連續失敗幾次後斷路，以及斷路多久後再試
+BREAKER_THRESHOLD = int(os.environ.get('UPSTREAM_BREAKER_THRESHOLD', 5))
+BREAKER_RESET = float(os.environ.get('UPSTREAM_BREAKER_RESET', 30))
+
+RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+
+
+class UpstreamError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class CircuitBreaker:
+    # closed → open（連續失敗達門檻）→ half-open（冷卻後放行一個試探請求）
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.opened_at = self.clock()
+            self._probing = False
+
+    def release(self):
+        # 試探請求沒有得出結果就中止（例如 greenlet 被終止）時，讓下一個請求重新試探
+        with self._lock:
+            self._probing = False
+
+
+class UpstreamClient:
+    def __init__(self, base_url=OPENAI_BASE_URL, pool_size=POOL_SIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP,
+                 breaker=None, sleep=time.sleep):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker or CircuitBreaker()
+        self.sleep = sleep
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # 每個 worker 行程各自建立連線池，fork 之後不可共用 socket
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def backoff(self, attempt, retry_after=None):
+        # full jitter 指數退避；伺服器指定 Retry-After 時以其為下限
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_cap))
+        return delay
+
+    def post(self, path, payload, headers=None, stream=False):
+        if not self.breaker.allow():
+            upstream_latency.observe(0, 'circuit_open')
+            raise CircuitOpenError('upstream circuit is open')
+
+        settled = False
+        try:
+            response = self._post(self.base_url + path, payload, headers, stream)
+            settled = True
+            return response
+        except UpstreamError:
+            settled = True
+            raise
+        finally:
+            if not settled:
+                self.breaker.release()
+
+    def _post(self, url, payload, headers, stream):
+        # 每次嘗試都以 record_success / record_failure 或 UpstreamError 結束
+        attempt = 0
+        while True:
+            retry_after = None
+            started = time.perf_counter()
+            try:
+                response = self.session.post(url, json=payload, headers=headers,
+                                             timeout=self.timeout, stream=stream)
+            except requests.RequestException as e:
+                # 除連線與逾時外，也包含讀取回應內容時的錯誤（ChunkedEncodingError 等）與過多重新導向
+                status = 'timeout' if isinstance(e, requests.Timeout) else 'error'
+                upstream_latency.observe(time.perf_counter() - started, status)
+                error = UpstreamError(f'upstream request failed: {e}')
+            else:
+                # 串流請求只量到收到回應標頭為止
+                upstream_latency.observe(time.perf_counter() - started, str(response.status_code))
+                if response.status_code < 400:
+                    self.breaker.record_success()
+                    return response
+                error = UpstreamError(f'upstream returned {response.status_code}', response.status_code)
+                response.close()
+                if response.status_code not in RETRY_STATUS:
+                    # 4xx 為請求本身的問題，不計入斷路器
+                    self.breaker.record_success()
+                    raise error
+                try:
+                    retry_after = float(response.headers.get('Retry-After'))
+                except (TypeError, ValueError):
+                    pass
+
+            if attempt >= self.max_retries:
+                self.breaker.record_failure()
+                raise error
+            self.sleep(self.backoff(attempt, retry_after))
+            attempt += 1
+
+    def stream(self, path, payload, headers=None):
+        # 讀取 SSE 回應，逐一產生每個 data 事件的 JSON；只在收到首個位元組前重試
+        response = self.post(path, payload, headers=headers, stream=True)
+        try:
+            for line in response.iter_lines():
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    return
+                yield json.loads(data)
+        except (requests.RequestException, ValueError) as e:
+            self.breaker.record_failure()
+            raise UpstreamError(f'upstream stream interrupted: {e}')
+        finally:
+            response.close()
+
+
+openai_client = UpstreamClient()
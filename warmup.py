@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+WARMUP_PATH = os.environ.get('SUGGESTION_WARMUP_PATH', os.path.join(DATA_DIR, 'warmup.json'))
+WARMUP_CONCURRENCY = int(os.environ.get('SUGGESTION_WARMUP_CONCURRENCY', 4))
+# 背景預先產生的間隔（秒），0 表示不啟動
+WARMUP_INTERVAL = float(os.environ.get('SUGGESTION_WARMUP_INTERVAL', 3600))
+MAX_PENDING = 256
+
+logger = logging.getLogger(__name__)
+
+
+def load_catalog(path=WARMUP_PATH):
+    # 需要預先產生建議的熱門路線與出發時段
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'days': 0, 'departures': [], 'routes': []}
+
+
+class SuggestionWarmer:
+    # jobs() 產生 (cache_key, request_data)；fetch(cache_key, request_data) 呼叫上游並寫入快取
+    def __init__(self, cache, jobs, fetch, concurrency=WARMUP_CONCURRENCY, max_pending=MAX_PENDING):
+        self.cache = cache
+        self.jobs = jobs
+        self.fetch = fetch
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                    thread_name_prefix='suggestion-warmup')
+            return self._executor
+
+    def _run(self, key, request_data):
+        try:
+            value, stale = self.cache.lookup(key)
+            if value is None or stale:
+                self.fetch(key, request_data)
+        except Exception:
+            logger.exception('suggestion warm-up failed for %s', key)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def refresh(self, key, request_data):
+        # 在背景重新產生；同一鍵不重複排入，佇列滿時直接略過
+        with self._lock:
+            if key in self._pending or len(self._pending) >= self.max_pending:
+                return None
+            self._pending.add(key)
+        return self.executor.submit(self._run, key, request_data)
+
+    def warm(self):
+        # 依序排入所有目錄項目，待排數量達上限時等待前面的工作完成
+        futures = set()
+        submitted = 0
+        for key, request_data in self.jobs():
+            while len(futures) >= self.max_pending:
+                futures = wait(futures, return_when='FIRST_COMPLETED').not_done
+            future = self.refresh(key, request_data)
+            if future is not None:
+                futures.add(future)
+                submitted += 1
+        wait(futures)
+        return submitted
+
+    def start(self, interval=WARMUP_INTERVAL):
+        if interval <= 0 or self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.warm()
+                except Exception:
+                    logger.exception('suggestion warm-up round failed')
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=loop, name='suggestion-warmup-scheduler', daemon=True)
+        self._thread.start()
+
+
+if __name__ == '__main__':
+    # 部署時執行：python warmup.py
+    os.environ['SUGGESTION_WARMUP_INTERVAL'] = '0'
+    logging.basicConfig(level=logging.INFO)
+    from app import suggestion_warmer
+
+    started = time.time()
+    count = suggestion_warmer.warm()
+    logger.info('warmed %d suggestions in %.1fs', count, time.time() - started)